@@ -0,0 +1,273 @@
+import math
+import operator
+
+from jit import decode
+
+# Registers a loop may update. r4 and r5 address RAM, r6 is always 0 and r7
+# is the PC.
+REGS = (0, 1, 2, 3)
+
+ZERO = (0, 0, 0, 0, 0)
+
+# COND subtypes with their operands swapped, and negated.
+SWAPPED = {0b001: 0b001, 0b101: 0b101, 0b010: 0b111, 0b111: 0b010, 0b011: 0b110, 0b110: 0b011}
+NEGATED = {0b001: 0b101, 0b101: 0b001, 0b010: 0b110, 0b110: 0b010, 0b011: 0b111, 0b111: 0b011}
+TESTS = {
+    0b001: operator.ne,
+    0b010: operator.ge,
+    0b011: operator.gt,
+    0b101: operator.eq,
+    0b110: operator.lt,
+    0b111: operator.le,
+}
+
+
+def unit(r):
+    # The form of register r's value at the start of an iteration.
+    return tuple(1 if i == r + 1 else 0 for i in range(5))
+
+
+def add(f, g, sign=1):
+    return tuple((a + sign * b) & 255 for a, b in zip(f, g))
+
+
+def compile_forms(forms, stepped=False):
+    # A function of r0-r3 returning the values of forms, as a tuple. With
+    # stepped, it takes (k, r0-r3, s0-s3) and evaluates the forms k steps of
+    # s on.
+    args = "k, x0, x1, x2, x3, s0, s1, s2, s3" if stepped else "x0, x1, x2, x3"
+    exprs = []
+    for c, *coeffs in forms:
+        terms = [str(c)] if c else []
+        for r, a in enumerate(coeffs):
+            x = f"(x{r} + k * s{r})" if stepped else f"x{r}"
+            if a == 1:
+                terms.append(x)
+            elif a == 255:
+                terms.append(f"-{x}")
+            elif a:
+                terms.append(f"{a} * {x}")
+        exprs.append(f"({' + '.join(terms)}) & 255" if terms else "0")
+    return eval(f"lambda {args}: ({', '.join(exprs)},)")
+
+
+def exits(subtype, c):
+    # The ranges of values v for which "Jcc v, c" is taken.
+    if subtype == 0b101:  # JEQ
+        return ((c, c),)
+    if subtype == 0b001:  # JNE
+        return ((0, c - 1), (c + 1, 255)) if 0 < c < 255 else ((1, 255),) if c == 0 else ((0, 254),)
+    if subtype == 0b110:  # JLT
+        return ((0, c - 1),) if c else ()
+    if subtype == 0b111:  # JLE
+        return ((0, c),)
+    if subtype == 0b011:  # JGT
+        return ((c + 1, 255),) if c < 255 else ()
+    return ((c, 255),)  # JGE
+
+
+def first_in(t, d, lo, hi):
+    # The least k >= 0 with (t + k*d) % 256 in lo..hi, or None if there is
+    # none. Works through the runs between wraparounds, so it takes at most
+    # d steps however many iterations it skips.
+    if d == 0:
+        return 0 if lo <= t <= hi else None
+    if d > 128:  # counting down: count 255 - t up instead
+        return first_in(255 - t, 256 - d, 255 - hi, 255 - lo)
+    period = 256 // math.gcd(d, 256)
+    k = 0
+    while k < period:
+        if lo <= t <= hi:
+            return k
+        if t < lo:
+            j = -(-(lo - t) // d)
+            if t + j * d <= hi:
+                return k + j
+        j = -(-(256 - t) // d)  # to the first value past 255
+        k += j
+        t += j * d - 256
+    return None
+
+
+class Loop:
+    """A loop the VM can skip to the end of.
+
+    The loop is the instructions head..tail, ending in a jump back to head.
+    They only ADD, SUB and MOV among r0-r3, and take one conditional
+    branch out: at exit, or as the jump back when it isn't taken. Register
+    values are then linear (mod 256) in their values at the start of an
+    iteration. forms holds each register's value after a whole iteration,
+    and at_test its value at the exit branch, each as (constant,
+    coefficient of r0, ..., of r3). In every iteration past the first,
+    each register changes by a fixed amount, so the exit test compares
+    an arithmetic sequence with a constant.
+    """
+
+    __slots__ = ("head", "tail", "exit", "subtype", "a", "b", "taken", "target", "forms", "at_test")
+
+    def __init__(self, head, tail, exit, subtype, a, b, taken, target, forms, at_test):
+        self.head = head
+        self.tail = tail
+        self.exit = exit  # PC of the exit branch
+        self.subtype = subtype  # its condition
+        self.a = a  # forms of its two operands
+        self.b = b
+        self.taken = taken  # whether the loop exits when it is taken
+        self.target = target  # PC the loop exits to
+        self.forms = forms
+        self.at_test = at_test
+
+
+def operand(val, imm, forms):
+    if imm:
+        return (val, 0, 0, 0, 0)
+    r = val & 0x7
+    if r in REGS:
+        return forms[r]
+    return ZERO if r == 6 else None
+
+
+def analyze(program, head, tail):
+    # Returns a Loop for head..tail, or None if it doesn't qualify.
+    forms = [unit(r) for r in REGS]
+    exit = None
+    for pc in range(head, tail + 1):
+        opclass, subtype, imm1, imm2, op1, op2, dest = decode(program[pc * 4 : pc * 4 + 4])
+        d = dest & 0x7
+        if opclass == 0b00 and subtype in (0b010, 0b110):  # ADD, SUB
+            a, b = operand(op1, imm1, forms), operand(op2, imm2, forms)
+            if a is None or b is None or d not in REGS:
+                return None
+            forms[d] = add(a, b, 1 if subtype == 0b010 else -1)
+        elif opclass == 0b10 and subtype == 0b000:  # MOV
+            a = operand(op1, imm1, forms)
+            if a is None or d not in REGS:
+                return None
+            forms[d] = a
+        elif opclass == 0b01 and subtype == 0b100:  # NOP
+            pass
+        elif opclass == 0b01 and subtype != 0b000:
+            a, b = operand(op1, imm1, forms), operand(op2, imm2, forms)
+            if a is None or b is None or exit is not None:
+                return None
+            if pc == tail and dest == head:
+                exit = Loop(head, tail, pc, subtype, a, b, False, tail + 1, None, list(forms))
+            elif not head <= dest <= tail:
+                exit = Loop(head, tail, pc, subtype, a, b, True, dest, None, list(forms))
+            else:
+                return None
+        elif not (opclass == 0b01 and pc == tail and dest == head):  # the JMP back
+            return None
+    if exit is None or (exit.exit != tail and decode(program[tail * 4 : tail * 4 + 4])[:2] != (0b01, 0b000)):
+        return None
+    # Every register either counts by an amount fixed for the whole loop,
+    # or is set from such amounts. Both only depend on registers the loop
+    # never changes.
+    fixed = {r for r in REGS if forms[r] == unit(r)}
+    for r in REGS:
+        coeffs = forms[r][1:]
+        if coeffs[r] not in (0, 1) or any(a and j != r and j not in fixed for j, a in enumerate(coeffs)):
+            return None
+    exit.forms = forms
+    return exit
+
+
+def find_loops(program):
+    # Returns {head: Loop} for every loop in program that qualifies.
+    n = min(len(program) // 4, 256)
+    loops = {}
+    for pc in range(n):
+        opclass, subtype, _, _, _, _, dest = decode(program[pc * 4 : pc * 4 + 4])
+        if opclass != 0b01 or subtype == 0b100 or dest > pc or dest in loops:
+            continue
+        loop = analyze(program, dest, pc)
+        if loop is not None:
+            loops[dest] = loop
+    return loops
+
+
+class Accelerator:
+    """Skips straight to the end of simple counting loops.
+
+    Whenever the VM reaches the head of a Loop, the iteration it leaves
+    in is worked out from the current registers, and the registers are
+    set as they would be there. The VM then resumes at the exit. The step
+    count goes up by every instruction skipped. A loop that would never
+    exit, or whose skip would overrun the run's budget, runs as usual.
+    """
+
+    def __init__(self, program):
+        self.loops = find_loops(bytes(program))
+        self.skips = 0
+        self.skipped = 0
+
+    def wrap(self, vm, table):
+        for head, loop in self.loops.items():
+            table[head] = self.handler(vm, table[head], loop)
+
+    def handler(self, vm, body, loop):
+        mem = vm.state
+        ctr = vm.ctr
+        pending = 0 if vm.engine == "jit" else 1  # see Memo.handler()
+        length = loop.tail - loop.head + 1
+        prefix = loop.exit - loop.head + 1  # instructions run in the last iteration
+        target = loop.target
+        subtype = loop.subtype if loop.taken else NEGATED[loop.subtype]
+        test, swapped = TESTS[subtype], SWAPPED[subtype]
+        operands = compile_forms((loop.a, loop.b))
+        # How far the operands move when the registers move by given amounts.
+        moves = compile_forms(((0, *loop.a[1:]), (0, *loop.b[1:])))
+        iterate = compile_forms(loop.forms)
+        steps_from = compile_forms(add(f, unit(r), -1) for r, f in enumerate(loop.forms))
+        at_exit = compile_forms(loop.at_test, stepped=True)
+
+        def exit_state(x):
+            # (iterations before the exit, registers there), or None if the
+            # loop never exits.
+            a, b = operands(*x)
+            if test(a, b):
+                return 0, at_exit(0, *x, 0, 0, 0, 0)
+            x = iterate(*x)
+            # From here on, every register moves by a fixed step.
+            step = steps_from(*x)
+            da, db = moves(*step)
+            a, b = operands(*x)
+            if da and db:
+                return None
+            if not (da or db):
+                return (1, at_exit(0, *x, *step)) if test(a, b) else None
+            t, d, c, cond = (a, da, b, subtype) if db == 0 else (b, db, a, swapped)
+            k = None
+            for lo, hi in exits(cond, c):
+                m = first_in(t, d, lo, hi)
+                if m is not None and (k is None or m < k):
+                    k = m
+            if k is None:
+                return None
+            return k + 1, at_exit(k, *x, *step)
+
+        def accelerated():
+            found = exit_state((mem[0], mem[1], mem[2], mem[3]))
+            if found is None:
+                return body()
+            k, regs = found
+            steps = k * length + prefix
+            if ctr[0] + steps > ctr[1]:
+                return body()
+            ctr[0] += steps - pending
+            mem[0], mem[1], mem[2], mem[3] = regs
+            self.skips += 1
+            self.skipped += steps
+            return target
+
+        return accelerated
+
+    def report(self, source_map=None):
+        names = ", ".join(
+            (source_map.label(head) if source_map is not None else None) or f"{head:02X}" for head in sorted(self.loops)
+        )
+        return (
+            f"Accelerated {len(self.loops)} loops ({names or 'none'}): "
+            f"{self.skips} skips, {self.skipped} instructions skipped"
+        )
+
@@ -1,5 +1,6 @@
+import os
 import re
-from typing import List
+from typing import List, NamedTuple
 
 # --- ISA encoding tables (partial, extend as needed) ---
 OPCODES = {
@@ -67,6 +68,9 @@ def parse_value(val, constants):
     raise ValueError(f"Unknown value: {val}")
 
 
+LABEL_RE = re.compile(r"^\$[A-Za-z_]\w*$")
+
+
 def is_register(val):
     return val in REGISTERS
 
@@ -128,162 +132,634 @@ def handle_shorthand_op(op: str, args: List[str]) -> List[str]:
     return args
 
 
-# --- Assembler core ---
-def assemble(lines):
-    # First pass: handle constants, macros, labels
-    constants = {}
-    macros = {}
-    labels = {}
-    code = []
-    pc = 0
-    expanded = []
-    i = 0
-    n = len(lines)
-    while i < n:
-        line = lines[i].split(";")[0].strip()
-        if not line:
-            i += 1
+# --- Lexer ---
+# One pattern, compiled once, matches every token kind. Char literals come
+# before comments so that ';' can be written as a character; strings only
+# appear in include directives.
+TOKEN_RE = re.compile(
+    r"""
+    (?P<char>'[^\n]'|"[^\n]")
+    |(?P<string>"[^"\n]*")
+    |(?P<comment>;.*)
+    |(?P<space>\s+)
+    |(?P<number>0[xX][0-9A-Fa-f]+|0[bB][01]+|\d+)
+    |(?P<name>[$A-Za-z_{][\w${}]*)
+    |(?P<punct>[,:()])
+    |(?P<error>.)
+    """,
+    re.VERBOSE,
+)
+
+MAX_MACRO_DEPTH = 64
+
+
+class Token(NamedTuple):
+    kind: str  # "char", "string", "number", "name", "punct" or "error"
+    text: str
+    line: int  # 1-based source line
+    col: int
+    file: str = None  # the included file it came from, None for the main one
+
+
+def tokenize_line(text, line=0, file=None):
+    return [
+        Token(m.lastgroup, m.group(), line, m.start(), file)
+        for m in TOKEN_RE.finditer(text)
+        if m.lastgroup not in ("space", "comment")
+    ]
+
+
+def include_target(tokens, path):
+    # The file an 'include "name"' line names, relative to the directory of
+    # the file it is in (path, or the working directory if None).
+    if len(tokens) != 2 or tokens[1].kind not in ("string", "char"):
+        fail(tokens[0], 'Invalid include, expected include "file"')
+    return os.path.normpath(os.path.join(os.path.dirname(path or ""), tokens[1].text[1:-1]))
+
+
+def tokenize(lines, path=None, seen=None, file=None):
+    # Returns the non-empty lines of the source as token lists, with the
+    # lines of included files spliced in where they are included. A file
+    # included more than once, directly or not, is only read the first time.
+    seen = set() if seen is None else seen
+    if path is not None:
+        seen.add(os.path.abspath(path))
+    result = []
+    for n, text in enumerate(lines, 1):
+        tokens = tokenize_line(text, n, file)
+        if not tokens:
             continue
-        if line.startswith("define "):
-            # Support macro arguments: define MACRO(arg1,arg2): ... end
-            m = re.match(r"define\s+(\w+)(\((.*?)\))?(\:)?\s*(.*)", line)
-            if m:
-                name = m.group(1)
-                arglist = m.group(3)
-                colon = m.group(4)
-                rest = m.group(5)
-                macro_args = []
-                if arglist:
-                    macro_args = [a.strip() for a in arglist.split(",") if a.strip()]
-                if colon:
-                    # Macro: collect lines until 'end' or next define or EOF
-                    macro_lines = []
-                    i += 1
-                    while i < n:
-                        next_line = lines[i].split(";")[0].strip()
-                        if next_line == "end":
-                            i += 1
-                            break
-                        if next_line.startswith("define "):
-                            break
-                        if next_line:
-                            macro_lines.append(next_line)
-                        i += 1
-                    macros[name.upper()] = (macro_args, macro_lines)
-                    continue
-                else:
-                    constants[name] = parse_value(rest, constants)
-                    i += 1
-                    continue
+        if tokens[0].text != "include":
+            result.append(tokens)
+            continue
+        target = include_target(tokens, path)
+        if os.path.abspath(target) in seen:
+            continue
+        try:
+            with open(target) as f:
+                included = f.readlines()
+        except OSError as e:
+            fail(tokens[0], f"Can't include {target}: {e.strerror}")
+        result.extend(tokenize(included, target, seen, target))
+    return result
+
+
+def where(file, line):
+    return f"line {line}" if file is None else f"{file} line {line}"
+
+
+def fail(token, message, chain=()):
+    uses = "".join(f", in {name} used on {where(file, line)}" for name, file, line in reversed(chain))
+    raise ValueError(f"{message} ({where(token.file, token.line)}{uses})")
+
+
+# --- Parser ---
+class Instr(NamedTuple):
+    mnemonic: str
+    args: List[str]  # OP1, OP2 and DEST after shorthand expansion
+    line: int
+    chain: tuple = ()  # (macro, file, line of use) frames, outermost first
+    file: str = None  # None for the main file
+
+
+class Label(NamedTuple):
+    name: str
+    line: int
+    file: str = None
+
+
+class Parser:
+    """Turns token lines into an instruction IR.
 
-        if not line:
+    The first pass collects constants, register aliases and macros. Macro
+    uses are then expanded at the token level, memoized per (macro, args),
+    and the result is parsed into Instr and Label records.
+    """
+
+    def __init__(self):
+        self.constants = {}
+        self.aliases = {}  # define NAME <register>
+        self.macros = {}  # NAME -> (params, body token lines)
+        self.memo = {}
+
+    def parse(self, token_lines):
+        body = self.collect(token_lines)
+        ir = []
+        for tokens in body:
+            for line, chain in self.expand(tokens, 0):
+                item = self.parse_line(line, chain)
+                if item is not None:
+                    ir.append(item)
+        return ir
+
+    def collect(self, token_lines):
+        body = []
+        i = 0
+        n = len(token_lines)
+        while i < n:
+            tokens = token_lines[i]
             i += 1
-            continue
-        expanded.append(line)
-        pc += 1
-        i += 1
-
-    # Macro expansion (recursive, with args)
-    def expand_macros(lines, parent_args=None):
-        result = []
-        for line in lines:
-            tokens = re.split(r"[,\s]+", line.strip())
-            if not tokens or not tokens[0]:
+            if tokens[0].text != "define":
+                body.append(tokens)
                 continue
-            mnemonic = tokens[0].upper()
-            if mnemonic in macros:
-                macro_args, macro_body = macros[mnemonic]
-                # Parse actual arguments from invocation
-                # e.g. MACRO x, y, z
-                actual_args = tokens[1 : 1 + len(macro_args)]
-                arg_map = dict(zip(macro_args, actual_args))
-
-                # Support parent macro argument substitution
-                def subst_args(l: str):
-                    # Replace $arg or {arg} with value
-                    for k, v in arg_map.items():
-                        l = l.replace(f"{k}", v)
-                    if parent_args:
-                        for k, v in parent_args.items():
-                            l = l.replace(f"{k}", v)
-
-                    return l
-
-                expanded_body = [subst_args(l) for l in macro_body]
-                result.extend(expand_macros(expanded_body, arg_map))
-            else:
-                # Substitute parent macro arguments if any
-                if parent_args:
-                    for k, v in parent_args.items():
-                        line = line.replace(f"{k}", v)
-                result.append(line)
-        return result
-
-    expanded = expand_macros(expanded)
-    # Second pass: assemble instructions
-    pc = 0
-    output = []
-    unresolved = []
-    for line in expanded:
-        # Remove inline labels (should not be present after first pass, but just in case)
-        while True:
-            m = re.match(r"^(\w+):\s*(.*)", line)
-            if m:
-                line = m.group(2)
+            if len(tokens) < 2 or tokens[1].kind != "name":
+                fail(tokens[0], "Invalid define")
+            name = tokens[1].text
+            rest = tokens[2:]
+            params = []
+            if rest and rest[0].text == "(":
+                close = next((k for k, t in enumerate(rest) if t.text == ")"), None)
+                if close is None:
+                    fail(rest[0], f"Unclosed parameter list for {name}")
+                params = [t.text for t in rest[1:close] if t.text != ","]
+                rest = rest[close + 1 :]
+            if rest and rest[0].text == ":":
+                # Macro: the body runs until 'end', the next define or EOF.
+                lines = []
+                while i < n and token_lines[i][0].text not in ("end", "define"):
+                    lines.append(token_lines[i])
+                    i += 1
+                if i < n and token_lines[i][0].text == "end":
+                    i += 1
+                self.macros[name.upper()] = (params, lines)
+                continue
+            if len(rest) != 1:
+                fail(tokens[0], f"Invalid value for {name}")
+            value = rest[0].text
+            if value in REGISTERS or value in self.aliases:
+                self.aliases[name] = self.aliases.get(value, value)
             else:
-                break
-        if not line.strip():
-            continue
-        tokens = re.split(r"[,\s]+", line.strip())
-        if not tokens or not tokens[0]:
-            continue
-        mnemonic = tokens[0].upper()
+                self.constants[name] = parse_value(value, self.constants)
+        return body
+
+    def expand(self, tokens, depth):
+        # Returns (token line, macro chain) for each line one source line
+        # expands to. Memoized expansions hold chains relative to the macro,
+        # and each use prefixes its own frame.
+        head = tokens[0]
+        if head.kind != "name" or head.text.upper() not in self.macros:
+            return [(tokens, ())]
+        name = head.text.upper()
+        params, body = self.macros[name]
+        args = [t for t in tokens[1:] if t.text != ","][: len(params)]
+        key = (name, tuple(t.text for t in args))
+        if key not in self.memo:
+            if depth >= MAX_MACRO_DEPTH:
+                fail(head, f"Macro {name} nested more than {MAX_MACRO_DEPTH} deep")
+            mapping = {p: a for p, a in zip(params, args)}
+            splices = {"{" + p + "}": a.text for p, a in mapping.items()}
+            result = []
+            for line in body:
+                result.extend(self.expand([self.substitute(t, mapping, splices) for t in line], depth + 1))
+            self.memo[key] = result
+        frame = ((name, head.file, head.line),)
+        return [(line, frame + chain) for line, chain in self.memo[key]]
+
+    @staticmethod
+    def substitute(token, mapping, splices):
+        # Parameters are replaced as whole tokens; {param} splices the argument
+        # into a longer name, e.g. $loop_{n}.
+        if token.kind != "name":
+            return token
+        if token.text in mapping:
+            return mapping[token.text]
+        text = token.text
+        if "{" in text:
+            for k, v in splices.items():
+                text = text.replace(k, v)
+            return token._replace(text=text)
+        return token
+
+    def parse_line(self, tokens, chain=()):
+        # Inline "name:" prefixes are ignored.
+        while len(tokens) >= 2 and tokens[0].kind == "name" and tokens[1].text == ":":
+            tokens = tokens[2:]
+        if not tokens:
+            return None
+        head = tokens[0]
+        mnemonic = head.text.upper()
         if mnemonic == "LABEL":
-            # Handle label definition, e.g. "LABEL foo"
-            if len(tokens) != 2:
-                raise ValueError(f"Invalid LABEL definition: {line}")
-            label_name = tokens[1].strip().strip(":")
-            if label_name in labels:
-                raise ValueError(f"Label '{label_name}' already defined")
-            labels[label_name] = pc
-            constants[label_name] = pc  # Also treat label as constant
-            # pc += 1  # Increment PC for label definition
-            continue
-        args = tokens[1:]
-        # Fill missing args
+            if len(tokens) == 3 and tokens[2].text == ":":
+                tokens = tokens[:2]
+            if len(tokens) != 2 or tokens[1].kind != "name":
+                fail(head, "Invalid LABEL definition")
+            return Label(tokens[1].text, head.line, head.file)
+        args = []
+        for t in tokens[1:]:
+            if t.text == ",":
+                continue
+            if t.kind in ("punct", "error"):
+                fail(t, f"Unexpected {t.text!r}", chain)
+            args.append(self.aliases.get(t.text, t.text))
         args = handle_shorthand_op(mnemonic, args)
+        if len(args) < 3:
+            print(f"Not enough args for operator: {mnemonic} {args} ")
+            exit(1)
+        if mnemonic not in OPCODES:
+            fail(head, f"Unknown mnemonic: {mnemonic}", chain)
+        return Instr(mnemonic, args[:3], head.line, chain, head.file)
+
+
+# --- Peephole optimizer ---
+# Operand slots (0 = OP1, 1 = OP2, 2 = DEST) each instruction reads as
+# registers; anything not listed reads OP1 and OP2. WRT and RFT take OP2 as a
+# literal format.
+READS = {
+    "NOT": (0,),
+    "JMP": (),
+    "NOP": (),
+    "MOV": (0,),
+    "SWAP": (0, 2),
+    "PUSH": (0,),
+    "POP": (),
+    "WRT": (0,),
+    "CALL": (0,),
+    "RFT": (),
+    "HCF": (),
+}
+
+BRANCHES = {
+    "JNE": lambda a, b: a != b,
+    "JGE": lambda a, b: a >= b,
+    "JGT": lambda a, b: a > b,
+    "JEQ": lambda a, b: a == b,
+    "JLT": lambda a, b: a < b,
+    "JLE": lambda a, b: a <= b,
+}
+
+# Flipping the top subtype bit negates a condition.
+NEGATE = {"JNE": "JEQ", "JEQ": "JNE", "JGE": "JLT", "JLT": "JGE", "JGT": "JLE", "JLE": "JGT"}
+
+
+def identity(mnemonic, value):
+    # Whether "OP <reg>, value" leaves the register unchanged.
+    if mnemonic in ("ADD", "SUB", "OR", "XOR"):
+        return value == 0
+    if mnemonic in ("ROR", "ROL"):
+        return value % 8 == 0
+    return mnemonic == "AND" and value == 0xFF
+
 
-        # Macro expansion handled above
-        # Label resolution in args (support labels as operands)
-        for i, arg in enumerate(args):
-            if arg in labels:
-                args[i] = str(labels[arg])
-            elif re.match(r"^\$[A-Za-z_]\w*$", arg):  # Looks like a label
-                # Mark for patching later
-                unresolved.append((len(output), i, arg))
-                args[i] = "0"  # Temporary placeholder
+class Peephole:
+    """Removes wasted instructions from the IR between parsing and encoding.
 
+    Jumps are threaded through unconditional JMPs, branches with a known
+    outcome are folded, and no-op moves and arithmetic, values the next
+    instruction overwrites and unreachable code are dropped, repeating until
+    nothing changes. Labels stay in the IR, so assemble() renumbers them.
+
+    Dropping instructions assumes code addresses only come from labels and
+    CALL. If the program reads r7, writes it other than by a jump or POP,
+    jumps to a number or to a label it doesn't define, uses a label as
+    data, or may POP r7 a value other than a return address (see
+    stack_flow()), only the rewrites that keep every address are made. With public,
+    every label counts as reachable, as another module may jump to it.
+    """
+
+    def __init__(self, constants, public=False):
+        self.constants = constants
+        self.public = public
+        self.labels = set()
+        self.falls = set()  # POP r7s run on an empty stack, which fall through
+
+    def optimize(self, ir):
+        self.labels = {item.name for item in ir if isinstance(item, Label)}
+        relocatable = self.relocatable(ir)
+        while True:
+            instrs, before = [], [[]]  # before[i]: labels on instruction i
+            for item in ir:
+                if isinstance(item, Label):
+                    before[-1].append(item)
+                else:
+                    instrs.append(item)
+                    before.append([])
+            self.instrs = instrs
+            self.index = {label.name: i for i, labels in enumerate(before) for label in labels}
+            changed = self.thread()
+            changed |= self.fold()
+            if relocatable:
+                self.falls = self.stack_flow()
+                relocatable = self.falls is not None
+            if relocatable:
+                changed |= self.drop_noops()
+                changed |= self.drop_dead_stores()
+                changed |= self.invert_branches(before)
+                changed |= self.drop_unreachable()
+            ir = []
+            for labels, instr in zip(before, instrs + [None]):
+                ir.extend(labels)
+                if instr is not None:
+                    ir.append(instr)
+            if not changed:
+                return ir
+
+    # Operand helpers
+    def value(self, arg):
+        # ("reg", n), ("label", name), ("imm", n) or ("?", arg) if unresolved.
+        if arg in REGISTERS:
+            return "reg", REGISTERS[arg]
+        if arg in self.labels:
+            return "label", arg
         try:
-            op1, op2, dest = args[:3]
+            return "imm", parse_value(arg, self.constants) & 0xFF
         except ValueError:
-            print(f"Not enough args for operator: {mnemonic} {args} ")
-            exit(1)
-        if mnemonic not in OPCODES:
-            raise ValueError(f"Unknown mnemonic: {mnemonic}")
-        opcode = encode_opcode(mnemonic, op1, op2)
-        b1 = opcode
+            return "?", arg
+
+    def dest(self, instr):
+        # The register an instruction's DEST field names, if known.
+        kind, v = self.value(instr.args[2])
+        return v & 0x7 if kind in ("reg", "imm") else None
+
+    def reads(self, instr):
+        regs = set()
+        for slot in READS.get(instr.mnemonic, (0, 1)):
+            kind, v = self.value(instr.args[slot])
+            if kind == "reg":
+                regs.add(v)
+        if 5 in regs or (self.writes(instr) and self.dest(instr) == 5):
+            regs.add(4)  # r5 goes through the RAM address in r4
+        return regs
+
+    def writes(self, instr):
+        # Whether the instruction always sets its DEST register.
+        return OPCODES[instr.mnemonic][0] == "ALU" or instr.mnemonic in ("MOV", "RFT")
+
+    def target(self, instr):
+        # Label a jump or CALL goes to, or None.
+        arg = instr.args[0] if instr.mnemonic == "CALL" else instr.args[2]
+        return arg if arg in self.index else None
+
+    def relocatable(self, ir):
+        for item in ir:
+            if isinstance(item, Label):
+                continue
+            m = item.mnemonic
+            if 7 in self.reads(item):
+                return False
+            if self.writes(item) and self.dest(item) in (7, None):
+                return False
+            for slot, arg in enumerate(item.args):
+                # Labels are allowed exactly where the ISA takes a code address.
+                jump = (OPCODES[m][0] == "COND" and m != "NOP" and slot == 2) or (m == "CALL" and slot == 0)
+                if jump != (arg in self.labels):
+                    return False
+        return True
+
+    def follow(self, i):
+        # The first live instruction at or after i.
+        instrs = self.instrs
+        while i < len(instrs) and instrs[i] is None:
+            i += 1
+        return i
+
+    def stack_flow(self):
+        # Follows the stack depth along every path, from the entry and from
+        # each CALL target, as subroutines start with their return address
+        # on top. Returns the POP r7s that run at top level on an empty
+        # stack, or None if some POP r7 may pop a value no CALL pushed, or
+        # an instruction is reached at two depths or from two subroutines.
+        instrs = self.instrs
+        depths = {}  # i -> (subroutine entry, or None at top level; depth)
+        falls = set()
+        todo = [(self.follow(0), None, 0)]
+        labels = list(self.index.values()) if self.public else []
+        while todo or labels:
+            if not todo:
+                i = self.follow(labels.pop())
+                if i not in depths:
+                    todo.append((i, i, 0))
+                continue
+            i, sub, depth = todo.pop()
+            if i >= len(instrs):
+                continue
+            if i in depths:
+                if depths[i] != (sub, depth):
+                    return None
+                continue
+            depths[i] = (sub, depth)
+            instr = instrs[i]
+            m = instr.mnemonic
+            nxt = [] if m in ("HCF", "JMP") else [i + 1]
+            if m == "PUSH":
+                depth += 1
+            elif m == "POP" and self.dest(instr) == 7:
+                if depth:
+                    return None
+                if sub is not None:
+                    nxt = []  # a return
+                else:
+                    falls.add(i)
+            elif m == "POP" and depth:
+                depth -= 1
+            elif m == "POP" and sub is not None:
+                return None  # pops the return address
+            if m in BRANCHES or m in ("JMP", "CALL"):
+                target = self.follow(self.index[self.target(instr)])
+                if m == "CALL":
+                    todo.append((target, target, 0))
+                else:
+                    nxt.append(target)
+            todo.extend((self.follow(k), sub, depth) for k in nxt)
+        return falls
+
+    # Passes. Each returns whether it changed anything.
+    def thread(self):
+        changed = False
+        instrs = self.instrs
+        for i, instr in enumerate(instrs):
+            if instr is None or not (instr.mnemonic in BRANCHES or instr.mnemonic in ("JMP", "CALL")):
+                continue
+            label = self.target(instr)
+            if label is None:
+                continue
+            seen = {label}
+            while True:
+                j = self.follow(self.index[label])
+                nxt = instrs[j] if j < len(instrs) else None
+                if nxt is None or nxt.mnemonic != "JMP" or self.target(nxt) in seen or self.target(nxt) is None:
+                    break
+                label = self.target(nxt)
+                seen.add(label)
+            if instr.mnemonic == "JMP" and nxt is not None and nxt.mnemonic == "HCF":
+                instrs[i] = nxt._replace(line=instr.line, chain=instr.chain, file=instr.file)
+                changed = True
+            elif label != self.target(instr):
+                args = [label, *instr.args[1:]] if instr.mnemonic == "CALL" else [*instr.args[:2], label]
+                instrs[i] = instr._replace(args=args)
+                changed = True
+        return changed
+
+    def fold(self):
+        # Branches on two immediates, or a register against itself.
+        changed = False
+        for i, instr in enumerate(self.instrs):
+            if instr is None or instr.mnemonic not in BRANCHES:
+                continue
+            (ka, a), (kb, b) = self.value(instr.args[0]), self.value(instr.args[1])
+            if not (ka == kb == "imm" or (ka == kb == "reg" and a == b)):
+                continue
+            if BRANCHES[instr.mnemonic](a, b):
+                self.instrs[i] = instr._replace(mnemonic="JMP", args=["0", "0", instr.args[2]])
+            else:
+                self.instrs[i] = instr._replace(mnemonic="NOP", args=["0", "0", "0"])
+            changed = True
+        return changed
+
+    def drop_noops(self):
+        changed = False
+        instrs = self.instrs
+        for i, instr in enumerate(instrs):
+            if instr is None:
+                continue
+            m = instr.mnemonic
+            (ka, a), (kb, b) = self.value(instr.args[0]), self.value(instr.args[1])
+            d = self.dest(instr)
+            if m == "NOP":
+                noop = True
+            elif OPCODES[m][0] == "COND":
+                noop = self.follow(self.index[instr.args[2]]) == self.follow(i + 1)
+            elif m in ("MOV", "SWAP"):
+                noop = ka == "reg" and a == d
+            elif m == "NOT":
+                noop = False
+            elif OPCODES[m][0] == "ALU":
+                same_a = ka == "reg" and a == d
+                noop = (
+                    (same_a and kb == "imm" and identity(m, b))
+                    or (m in ("ADD", "OR", "XOR", "AND") and ka == "imm" and kb == "reg" and b == d and identity(m, a))
+                    or (m in ("AND", "OR") and same_a and kb == "reg" and b == d)
+                )
+            else:
+                noop = False
+            if noop:
+                instrs[i] = None
+                changed = True
+        return changed
+
+    def drop_dead_stores(self):
+        # A register write the very next instruction overwrites unread.
+        changed = False
+        instrs = self.instrs
+        for i, instr in enumerate(instrs):
+            if instr is None or not (OPCODES[instr.mnemonic][0] == "ALU" or instr.mnemonic == "MOV"):
+                continue
+            j = self.follow(i + 1)
+            if j == len(instrs):
+                continue
+            nxt = instrs[j]
+            d = self.dest(instr)
+            if self.writes(nxt) and self.dest(nxt) == d and d not in self.reads(nxt):
+                instrs[i] = None
+                changed = True
+        return changed
+
+    def invert_branches(self, before):
+        # "Jcc $skip; JMP $far; label $skip" becomes "J!cc $far".
+        changed = False
+        instrs = self.instrs
+        for i, instr in enumerate(instrs):
+            if instr is None or instr.mnemonic not in NEGATE or self.target(instr) is None:
+                continue
+            j = self.follow(i + 1)
+            if j == len(instrs) or instrs[j].mnemonic != "JMP" or self.target(instrs[j]) is None:
+                continue
+            if any(before[k] for k in range(i + 1, j + 1)):
+                continue  # the JMP is also a jump target
+            if self.follow(self.index[instr.args[2]]) != self.follow(j + 1):
+                continue
+            instrs[i] = instr._replace(mnemonic=NEGATE[instr.mnemonic], args=[*instr.args[:2], instrs[j].args[2]])
+            instrs[j] = None
+            changed = True
+        return changed
+
+    def drop_unreachable(self):
+        instrs = self.instrs
+        seen = set()
+        todo = [self.follow(0)]
+        if self.public:
+            todo.extend(self.follow(i) for i in self.index.values())
+        while todo:
+            i = todo.pop()
+            if i >= len(instrs) or i in seen:
+                continue
+            seen.add(i)
+            instr = instrs[i]
+            m = instr.mnemonic
+            ret = m == "POP" and self.dest(instr) == 7 and i not in self.falls
+            nxt = [] if m in ("HCF", "JMP") or ret else [i + 1]
+            if m in BRANCHES or m in ("JMP", "CALL"):
+                nxt.append(self.index[self.target(instr)])
+            todo.extend(self.follow(k) for k in nxt)
+        changed = False
+        for i, instr in enumerate(instrs):
+            if instr is not None and i not in seen:
+                instrs[i] = None
+                changed = True
+        return changed
+
+
+# --- Assembler core ---
+def parse(lines, path=None, optimize=False, public=False):
+    # Returns (constants, IR) for one source file; path locates includes.
+    # optimize runs the Peephole pass, see there for public.
+    parser = Parser()
+    ir = parser.parse(tokenize(lines, path))
+    if optimize:
+        count = sum(isinstance(item, Instr) for item in ir)
+        ir = Peephole(parser.constants, public).optimize(ir)
+        print(f"Optimizer removed {count - sum(isinstance(item, Instr) for item in ir)} instructions")
+    return parser.constants, ir
+
+
+def place_labels(ir):
+    # Labels resolve to the index of the next instruction.
+    labels = {}
+    pc = 0
+    for item in ir:
+        if isinstance(item, Label):
+            if item.name in labels:
+                raise ValueError(f"Label '{item.name}' already defined ({where(item.file, item.line)})")
+            labels[item.name] = pc
+        else:
+            pc += 1
+    return labels
+
+
+def encode(item, constants):
+    op1, op2, dest = item.args
+    for arg in item.args:
+        if arg not in constants and LABEL_RE.match(arg):
+            raise ValueError(f"Undefined label: {arg} ({where(item.file, item.line)})")
+    try:
+        opcode = encode_opcode(item.mnemonic, op1, op2)
         b2 = encode_operand(op1, constants)
         b3 = encode_operand(op2, constants)
         b4 = encode_operand(dest, constants)
-        output.append(bytearray([b1, b2, b3, b4]))
-        pc += 1
-    for instr_idx, arg_idx, label in unresolved:
-        if label not in labels:
-            raise ValueError(f"Undefined label: {label}")
-        val = labels[label] & 0xFF
-        # arg_idx: 0=op1, 1=op2, 2=dest
-        output[instr_idx][arg_idx + 1] = val  # +1 because b1 is opcode
+    except ValueError as e:
+        raise ValueError(f"{e} ({where(item.file, item.line)})") from None
+    return bytearray([opcode, b2, b3, b4])
+
+
+def assemble(lines, source_map=None, optimize=False, path=None):
+    # source_map, if given, is a sourcemap.SourceMap to fill in. optimize runs
+    # the Peephole pass over the IR before labels are resolved. path is the
+    # file the lines came from, which includes are relative to.
+    constants, ir = parse(lines, path, optimize)
+    labels = place_labels(ir)
+    if source_map is not None:
+        for name, pc in labels.items():
+            source_map.add_label(name, pc)
+    constants = {**constants, **labels}
 
+    output = []
+    for item in ir:
+        if isinstance(item, Label):
+            continue
+        output.append(encode(item, constants))
+        if source_map is not None:
+            source_map.add(item.line, item.chain, item.file)
+
+    pc = len(output)
     assert pc < 256, "Program is too long, must be under 256 bytes long"
     print(f"Program is {pc}/256 ({hex(pc).upper()}/0xFF) instructions long")
     return output
@@ -293,16 +769,50 @@ def assemble(lines):
 def main():
     import argparse
 
+    import linker
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", help="Input assembly file")
-    parser.add_argument("-o", "--output", help="Output binary file", default="out.mi8")
+    parser.add_argument("inputs", nargs="+", metavar="input", help="Assembly (.m8a) or object (.m8o) files, linked in order")
+    parser.add_argument("-o", "--output", help="Output binary file", default=None)
+    parser.add_argument("-O", "--optimize", action="store_true", help="Run the peephole optimizer")
+    parser.add_argument("-m", "--map", action="store_true", help="Also write a source map to OUTPUT.map")
+    parser.add_argument("-c", "--compile", action="store_true", help="Only assemble each input to an object file")
+    parser.add_argument("--no-cache", action="store_true", help="Reassemble every input instead of using the object cache")
+    parser.add_argument("--container", action="store_true", help="Write a container with a symbol table and checksum, see container.py")
     args = parser.parse_args()
-    with open(args.input) as f:
-        lines = f.readlines()
-    binprog = assemble(lines)
-    with open(args.output, "wb") as f:
-        for instr in binprog:
-            f.write(instr)
+
+    # A program assembled on its own has nothing else jumping into it, so the
+    # optimizer can treat it as a whole.
+    public = args.compile or len(args.inputs) > 1
+    objects = []
+    for path in args.inputs:
+        if path.endswith(".m8o"):
+            objects.append(linker.ObjectFile.load(path))
+        else:
+            objects.append(linker.build(path, args.optimize, not args.no_cache, public))
+    if args.compile:
+        if args.output and len(objects) > 1:
+            parser.error("-o with -c takes a single input")
+        for path, obj in zip(args.inputs, objects):
+            obj.save(args.output or os.path.splitext(os.path.basename(path))[0] + ".m8o")
+        return
+    output = args.output or "out.mi8"
+    source_map = None
+    if args.map or args.container:
+        from sourcemap import SourceMap
+
+        source_map = SourceMap(file=args.inputs[0])
+    binprog = linker.link(objects, source_map)
+    if args.container:
+        import container
+
+        container.save(output, b"".join(binprog), source_map.labels)
+    else:
+        with open(output, "wb") as f:
+            for instr in binprog:
+                f.write(instr)
+    if args.map:
+        source_map.save(output + ".map", b"".join(binprog))
 
 
 if __name__ == "__main__":
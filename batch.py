@@ -0,0 +1,125 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import container
+from terminal import BytesSource, MemorySink
+from vm import ENGINES, MiniMachineVM
+
+DEFAULT_MAX_STEPS = 10_000_000
+
+
+# Per-worker cache of loaded programs, keyed by path.
+_programs = {}
+
+
+def load_program(path):
+    # Returns (container.Image, load time). Assembly sources are assembled on
+    # load; each distinct path is only loaded once per worker.
+    if path in _programs:
+        return _programs[path], 0.0
+    start = time.perf_counter()
+    if path.endswith(".m8a"):
+        from assembler import assemble
+
+        with open(path) as f:
+            lines = f.readlines()
+        with contextlib.redirect_stdout(io.StringIO()):
+            image = container.Image(b"".join(assemble(lines, path=path)))
+    else:
+        image = container.load(path)
+    _programs[path] = image
+    return image, time.perf_counter() - start
+
+
+def read_field(job, name, base):
+    # A job gives inline text as `name` or a file as `name`_file.
+    if f"{name}_file" in job:
+        with open(os.path.join(base, job[f"{name}_file"]), "rb") as f:
+            return f.read()
+    if name in job:
+        return job[name].encode()
+    return None
+
+
+def run_job(args):
+    index, job, base, engine, default_steps, default_timeout, detect_loops = args
+    result = {"index": index, "id": job.get("id", index), "program": job["program"]}
+    try:
+        image, load_time = load_program(os.path.join(base, job["program"]))
+        stdin = read_field(job, "stdin", base) or b""
+        expected = read_field(job, "expected", base)
+        start = time.perf_counter()
+        vm = MiniMachineVM(
+            image.program, engine=engine, output=MemorySink(), input_source=BytesSource(stdin), leaders=image.leaders
+        )
+        decoded = time.perf_counter()
+        vm.run(
+            job.get("max_steps", default_steps),
+            timeout=job.get("timeout", default_timeout),
+            detect_loops=detect_loops,
+        )
+        done = time.perf_counter()
+    except (Exception, SystemExit) as e:  # the assembler exits on some errors
+        result.update(exit_reason="error", error=f"{type(e).__name__}: {e}", passed=False)
+        return result
+    result.update(
+        exit_reason=vm.exit_reason,
+        steps=vm.steps,
+        output=vm.output.data.decode(errors="backslashreplace"),
+        passed=None if expected is None else vm.output.data == expected,
+        load_time=load_time,
+        decode_time=decoded - start,
+        run_time=done - decoded,
+    )
+    if vm.loop is not None:
+        result["loop"] = list(vm.loop)
+    return result
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run many Mini-8 jobs headlessly across a process pool")
+    parser.add_argument("manifest", help="JSON lines file, one job per line")
+    parser.add_argument("-o", "--output", help="JSON lines results file (default: stdout)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--engine", choices=ENGINES, default="table")
+    parser.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS, help="Step budget for jobs without one")
+    parser.add_argument("--timeout", type=float, help="Time limit in seconds for jobs without one")
+    parser.add_argument("--detect-loops", action="store_true", help="Stop jobs that provably loop forever")
+    args = parser.parse_args()
+
+    base = os.path.dirname(os.path.abspath(args.manifest))
+    jobs = read_manifest(args.manifest)
+    # Group jobs by program so each worker chunk mostly reuses one loaded program.
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i]["program"])
+    work = [(i, jobs[i], base, args.engine, args.max_steps, args.timeout, args.detect_loops) for i in order]
+    chunksize = max(1, len(work) // (4 * max(1, args.jobs)))
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    failed = 0
+    try:
+        with Pool(args.jobs) as pool:
+            for result in pool.imap_unordered(run_job, work, chunksize):
+                if result["passed"] is False:
+                    failed += 1
+                out.write(json.dumps(result) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"{len(jobs) - failed}/{len(jobs)} jobs passed", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import numpy as np
+
+from vm import uses_ram
+
+# RFT conversion per format, indexed [fmt, byte]. 0xFF marks out-of-range input.
+RFT_TABLE = np.full((4, 256), 0xFF, dtype=np.uint8)
+RFT_TABLE[0] = np.arange(256)
+for _c in b"0123456789":
+    RFT_TABLE[1, _c] = _c - ord("0")
+for _i in range(26):
+    RFT_TABLE[2, ord("A") + _i] = _i
+    RFT_TABLE[2, ord("a") + _i] = _i
+for _c in b"0123456789ABCDEFabcdef":
+    RFT_TABLE[3, _c] = int(chr(_c), 16)
+
+# WRT output per format, indexed [fmt, value]. Every entry is a single byte,
+# except UTF-8 0x00, which clears the terminal and is handled separately.
+WRT_TABLE = np.full((4, 256), ord("?"), dtype=np.uint8)
+WRT_TABLE[0] = np.arange(256)
+WRT_TABLE[1, :10] = np.frombuffer(b"0123456789", dtype=np.uint8)
+WRT_TABLE[2, :26] = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", dtype=np.uint8)
+WRT_TABLE[3, :16] = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+CLEAR = b"\033c"
+
+# Jump conditions indexed by COND subtype. None marks JMP (always) and NOP (never).
+COND_UFUNCS = (None, np.not_equal, np.greater_equal, np.greater, None, np.equal, np.less, np.less_equal)
+
+
+class BatchVM:
+    """Runs N copies of one program in lockstep, holding machine state as arrays.
+
+    Registers are (N, 8), RAM is (N, 256) and each machine has a fixed-depth
+    stack with its own stack pointer. As in MiniMachineVM, r5 is the RAM byte
+    r4 points at and its column in reg stays 0. Every step executes one instruction on
+    every running machine, with one vectorized pass per opcode present. WRT
+    output is collected per machine rather than written to stdout, and RFT
+    reads from per-machine input buffers, returning 0xFE once one is empty.
+    """
+
+    def __init__(self, program: bytes, n: int, stack_depth: int = 256, inputs=None):
+        self.program = bytes(program)
+        self.n = n
+        self.size = min(len(self.program) // 4, 256)
+        code = np.zeros((256, 4), dtype=np.int32)
+        code[: self.size] = np.frombuffer(self.program[: self.size * 4], dtype=np.uint8).reshape(-1, 4)
+        opcode = code[:, 0]
+        self.op = ((opcode >> 3) & 0x3) << 3 | (opcode & 0x7)
+        self.imm1 = ((opcode >> 6) & 1).astype(bool)
+        self.imm2 = ((opcode >> 5) & 1).astype(bool)
+        self.op1 = code[:, 1]
+        self.op2 = code[:, 2]
+        self.dest = code[:, 3]
+        self.uses_ram = np.array([uses_ram(bytes(instr)) for instr in code.astype(np.uint8)])
+
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.stack = np.zeros((n, stack_depth), dtype=np.uint8)
+        self.sp = np.zeros(n, dtype=np.intp)
+        self.halted = np.zeros(n, dtype=bool)
+        self.overflow = np.zeros(n, dtype=bool)
+        self.steps = np.zeros(n, dtype=np.int64)
+
+        self.out = np.zeros((n, 64), dtype=np.uint8)
+        self.out_len = np.zeros(n, dtype=np.intp)
+        self.set_inputs(inputs or [b""] * n)
+
+    def set_inputs(self, inputs):
+        if len(inputs) != self.n:
+            raise ValueError(f"Expected {self.n} input streams, got {len(inputs)}")
+        width = max((len(s) for s in inputs), default=0)
+        self.inp = np.zeros((self.n, max(width, 1)), dtype=np.uint8)
+        for i, s in enumerate(inputs):
+            self.inp[i, : len(s)] = np.frombuffer(bytes(s), dtype=np.uint8)
+        self.inp_len = np.array([len(s) for s in inputs], dtype=np.intp)
+        self.inp_pos = np.zeros(self.n, dtype=np.intp)
+
+    def output(self, i):
+        return self.out[i, : self.out_len[i]].tobytes()
+
+    @property
+    def outputs(self):
+        return [self.output(i) for i in range(self.n)]
+
+    def emit(self, rows, data):
+        # Append one byte per row in rows, growing the output buffer as needed.
+        need = int(self.out_len[rows].max()) + 1
+        if need > self.out.shape[1]:
+            grown = np.zeros((self.n, max(need, self.out.shape[1] * 2)), dtype=np.uint8)
+            grown[:, : self.out.shape[1]] = self.out
+            self.out = grown
+        self.out[rows, self.out_len[rows]] = data
+        self.out_len[rows] += 1
+
+    def run(self, max_steps=None):
+        # Step until every machine has halted, or for at most max_steps steps.
+        # Returns the number of steps taken.
+        taken = 0
+        while max_steps is None or taken < max_steps:
+            if not self.step():
+                break
+            taken += 1
+        return taken
+
+    def step(self):
+        # Execute one instruction on every running machine. Returns the number
+        # of machines that executed an instruction.
+        act = np.flatnonzero(~self.halted)
+        if act.size == 0:
+            return 0
+        reg = self.reg
+        p = reg[act, 7].astype(np.intp)
+        off = p >= self.size
+        if off.any():
+            self.halted[act[off]] = True
+            act, p = act[~off], p[~off]
+            if act.size == 0:
+                return 0
+        rows = slice(None) if act.size == self.n else act
+        self.steps[rows] += 1
+        pc = p[0]
+        if self.op[pc] < 0b10001 and (p == pc).all():
+            self.step_uniform(rows, pc)
+            return act.size
+
+        op = self.op[p]
+        op1 = self.op1[p]
+        op2 = self.op2[p]
+        dest = self.dest[p]
+        d = dest & 0x7
+        src1 = reg[act, op1 & 0x7]
+        src2 = reg[act, op2 & 0x7]
+        if self.uses_ram[p].any():
+            cells = self.ram[act, reg[act, 4]]
+            src1 = np.where(op1 & 0x7 == 5, cells, src1)
+            src2 = np.where(op2 & 0x7 == 5, cells, src2)
+        a = np.where(self.imm1[p], op1, src1).astype(np.int32)
+        b = np.where(self.imm2[p], op2, src2).astype(np.int32)
+        nxt = (p + 1) & 0xFF
+        val = np.zeros(act.size, dtype=np.int32)
+        write = np.zeros(act.size, dtype=bool)
+
+        if (p == p[0]).all():
+            # Machines in lockstep: a single pass over every row.
+            groups = [(op[0], np.arange(act.size))]
+        else:
+            groups = [(k, np.flatnonzero(op == k)) for k in np.unique(op)]
+        for k, idx in groups:
+            if k < 8:  # ALU
+                x, y = a[idx], b[idx]
+                if k == 0b000:
+                    r = x & y
+                elif k == 0b001:
+                    s = y % 8
+                    r = (x >> s) | (x << (8 - s))
+                elif k == 0b010:
+                    r = x + y
+                elif k == 0b011:
+                    r = x ^ y
+                elif k == 0b100:
+                    r = x | y
+                elif k == 0b101:
+                    s = y % 8
+                    r = (x << s) | (x >> (8 - s))
+                elif k == 0b110:
+                    r = x - y
+                else:
+                    r = ~x
+                val[idx] = r & 0xFF
+                write[idx] = True
+            elif k < 16:  # COND
+                sub = k & 0x7
+                if sub == 0b100:  # NOP
+                    continue
+                if sub != 0b000:
+                    idx = idx[COND_UFUNCS[sub](a[idx], b[idx])]
+                nxt[idx] = dest[idx]
+            elif k == 0b10000:  # MOV
+                val[idx] = a[idx]
+                write[idx] = True
+            elif k == 0b10001:  # SWAP
+                i1 = op1[idx] & 0x7
+                i2 = d[idx]
+                ok = (i1 != 6) & (i2 != 6)
+                idx, i1, i2 = idx[ok], i1[ok], i2[ok]
+                rows = act[idx]
+                addr = reg[rows, 4].astype(np.intp)  # before a swap with r4 moves it
+                m1, m2 = i1 == 5, i2 == 5
+                v1 = np.where(m1, self.ram[rows, addr], reg[rows, i1])
+                v2 = np.where(m2, self.ram[rows, addr], reg[rows, i2])
+                reg[rows[~m1], i1[~m1]] = v2[~m1]
+                self.ram[rows[m1], addr[m1]] = v2[m1]
+                reg[rows[~m2], i2[~m2]] = v1[~m2]
+                self.ram[rows[m2], addr[m2]] = v1[m2]
+                nxt[idx] = (reg[rows, 7].astype(np.intp) + 1) & 0xFF
+            elif k == 0b10010:  # PUSH
+                full = self.push(idx, act, a)
+                nxt[full] = p[full]
+            elif k == 0b10011:  # POP
+                rows = act[idx]
+                has = self.sp[rows] > 0
+                idx, rows = idx[has], rows[has]
+                self.sp[rows] -= 1
+                val[idx] = self.stack[rows, self.sp[rows]]
+                write[idx] = True
+            elif k == 0b10100:  # WRT
+                fmt = op2[idx] & 0x3
+                v = a[idx]
+                clear = (fmt == 0) & (v == 0)
+                if clear.any():
+                    rows = act[idx[clear]]
+                    for byte in CLEAR:
+                        self.emit(rows, byte)
+                rest = ~clear
+                if rest.any():
+                    self.emit(act[idx[rest]], WRT_TABLE[fmt[rest], v[rest]])
+            elif k == 0b10101:  # CALL
+                full = self.push(idx, act, p)
+                nxt[idx] = a[idx]
+                nxt[full] = p[full]
+            elif k == 0b10110:  # RFT
+                rows = act[idx]
+                has = self.inp_pos[rows] < self.inp_len[rows]
+                ch = self.inp[rows, np.minimum(self.inp_pos[rows], self.inp.shape[1] - 1)]
+                val[idx] = np.where(has, RFT_TABLE[op2[idx] & 0x3, ch], 0xFE)
+                write[idx] = True
+                self.inp_pos[rows] += has
+            elif k == 0b10111:  # HCF
+                self.halted[act[idx]] = True
+                nxt[idx] = p[idx]
+            else:  # Reserved opclass: neither executes nor advances
+                nxt[idx] = p[idx]
+
+        w = write & (d != 6)
+        to_pc = w & (d == 7)
+        w &= d != 7
+        to_ram = w & (d == 5)
+        if to_ram.any():
+            rows = act[to_ram]
+            self.ram[rows, reg[rows, 4]] = val[to_ram]
+            w &= ~to_ram
+        reg[act[w], d[w]] = val[w]
+        nxt[to_pc] = (val[to_pc] + 1) & 0xFF
+        reg[act, 7] = nxt
+        return act.size
+
+    def step_uniform(self, rows, pc):
+        # Fast path for ALU, COND and MOV when every running machine is at the
+        # same PC: operands decode once and registers are touched column-wise.
+        reg = self.reg
+        k = int(self.op[pc])
+        op1, op2, dest = int(self.op1[pc]), int(self.op2[pc]), int(self.dest[pc])
+        d = dest & 0x7
+        a = op1 if self.imm1[pc] else self.read(rows, op1 & 0x7)
+        b = op2 if self.imm2[pc] else self.read(rows, op2 & 0x7)
+        nxt = (pc + 1) & 0xFF
+        val = None
+        if k < 8:  # ALU
+            if k == 0b000:
+                val = a & b
+            elif k == 0b001:
+                s = b % 8
+                val = ((a >> s) | (a << (8 - s))) & 0xFF
+            elif k == 0b010:
+                val = (a + b) & 0xFF
+            elif k == 0b011:
+                val = a ^ b
+            elif k == 0b100:
+                val = a | b
+            elif k == 0b101:
+                s = b % 8
+                val = ((a << s) | (a >> (8 - s))) & 0xFF
+            elif k == 0b110:
+                val = (a - b) & 0xFF
+            else:
+                val = ~a & 0xFF
+        elif k < 16:  # COND
+            sub = k & 0x7
+            if sub == 0b000:
+                nxt = dest
+            elif sub != 0b100:
+                nxt = np.where(COND_UFUNCS[sub](a, b), dest, nxt)
+        else:  # MOV
+            val = a
+        if val is not None and d != 6:
+            if d == 7:
+                nxt = (val + 1) & 0xFF
+            elif d == 5:
+                self.ram[self.cells(rows)] = val
+            else:
+                reg[rows, d] = val
+        reg[rows, 7] = nxt
+
+    def cells(self, rows):
+        # Index arrays for the RAM byte r4 points at, on each machine in rows.
+        rows = np.arange(self.n) if isinstance(rows, slice) else rows
+        return rows, self.reg[rows, 4]
+
+    def read(self, rows, r):
+        # Register r of each machine in rows, widened for arithmetic.
+        values = self.ram[self.cells(rows)] if r == 5 else self.reg[rows, r]
+        return values.astype(np.int32)
+
+    def push(self, idx, act, values):
+        # Push values[idx] onto the stacks of machines act[idx]. Overflowing the
+        # fixed-depth stack halts that machine; returns the indices that did.
+        rows = act[idx]
+        full = self.sp[rows] >= self.stack.shape[1]
+        if full.any():
+            self.overflow[rows[full]] = True
+            self.halted[rows[full]] = True
+        ok, rows = idx[~full], rows[~full]
+        self.stack[rows, self.sp[rows]] = values[ok]
+        self.sp[rows] += 1
+        return idx[full]
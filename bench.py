@@ -0,0 +1,183 @@
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from assembler import assemble
+from terminal import BytesSource, MemorySink
+from vm import ENGINES, MiniMachineVM
+
+VERSION = 1
+
+PROGRAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+
+# Scripted runs for programs that read input. Programs that keep polling once
+# their input runs out are stopped by max_steps.
+SCRIPTS = {
+    "input_reader": {"stdin": bytes(range(32, 127)), "max_steps": 200_000},
+    "tic-tac-toe": {"stdin": b"03142"},
+}
+DEFAULT_MAX_STEPS = 10_000_000
+
+# Short programs are run back to back until a sample takes this long, so
+# timer resolution and noise don't swamp them.
+MIN_SAMPLE = 0.02
+
+
+def run_once(program, engine, stdin, max_steps):
+    # Returns (VM, seconds, output). JIT compilation happens at construction and is
+    # timed with the run; the cache is off so every run pays for it.
+    out = MemorySink()
+    start = time.perf_counter()
+    vm = MiniMachineVM(program, engine=engine, jit_cache=False, output=out, input_source=BytesSource(stdin))
+    vm.run(max_steps)
+    return vm, time.perf_counter() - start, bytes(out.data)
+
+
+def bench_program(path, engines, repeat):
+    name = os.path.splitext(os.path.basename(path))[0]
+    script = SCRIPTS.get(name, {})
+    stdin = script.get("stdin", b"")
+    max_steps = script.get("max_steps", DEFAULT_MAX_STEPS)
+    with open(path) as f:
+        lines = f.readlines()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            program = b"".join(assemble(lines, path=path))
+        times.append(time.perf_counter() - start)
+    result = {"instructions": len(program) // 4, "assemble_s": min(times), "engines": {}}
+
+    for engine in engines:
+        vm, seconds, output = run_once(program, engine, stdin, max_steps)
+        runs = max(1, int(MIN_SAMPLE / seconds)) if seconds else 1
+        best = None
+        for _ in range(repeat):
+            seconds = sum(run_once(program, engine, stdin, max_steps)[1] for _ in range(runs)) / runs
+            best = seconds if best is None else min(best, seconds)
+        # Peak memory is measured on a separate run, as tracing slows it down.
+        tracemalloc.start()
+        run_once(program, engine, stdin, max_steps)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["engines"][engine] = {
+            "steps": vm.steps,
+            "exit": vm.exit_reason,
+            "seconds": best,
+            "ips": vm.steps / best if best else 0.0,
+            "peak_kib": peak / 1024,
+            "output_sha256": hashlib.sha256(output).hexdigest(),
+        }
+    outputs = {r["output_sha256"] for r in result["engines"].values()}
+    if len(outputs) > 1:
+        result["mismatch"] = True  # engines disagree on the output
+    return name, result
+
+
+def compare(results, baseline, threshold):
+    # Returns lines describing regressions: throughput down, or assembler
+    # time up, by more than threshold (a fraction), per program and engine.
+    problems = []
+    for name, result in results["programs"].items():
+        base = baseline["programs"].get(name)
+        if base is None:
+            continue
+        if result["assemble_s"] > base["assemble_s"] * (1 + threshold):
+            problems.append(
+                f"{name}: assembler {base['assemble_s'] * 1000:.2f}ms -> {result['assemble_s'] * 1000:.2f}ms"
+            )
+        for engine, run in result["engines"].items():
+            old = base["engines"].get(engine)
+            if old is None:
+                continue
+            if run["steps"] != old["steps"]:
+                problems.append(f"{name}/{engine}: ran {run['steps']} instructions, baseline ran {old['steps']}")
+            elif run["ips"] < old["ips"] * (1 - threshold):
+                change = 100 * (run["ips"] / old["ips"] - 1)
+                problems.append(f"{name}/{engine}: {old['ips']:,.0f} -> {run['ips']:,.0f} instructions/s ({change:+.1f}%)")
+    return problems
+
+
+def table(results, baseline=None):
+    lines = [f"{'program':<20} {'engine':<10} {'asm ms':>8} {'steps':>10} {'instr/s':>13} {'peak KiB':>9}  vs baseline"]
+    for name, result in sorted(results["programs"].items()):
+        base = (baseline or {}).get("programs", {}).get(name, {}).get("engines", {})
+        for engine, run in result["engines"].items():
+            delta = ""
+            if engine in base and base[engine]["ips"]:
+                delta = f"{100 * (run['ips'] / base[engine]['ips'] - 1):+.1f}%"
+            lines.append(
+                f"{name:<20} {engine:<10} {result['assemble_s'] * 1000:>8.2f} {run['steps']:>10} "
+                f"{run['ips']:>13,.0f} {run['peak_kib']:>9.1f}  {delta}"
+            )
+        if result.get("mismatch"):
+            lines.append(f"{name:<20} engines produced different output")
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the assembler and every VM engine over programs/")
+    parser.add_argument("programs", nargs="*", help="Program names or .m8a paths (default: all of programs/)")
+    parser.add_argument("--engine", action="append", choices=ENGINES, help="Engines to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the fastest is kept")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against this results file")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed slowdown before a regression, as a fraction")
+    parser.add_argument("--update-baseline", action="store_true", help="Save the results as the new --baseline")
+    args = parser.parse_args()
+
+    paths = []
+    for p in args.programs or sorted(glob.glob(os.path.join(PROGRAMS_DIR, "*.m8a"))):
+        paths.append(p if p.endswith(".m8a") else os.path.join(PROGRAMS_DIR, p + ".m8a"))
+    results = {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "programs": {},
+    }
+    for path in paths:
+        name, result = bench_program(path, args.engine or list(ENGINES), args.repeat)
+        results["programs"][name] = result
+        print(f"{name}: done", file=sys.stderr)
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != VERSION:
+            sys.exit(f"Unsupported baseline version: {baseline.get('version')}")
+    print(table(results, baseline))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.update_baseline:
+        if not args.baseline:
+            sys.exit("--update-baseline needs --baseline FILE")
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+    failed = any(r.get("mismatch") for r in results["programs"].values())
+    if baseline is not None:
+        problems = compare(results, baseline, args.threshold)
+        for line in problems:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,766 @@
+import json
+
+from jit import decode
+from vm import ALU_FUNCS, COND_FUNCS
+
+# How an instruction leaves, see effect().
+NEXT, JUMP, BRANCH, CALL, RET, HALT, INDIRECT = "next", "jump", "branch", "call", "ret", "halt", "indirect"
+
+# Edges along which a subroutine continues; "call" edges enter another one.
+INTRA = ("next", "jump", "return")
+
+
+def effect(pc, instr):
+    # Returns (kind, target) for the instruction at pc. target is the static
+    # destination of a jump, branch or CALL, or None if it is computed.
+    opclass, subtype, imm1, imm2, op1, op2, dest = decode(instr)
+    d = dest & 0x7
+
+    def static(val, imm):
+        # Operand value if it doesn't depend on registers. r7 reads as pc.
+        if imm:
+            return val
+        return pc if val & 0x7 == 7 else None
+
+    a, b = static(op1, imm1), static(op2, imm2)
+    if opclass == 0b00:
+        if d != 7:
+            return NEXT, None
+        if subtype == 0b111:
+            b = 0
+        if a is None or b is None:
+            return INDIRECT, None
+        return JUMP, (ALU_FUNCS[subtype](a, b) + 1) & 0xFF
+    if opclass == 0b01:
+        if subtype == 0b000:
+            return JUMP, dest
+        if subtype == 0b100:
+            return NEXT, None
+        if a is None and b is None and not imm1 and not imm2 and op1 & 0x7 == op2 & 0x7:
+            a = b = 0  # a register against itself
+        if a is not None and b is not None:
+            return (JUMP, dest) if COND_FUNCS[subtype](a, b) else (NEXT, None)
+        return BRANCH, dest
+    if opclass == 0b10:
+        if subtype == 0b000 and d == 7:  # MOV into r7 resumes after the value
+            return (INDIRECT, None) if a is None else (JUMP, (a + 1) & 0xFF)
+        if subtype == 0b001 and 7 in (op1 & 0x7, d):
+            return INDIRECT, None
+        if subtype == 0b011 and d == 7:
+            return RET, None
+        if subtype == 0b101:
+            return CALL, a
+        if subtype == 0b110 and d == 7:
+            return INDIRECT, None
+        if subtype == 0b111:
+            return HALT, None
+        return NEXT, None
+    return JUMP, pc  # reserved opcodes never advance the PC
+
+
+class Block:
+    """A basic block: instructions start to end - 1.
+
+    succs holds (kind, target) edges, kind being "next", "jump", "call",
+    "return" (from a CALL to its return site) or "indirect", with target None
+    for computed destinations or ones past the end of the program. exit is
+    "halt", "ret", "end" or None.
+    """
+
+    __slots__ = ("start", "end", "succs", "preds", "exit")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.succs = []
+        self.preds = []
+        self.exit = None
+
+    def size(self):
+        return self.end - self.start
+
+
+class Loop:
+    """A natural loop of a subroutine, found from its back edges.
+
+    bound is the most times the header can run per entry into the loop, when
+    it could be inferred from a counter compared against an immediate, and
+    counter the register that was used for it.
+    """
+
+    __slots__ = ("header", "body", "latches", "counter", "bound")
+
+    def __init__(self, header, body, latches):
+        self.header = header
+        self.body = body
+        self.latches = latches
+        self.counter = None
+        self.bound = None
+
+
+class Subroutine:
+    """The blocks reachable from a CALL target (or the entry point) without
+    following calls, with its loops and static cost."""
+
+    __slots__ = ("entry", "blocks", "dom", "loops", "calls", "writes", "clobbers", "wcet", "notes")
+
+    def __init__(self, entry, blocks):
+        self.entry = entry
+        self.blocks = blocks
+        self.dom = {}
+        self.loops = []
+        self.calls = set()  # targets, with None for computed ones
+        self.writes = set()  # registers written here or in callees
+        self.clobbers = None  # those not restored by the time it returns
+        self.wcet = None  # worst-case instructions per call, None if unbounded
+        self.notes = []  # why wcet is None
+
+    def size(self, cfg):
+        return sum(cfg.blocks[b].size() for b in self.blocks)
+
+
+class CFG:
+    """The control-flow graph of a Mini-8 binary and its static costs.
+
+    Costs count executed instructions, which is what the VM counts as steps.
+    A subroutine's worst case takes the longest path through its blocks,
+    charging each CALL with the callee's worst case and each loop with its
+    bound times its longest iteration. Loop bounds are found for loops with a
+    single ADD/SUB-immediate counter update and an exit test of that counter
+    against an immediate; with no known start value every one of the 256 is
+    tried. Anything else, like computed jumps, recursion or input-driven
+    loops, leaves the worst case unbounded with a note saying why.
+    """
+
+    def __init__(self, program, source_map=None):
+        self.program = bytes(program)
+        self.size = min(len(self.program) // 4, 256)
+        self.source_map = source_map
+        self.effects = [effect(pc, self.instr(pc)) for pc in range(self.size)]
+        self.blocks = {}
+        self.build_blocks()
+        self.reachable = self.reach(0, INTRA + ("call",))
+        self.subs = {}
+        entries = {t for b in self.reachable for k, t in self.blocks[b].succs if k == "call" and t is not None}
+        for entry in sorted(entries | ({0} if self.size else set())):
+            self.subs[entry] = Subroutine(entry, self.reach(entry, INTRA))
+        self.find_writes()
+        for entry in self.subs:
+            self.find_clobbers(entry, set())
+        for sub in self.subs.values():
+            self.find_loops(sub)
+            self.find_bounds(sub)
+        self.active = set()  # subroutines whose cost is being computed
+        self.done = set()
+        for entry in self.subs:
+            self.cost(entry)
+
+    def instr(self, pc):
+        return self.program[pc * 4 : pc * 4 + 4]
+
+    def name(self, pc):
+        label = self.source_map.label(pc) if self.source_map is not None else None
+        return label or f"{pc:02X}"
+
+    # Graph construction
+    def build_blocks(self):
+        n = self.size
+        leaders = {0}
+        for pc, (kind, target) in enumerate(self.effects):
+            if kind != NEXT:
+                leaders.add(pc + 1)
+                if target is not None:
+                    leaders.add(target)
+        starts = sorted(pc for pc in leaders if pc < n)
+        for start, end in zip(starts, starts[1:] + [n]):
+            block = self.blocks[start] = Block(start, end)
+            last = end - 1
+            kind, target = self.effects[last]
+            nxt = last + 1 if last + 1 < n else None
+            if kind == NEXT:
+                edges = [("next", nxt)]
+            elif kind == JUMP:
+                edges = [("jump", target)]
+            elif kind == BRANCH:
+                edges = [("jump", target), ("next", nxt)]
+            elif kind == CALL:
+                edges = [("call", target), ("return", nxt)]
+            elif kind == INDIRECT:
+                edges = [("indirect", None)]
+            else:
+                edges = []
+                block.exit = kind
+            for k, t in edges:
+                if t is not None and t >= n:
+                    t = None
+                if t is None and k in ("next", "jump", "return"):
+                    block.exit = "end"
+                block.succs.append((k, t))
+        for block in self.blocks.values():
+            for k, t in block.succs:
+                if t is not None:
+                    self.blocks[t].preds.append((k, block.start))
+
+    def reach(self, entry, kinds):
+        seen = set()
+        todo = [entry] if entry < self.size else []
+        while todo:
+            b = todo.pop()
+            if b in seen:
+                continue
+            seen.add(b)
+            todo.extend(t for k, t in self.blocks[b].succs if k in kinds and t is not None)
+        return seen
+
+    def intra_succs(self, b):
+        return [t for k, t in self.blocks[b].succs if k in INTRA and t is not None]
+
+    def unreachable(self):
+        # PC ranges no path from the entry point reaches.
+        ranges = []
+        for start in sorted(self.blocks):
+            if start in self.reachable:
+                continue
+            block = self.blocks[start]
+            if ranges and ranges[-1][1] == start - 1:
+                ranges[-1][1] = block.end - 1
+            else:
+                ranges.append([start, block.end - 1])
+        return ranges
+
+    # Dataflow
+    def instr_writes(self, pc):
+        # Registers the instruction at pc may write, not counting r7.
+        opclass, subtype, _, _, op1, _, dest = decode(self.instr(pc))
+        d = dest & 0x7
+        if opclass == 0b00 or (opclass == 0b10 and subtype in (0b000, 0b011, 0b110)):
+            return {d} - {6, 7}
+        if opclass == 0b10 and subtype == 0b001:
+            return {op1 & 0x7, d} - {6, 7}
+        return set()
+
+    def find_writes(self):
+        for sub in self.subs.values():
+            for b in sub.blocks:
+                block = self.blocks[b]
+                for pc in range(block.start, block.end):
+                    sub.writes |= self.instr_writes(pc)
+                sub.calls.update(t for k, t in block.succs if k == "call")
+        changed = True
+        while changed:
+            changed = False
+            for sub in self.subs.values():
+                for target in sub.calls:
+                    extra = set(range(6)) if target is None else self.subs[target].writes
+                    if not extra <= sub.writes:
+                        sub.writes |= extra
+                        changed = True
+
+    def find_clobbers(self, entry, active):
+        # Tracks which entry value each register and stack slot holds, so
+        # registers saved with PUSH and restored with POP before returning
+        # don't count as clobbered. Falls back to every written register if
+        # the stack doesn't balance.
+        sub = self.subs[entry]
+        if sub.clobbers is not None:
+            return sub.clobbers
+        if entry in active:
+            return sub.writes  # recursive
+        active.add(entry)
+        for target in sub.calls:
+            if target is not None:
+                self.find_clobbers(target, active)
+        active.discard(entry)
+        into = {entry: (tuple(range(8)), ("return address",))}
+        returns = []
+        todo = [entry]
+        while todo:
+            b = todo.pop()
+            regs, stack = into[b]
+            regs = list(regs)
+            block = self.blocks[b]
+            for pc in range(block.start, block.end):
+                opclass, subtype, imm1, _, op1, _, dest = decode(self.instr(pc))
+                d = dest & 0x7
+                if opclass == 0b10 and subtype == 0b010:  # PUSH
+                    stack += (None if imm1 or (op1 & 0x7) in (5, 6, 7) else regs[op1 & 0x7],)
+                elif opclass == 0b10 and subtype == 0b011:  # POP
+                    if not stack:
+                        sub.clobbers = sub.writes
+                        return sub.clobbers
+                    if d == 7:
+                        returns.append(regs)
+                    else:
+                        regs[d] = stack[-1]
+                    stack = stack[:-1]
+                elif opclass == 0b10 and subtype == 0b001:  # SWAP
+                    r = op1 & 0x7
+                    regs[r], regs[d] = regs[d], regs[r]
+                elif opclass == 0b10 and subtype == 0b000 and not imm1 and (op1 & 0x7) not in (5, 6, 7):
+                    regs[d] = regs[op1 & 0x7]
+                elif opclass == 0b10 and subtype == 0b101:
+                    target = self.effects[pc][1]
+                    for r in range(6) if target not in self.subs else self.subs[target].clobbers or self.subs[target].writes:
+                        regs[r] = None
+                else:
+                    for r in self.instr_writes(pc):
+                        regs[r] = None
+                regs[5] = None  # RAM data, changes with r4
+            for t in self.intra_succs(b):
+                if t not in into:
+                    into[t] = (tuple(regs), stack)
+                    todo.append(t)
+                    continue
+                old_regs, old_stack = into[t]
+                if len(old_stack) != len(stack):
+                    sub.clobbers = sub.writes
+                    return sub.clobbers
+                new = (
+                    tuple(x if x == y else None for x, y in zip(old_regs, regs)),
+                    tuple(x if x == y else None for x, y in zip(old_stack, stack)),
+                )
+                if new != into[t]:
+                    into[t] = new
+                    todo.append(t)
+        preserved = {r for r in range(6) if returns and all(regs[r] == r for regs in returns)}
+        sub.clobbers = sub.writes - preserved
+        return sub.clobbers
+
+    def transfer(self, pc, regs):
+        # Constant propagation through one instruction; None is unknown.
+        opclass, subtype, imm1, imm2, op1, op2, dest = decode(self.instr(pc))
+        d = dest & 0x7
+
+        def val(v, imm):
+            if imm:
+                return v
+            r = v & 0x7
+            return pc if r == 7 else 0 if r == 6 else regs[r]
+
+        if opclass == 0b00:
+            a, b = val(op1, imm1), val(op2, imm2)
+            if subtype == 0b111:
+                b = 0
+            value = None if a is None or b is None else ALU_FUNCS[subtype](a, b) & 0xFF
+        elif opclass == 0b10 and subtype == 0b000:
+            value = val(op1, imm1)
+        elif opclass == 0b10 and subtype == 0b001:
+            r = op1 & 0x7
+            if 6 not in (r, d) and 7 not in (r, d):
+                regs[r], regs[d] = regs[d], regs[r]
+            return
+        elif opclass == 0b10 and subtype == 0b101:
+            target = self.effects[pc][1]
+            for r in range(6) if target not in self.subs else self.subs[target].clobbers:
+                regs[r] = None
+            return
+        else:
+            value = None
+        for r in self.instr_writes(pc):
+            regs[r] = value
+        regs[5] = None  # RAM data, changes with r4
+
+    def entry_regs(self, sub):
+        # The machine starts with every register zeroed.
+        regs = [0] * 8 if sub.entry == 0 else [None] * 8
+        regs[5] = None
+        return regs
+
+    def constants(self, sub):
+        # Register values known on entry to each block of the subroutine.
+        into = {sub.entry: self.entry_regs(sub)}
+        todo = [sub.entry]
+        while todo:
+            b = todo.pop()
+            regs = list(into[b])
+            block = self.blocks[b]
+            for pc in range(block.start, block.end):
+                self.transfer(pc, regs)
+            for t in self.intra_succs(b):
+                old = into.get(t)
+                new = regs if old is None else [x if x == y else None for x, y in zip(old, regs)]
+                if new != old:
+                    into[t] = new
+                    todo.append(t)
+        return into
+
+    # Loops
+    def find_loops(self, sub):
+        blocks = sub.blocks
+        preds = {b: [p for _, p in self.blocks[b].preds if p in blocks and b in self.intra_succs(p)] for b in blocks}
+        dom = {b: set(blocks) for b in blocks}
+        dom[sub.entry] = {sub.entry}
+        changed = True
+        while changed:
+            changed = False
+            for b in sorted(blocks):
+                if b == sub.entry:
+                    continue
+                new = set.intersection(*(dom[p] for p in preds[b])) if preds[b] else set()
+                new = new | {b}
+                if new != dom[b]:
+                    dom[b] = new
+                    changed = True
+        sub.dom = dom
+        headers = {}
+        for b in blocks:
+            for t in self.intra_succs(b):
+                if t in dom[b]:
+                    headers.setdefault(t, set()).add(b)
+        for header, latches in sorted(headers.items()):
+            body = {header}
+            todo = list(latches)
+            while todo:
+                b = todo.pop()
+                if b not in body:
+                    body.add(b)
+                    todo.extend(preds[b])
+            sub.loops.append(Loop(header, body, latches))
+
+    def find_bounds(self, sub):
+        into = None
+        for loop in sub.loops:
+            inner = set().union(*(m.body for m in sub.loops if m.body < loop.body))
+            latches = loop.latches
+            for b in sorted(loop.body - inner):
+                if self.effects[self.blocks[b].end - 1][0] != BRANCH:
+                    continue
+                if not all(b in sub.dom[latch] for latch in latches):
+                    continue  # not on every iteration
+                if into is None:
+                    into = self.constants(sub)
+                bound = self.bound(sub, loop, b, inner, into)
+                if bound is not None:
+                    loop.bound = bound
+                    break
+
+    def bound(self, sub, loop, test, inner, into):
+        # Iterations of loop if the branch ending block test exits it by
+        # comparing a counter with a value fixed during the loop, else None.
+        block = self.blocks[test]
+        pc = block.end - 1
+        opclass, subtype, imm1, imm2, op1, op2, dest = decode(self.instr(pc))
+        taken, fall = (t for _, t in block.succs)
+        stays = (taken in loop.body, fall in loop.body)
+        if stays[0] == stays[1]:
+            return None
+        operands = ((op1, imm1), (op2, imm2))
+        for side in (0, 1):
+            val, imm = operands[side]
+            r = val & 0x7
+            if imm or r in (5, 6, 7):
+                continue
+            counter = self.counter(sub, loop, r, inner)
+            if counter is None:
+                continue
+            upd, u_block, step = counter
+            other, other_imm = operands[1 - side]
+            o = other & 0x7
+            if other_imm:
+                limits = {other}
+            elif o == 7:
+                limits = {pc}
+            elif o == 6:
+                limits = {0}
+            elif o == r or o == 5 or self.loop_writes(loop, o) != []:
+                continue
+            else:
+                limits = self.entry_values(sub, loop, o, into)
+                if limits is None:
+                    continue
+            starts = self.entry_values(sub, loop, r, into) or range(256)
+            update_first = upd < pc if u_block == test else u_block in sub.dom[test]
+            cond = COND_FUNCS[subtype]
+            worst = 0
+            for limit in limits:
+                for v in starts:
+                    for it in range(1, 257):
+                        if update_first:
+                            v = (v + step) & 0xFF
+                        jumps = cond(v, limit) if side == 0 else cond(limit, v)
+                        if not stays[0 if jumps else 1]:
+                            break
+                        if not update_first:
+                            v = (v + step) & 0xFF
+                    else:
+                        return None  # this counter never exits
+                    worst = max(worst, it)
+            loop.counter = r
+            return worst
+        return None
+
+    def loop_writes(self, loop, r):
+        # PCs in the loop that write r, or None if a call in it may.
+        writes = []
+        for b in loop.body:
+            for p in range(self.blocks[b].start, self.blocks[b].end):
+                if r in self.instr_writes(p):
+                    writes.append(p)
+                if self.effects[p][0] == CALL:
+                    target = self.effects[p][1]
+                    if target not in self.subs or r in self.subs[target].clobbers:
+                        return None
+        return writes
+
+    def counter(self, sub, loop, r, inner):
+        # (pc, block, step) of the single r = r +/- k in the loop, if that is
+        # the only write to r and it runs exactly once per iteration.
+        writes = self.loop_writes(loop, r)
+        if writes is None or len(writes) != 1:
+            return None
+        upd = writes[0]
+        opclass, subtype, imm1, imm2, op1, op2, dest = decode(self.instr(upd))
+        if opclass != 0b00 or subtype not in (0b010, 0b110) or dest & 0x7 != r:
+            return None
+        if not imm1 and imm2 and op1 & 0x7 == r:
+            step = op2
+        elif subtype == 0b010 and imm1 and not imm2 and op2 & 0x7 == r:
+            step = op1
+        else:
+            return None
+        if subtype == 0b110:
+            step = -step
+        block = next(b for b in loop.body if self.blocks[b].start <= upd < self.blocks[b].end)
+        if block in inner or not all(block in sub.dom[latch] for latch in loop.latches):
+            return None
+        return upd, block, step
+
+    def entry_values(self, sub, loop, r, into):
+        # The values r can hold when the loop is entered, or None if unknown.
+        header = self.blocks[loop.header]
+        outside = [p for k, p in header.preds if k in INTRA and p in sub.blocks and p not in loop.body]
+        values = {self.exit_regs(p, into)[r] for p in outside}
+        if loop.header == sub.entry:
+            values.add(self.entry_regs(sub)[r])
+        return None if None in values or not values else values
+
+    def exit_regs(self, b, into):
+        regs = list(into.get(b, [None] * 8))
+        block = self.blocks[b]
+        for pc in range(block.start, block.end):
+            self.transfer(pc, regs)
+        return regs
+
+    # Costs
+    def note(self, sub, text):
+        if text not in sub.notes:
+            sub.notes.append(text)
+
+    def cost(self, entry):
+        # Worst-case instructions for one call of the subroutine at entry.
+        sub = self.subs[entry]
+        if entry in self.done:
+            return sub.wcet
+        if entry in self.active:
+            return None  # recursive; the caller notes it
+        self.active.add(entry)
+        sub.wcet = self.longest(sub, sub.blocks, entry, None)
+        self.active.discard(entry)
+        self.done.add(entry)
+        return sub.wcet
+
+    def block_cost(self, sub, b):
+        block = self.blocks[b]
+        total = block.size()
+        for kind, target in block.succs:
+            if kind == "indirect":
+                self.note(sub, f"computed jump at {block.end - 1:02X}")
+                return None
+            if kind != "call":
+                continue
+            if target is None:
+                self.note(sub, f"CALL to a computed or missing address at {block.end - 1:02X}")
+                return None
+            if target in self.active:
+                self.note(sub, f"recursive call to {self.name(target)}")
+                return None
+            callee = self.cost(target)
+            if callee is None:
+                self.note(sub, f"calls {self.name(target)}, which is unbounded")
+                return None
+            total += callee
+        return total
+
+    def loop_cost(self, sub, loop):
+        if loop.bound is None:
+            self.note(sub, f"no bound for the loop at {self.name(loop.header)}")
+            return None
+        body = self.longest(sub, loop.body, loop.header, loop)
+        return None if body is None else loop.bound * body
+
+    def longest(self, sub, region, entry, own):
+        # Most instructions on a path from entry through region, not taking
+        # edges back to entry. Outermost loops inside region, other than own,
+        # count as single nodes costing their bound times their longest
+        # iteration.
+        loops = [l for l in sub.loops if l is not own and l.body <= region]
+        outer = [l for l in loops if not any(l.body < m.body for m in loops)]
+        node = {}
+        for loop in outer:
+            for b in loop.body:
+                node[b] = loop
+        memo = {}
+        visiting = set()
+
+        def value(n):
+            if n in memo:
+                return memo[n]
+            if n in visiting:
+                self.note(sub, "irreducible control flow")
+                return None
+            visiting.add(n)
+            if isinstance(n, Loop):
+                cost = self.loop_cost(sub, n)
+                succs = {t for b in n.body for t in self.intra_succs(b) if t not in n.body}
+            else:
+                cost = self.block_cost(sub, n)
+                succs = set(self.intra_succs(n))
+            best = 0
+            for t in succs:
+                if t not in region or t == entry:
+                    continue
+                v = value(node.get(t, t))
+                best = None if v is None or best is None else max(best, v)
+            visiting.discard(n)
+            memo[n] = None if cost is None or best is None else cost + best
+            return memo[n]
+
+        return value(node.get(entry, entry))
+
+    # Output
+    def to_json(self, disassemble):
+        return {
+            "instructions": self.size,
+            "blocks": [
+                {
+                    "start": b,
+                    "end": block.end - 1,
+                    "reachable": b in self.reachable,
+                    "exit": block.exit,
+                    "succs": [{"kind": k, "target": t} for k, t in block.succs],
+                    "code": [disassemble(self.instr(pc)) for pc in range(block.start, block.end)],
+                }
+                for b, block in sorted(self.blocks.items())
+            ],
+            "subroutines": [
+                {
+                    "entry": sub.entry,
+                    "name": self.name(sub.entry),
+                    "blocks": sorted(sub.blocks),
+                    "instructions": sub.size(self),
+                    "calls": sorted(t for t in sub.calls if t is not None),
+                    "writes": [f"r{r}" for r in sorted(sub.writes)],
+                    "clobbers": [f"r{r}" for r in sorted(sub.clobbers)],
+                    "loops": [
+                        {
+                            "header": loop.header,
+                            "blocks": sorted(loop.body),
+                            "latches": sorted(loop.latches),
+                            "counter": None if loop.counter is None else f"r{loop.counter}",
+                            "bound": loop.bound,
+                        }
+                        for loop in sub.loops
+                    ],
+                    "wcet": sub.wcet,
+                    "notes": sub.notes,
+                }
+                for entry, sub in sorted(self.subs.items())
+            ],
+            "unreachable": self.unreachable(),
+        }
+
+    def write_json(self, path, disassemble):
+        with open(path, "w") as f:
+            json.dump(self.to_json(disassemble), f, indent=2)
+            f.write("\n")
+
+    def to_dot(self, disassemble):
+        # Blocks are grouped by the first subroutine they belong to; calls
+        # are dashed, returns to the call site dotted, and unreachable blocks
+        # grey.
+        headers = {loop.header for sub in self.subs.values() for loop in sub.loops}
+        owner = {}
+        for entry in sorted(self.subs):
+            for b in self.subs[entry].blocks:
+                owner.setdefault(b, entry)
+
+        def node(b):
+            block = self.blocks[b]
+            text = "".join(f"{pc:02X}: {disassemble(self.instr(pc))}\\l" for pc in range(block.start, block.end))
+            if block.exit:
+                text += f"({block.exit})\\l"
+            text = text.replace('"', '\\"')
+            attrs = f'label="{text}"'
+            if b not in self.reachable:
+                attrs += ", style=dashed, color=grey, fontcolor=grey"
+            if b in headers:
+                attrs += ", penwidth=2"
+            return f"b{b:02X} [{attrs}];"
+
+        lines = ["digraph mini8 {", '    node [shape=box, fontname="monospace"];']
+        for entry in sorted(self.subs):
+            sub = self.subs[entry]
+            wcet = "unbounded" if sub.wcet is None else f"worst case {sub.wcet}"
+            lines.append(f"    subgraph cluster_{entry:02X} {{")
+            lines.append(f'        label="{self.name(entry)} ({wcet})";')
+            lines.extend(f"        {node(b)}" for b in sorted(sub.blocks) if owner[b] == entry)
+            lines.append("    }")
+        lines.extend(f"    {node(b)}" for b in sorted(self.blocks) if b not in owner)
+        styles = {"call": " [style=dashed]", "return": " [style=dotted]", "jump": ' [label="jump"]'}
+        for b, block in sorted(self.blocks.items()):
+            for kind, target in block.succs:
+                if target is not None:
+                    lines.append(f"    b{b:02X} -> b{target:02X}{styles.get(kind, '')};")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        lines = []
+        for entry, sub in sorted(self.subs.items()):
+            calls = ", ".join(self.name(t) if t is not None else "(computed)" for t in sorted(sub.calls, key=lambda t: -1 if t is None else t))
+            lines.append(
+                f"{self.name(entry)}: {sub.size(self)} instructions in {len(sub.blocks)} blocks"
+                + (f", calls {calls}" if calls else "")
+            )
+            for loop in sub.loops:
+                span = f"{min(loop.body):02X}-{max(self.blocks[b].end - 1 for b in loop.body):02X}"
+                bound = "no bound" if loop.bound is None else f"at most {loop.bound} iterations (r{loop.counter})"
+                lines.append(f"    loop {span} at {self.name(loop.header)}: {bound}")
+            if sub.wcet is None:
+                lines.append(f"    worst case: unbounded ({'; '.join(sub.notes)})")
+            else:
+                lines.append(f"    worst case: {sub.wcet} instructions")
+        for lo, hi in self.unreachable():
+            lines.append(f"unreachable: {lo:02X}-{hi:02X}")
+        return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    import container
+    from sourcemap import load_for
+    from terminal import MemorySink
+    from vm import MiniMachineVM
+
+    parser = argparse.ArgumentParser(description="Control-flow graph and static worst-case cost of a Mini-8 binary")
+    parser.add_argument("program", help="Program binary (.mi8)")
+    parser.add_argument("--dot", help="Write the CFG as Graphviz DOT to this file")
+    parser.add_argument("--json", help="Write the CFG and costs as JSON to this file")
+    args = parser.parse_args()
+
+    image = container.load(args.program)
+    program = image.program
+    source_map = load_for(args.program, program) or image.source_map()
+    disassemble = MiniMachineVM(program, output=MemorySink(), source_map=source_map).disassemble
+    cfg = CFG(program, source_map)
+    print(cfg.report())
+    if args.dot:
+        with open(args.dot, "w") as f:
+            f.write(cfg.to_dot(disassemble))
+    if args.json:
+        cfg.write_json(args.json, disassemble)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import mmap
+import struct
+import sys
+import zlib
+
+VERSION = 1
+ISA_VERSION = 1
+# The first byte has the reserved opcode bit set, so no valid raw program
+# starts with the magic.
+MAGIC = b"\xffM8I"
+HEADER = struct.Struct("<4sBBHHHII")  # magic, version, ISA version, flags, instructions, symbols, symbol table bytes, CRC-32
+
+# Flags.
+PREDECODED = 1  # a bitmap of the JIT's block leaders follows the symbol table
+
+LEADERS_SIZE = 32  # one bit per PC
+
+
+class Image:
+    """A program loaded from disk, either raw instruction bytes or a container.
+
+    A container is the header above, the instructions, a symbol table of
+    (pc, name length, name) records, and with PREDECODED the block leaders
+    jit.find_leaders() would compute. The CRC covers the header up to it and
+    everything after it.
+
+    Files are mapped rather than read: program is a memoryview into the
+    mapping, so loading copies nothing until the VM decodes the program.
+    symbols maps label names to PCs and leaders is a set of PCs, or None
+    when the file doesn't have them.
+    """
+
+    def __init__(self, program, symbols=None, leaders=None, container=False):
+        self.program = program
+        self.symbols = symbols or {}
+        self.leaders = leaders
+        self.container = container
+
+    @property
+    def size(self):
+        return len(self.program) // 4
+
+    def source_map(self):
+        # A label-only source map for the symbols, or None without any.
+        if not self.symbols:
+            return None
+        from sourcemap import SourceMap
+
+        smap = SourceMap()
+        for name, pc in self.symbols.items():
+            smap.add_label(name, pc)
+        return smap
+
+
+def pack(program, symbols=None, leaders=None):
+    # The container for program, as bytes.
+    program = bytes(program)
+    count = len(program) // 4
+    if len(program) % 4 or count > 256:
+        raise ValueError(f"Not a Mini-8 program: {len(program)} bytes")
+    table = bytearray()
+    for name, pc in (symbols or {}).items():
+        encoded = name.encode()
+        if not 0 <= pc < 256 or len(encoded) > 255:
+            raise ValueError(f"Can't store symbol {name} at {pc}")
+        table += bytes((pc, len(encoded))) + encoded
+    flags = 0
+    body = program + table
+    if leaders is not None:
+        flags |= PREDECODED
+        bitmap = bytearray(LEADERS_SIZE)
+        for pc in leaders:
+            bitmap[pc >> 3] |= 1 << (pc & 7)
+        body += bitmap
+    header = HEADER.pack(MAGIC, VERSION, ISA_VERSION, flags, count, len(symbols or {}), len(table), 0)
+    crc = zlib.crc32(body, zlib.crc32(header[: HEADER.size - 4]))
+    return header[: HEADER.size - 4] + struct.pack("<I", crc) + body
+
+
+def save(path, program, symbols=None, predecode=True):
+    leaders = None
+    if predecode:
+        from jit import find_leaders
+
+        leaders = find_leaders(bytes(program))
+    data = pack(program, symbols, leaders)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def load(path, verify=True):
+    # Returns an Image. Files without the magic load as raw programs.
+    with open(path, "rb") as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            return Image(b"")
+    view = memoryview(mapping)
+    if view[:4] != MAGIC:
+        return Image(view)
+    return parse(view, path, verify)
+
+
+def parse(view, path="<memory>", verify=True):
+    if len(view) < HEADER.size:
+        raise ValueError(f"{path} is truncated")
+    magic, version, isa, flags, count, nsyms, table_size, crc = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a Mini-8 container")
+    if version != VERSION:
+        raise ValueError(f"Unsupported container version: {version}")
+    if isa != ISA_VERSION:
+        raise ValueError(f"{path} is built for ISA version {isa}, this VM runs version {ISA_VERSION}")
+    code = HEADER.size
+    table = code + count * 4
+    end = table + table_size + (LEADERS_SIZE if flags & PREDECODED else 0)
+    if count > 256 or len(view) != end:
+        raise ValueError(f"{path} is truncated or corrupt")
+    if verify and zlib.crc32(view[HEADER.size :], zlib.crc32(view[: HEADER.size - 4])) != crc:
+        raise ValueError(f"{path} fails its checksum")
+
+    symbols = {}
+    k = table
+    for _ in range(nsyms):
+        if k + 2 > table + table_size:
+            raise ValueError(f"{path} has a corrupt symbol table")
+        pc, length = view[k], view[k + 1]
+        symbols[bytes(view[k + 2 : k + 2 + length]).decode()] = pc
+        k += 2 + length
+    leaders = None
+    if flags & PREDECODED:
+        bitmap = view[table + table_size : end]
+        leaders = {pc for pc in range(count) if bitmap[pc >> 3] >> (pc & 7) & 1}
+    return Image(view[code:table], symbols, leaders, container=True)
+
+
+def main():
+    import argparse
+
+    import sourcemap
+
+    parser = argparse.ArgumentParser(description="Check Mini-8 binaries, or pack a raw one into a container")
+    parser.add_argument("files", nargs="+", help="Binaries (.mi8), raw or containers")
+    parser.add_argument("--pack", metavar="OUTPUT", help="Write the one input as a container, with the labels from its source map")
+    parser.add_argument("--no-predecode", action="store_true", help="Leave the block leaders out when packing")
+    args = parser.parse_args()
+
+    if args.pack:
+        if len(args.files) != 1:
+            parser.error("--pack takes a single input")
+        image = load(args.files[0])
+        smap = sourcemap.load_for(args.files[0], image.program)
+        symbols = smap.labels if smap is not None else image.symbols
+        save(args.pack, image.program, symbols, not args.no_predecode)
+        return
+    failed = False
+    for path in args.files:
+        try:
+            image = load(path)
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}")
+            failed = True
+            continue
+        if image.container:
+            extra = ", predecoded" if image.leaders is not None else ""
+            print(f"{path}: container v{VERSION}, {image.size} instructions, {len(image.symbols)} symbols{extra}")
+        else:
+            print(f"{path}: raw, {image.size} instructions")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+import sys
+
+
+class Stop(Exception):
+    """Raised by an instrumented handler to hand control back to the debugger.
+
+    next is the PC to resume at when the instruction has already executed
+    (watchpoints), or None when it has not (breakpoints).
+    """
+
+    def __init__(self, reason, next=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.next = next
+
+
+def writes(instr):
+    # Registers an instruction may write, not counting r7.
+    opcode, op1, _, dest = instr
+    opclass = (opcode >> 3) & 0x3
+    subtype = opcode & 0x7
+    d = dest & 0x7
+    if opclass == 0b00:
+        return {d}
+    if opclass == 0b10:
+        if subtype in (0b000, 0b011, 0b110):  # MOV, POP, RFT
+            return {d}
+        if subtype == 0b001:  # SWAP
+            return {op1 & 0x7, d}
+    return set()
+
+
+class Debugger:
+    """Breakpoints and watchpoints over a table-engine MiniMachineVM.
+
+    The VM runs at full speed through its decoded handler table. Only the
+    handlers at PCs with a breakpoint, or that may write a watched register or
+    RAM cell, are wrapped with checks, and the wrappers raise Stop when one
+    fires.
+
+    If the VM records a trace (see recorder.py), it can also step and continue
+    backwards. Going forward again replays the trace until it catches up with
+    where the machine had got to, and only then executes.
+    """
+
+    def __init__(self, vm):
+        if vm.engine != "table":
+            raise ValueError("The debugger needs the table engine")
+        self.vm = vm
+        self.orig = list(vm.table)
+        self.breakpoints = {}  # pc -> compiled condition, or None
+        self.watch_regs = set()
+        self.watch_ram = set()
+        self.temp = None  # (pc, stack depth) of a step-over return point
+
+    def instrs(self):
+        program = self.vm.program
+        for pc in range(min(self.vm.size, 256)):
+            yield pc, program[pc * 4 : pc * 4 + 4]
+
+    def install(self):
+        # Rebuild the wrapped handlers from the original table.
+        table = self.vm.table
+        table[:] = self.orig
+        regs = self.watch_regs | ({5} if self.watch_ram else set())  # r5 is the RAM data register
+        if 5 in self.watch_regs:
+            regs.add(4)  # which moves with RAMADDR
+        for pc, instr in self.instrs():
+            if regs & writes(instr):
+                table[pc] = self.watcher(table[pc])
+        for pc in self.breakpoints:
+            table[pc] = self.breaker(pc, table[pc])
+        if self.temp is not None:
+            pc, depth = self.temp
+            table[pc] = self.returner(depth, table[pc])
+
+    def env(self, pc):
+        vm = self.vm
+        env = {f"r{i}": vm.get_operand(i, 0) for i in range(7)}
+        env.update(r7=pc, pc=pc, sp=vm.sp, ram=vm.ram, stack=list(vm.stack[: vm.sp]))
+        return env
+
+    def break_reason(self, pc):
+        # Why the breakpoint at pc stops the machine, or None if it doesn't.
+        cond = self.breakpoints[pc]
+        if cond is None:
+            return f"Breakpoint at {pc:02X}"
+        try:
+            hit = eval(cond, {"__builtins__": {}}, self.env(pc))
+        except Exception as e:
+            return f"Breakpoint at {pc:02X}, condition failed: {e}"
+        return f"Breakpoint at {pc:02X}" if hit else None
+
+    def breaker(self, pc, fn):
+        def check():
+            reason = self.break_reason(pc)
+            if reason:
+                raise Stop(reason)
+            return fn()
+
+        return check
+
+    def returner(self, depth, fn):
+        vm = self.vm
+
+        def check():
+            if vm.sp <= depth:
+                raise Stop(None)
+            return fn()
+
+        return check
+
+    def watcher(self, fn):
+        reg = self.vm.get_operand
+        ram = self.vm.ram
+        regs = sorted(self.watch_regs)
+        cells = sorted(self.watch_ram)
+
+        def check():
+            before = [reg(r, 0) for r in regs]
+            cells_before = [ram[a] for a in cells]
+            nxt = fn()
+            for r, old in zip(regs, before):
+                if reg(r, 0) != old:
+                    raise Stop(f"Watchpoint r{r}: {old} -> {reg(r, 0)}", nxt)
+            for a, old in zip(cells, cells_before):
+                if ram[a] != old:
+                    raise Stop(f"Watchpoint ram[{a}]: {old} -> {ram[a]}", nxt)
+            return nxt
+
+        return check
+
+    def add_breakpoint(self, pc, condition=None):
+        self.breakpoints[pc] = None if condition is None else compile(condition, f"<break {pc:02X}>", "eval")
+        self.install()
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints.pop(pc, None)
+        self.install()
+
+    def watch(self, target):
+        # target is a register index, or ("ram", address).
+        if isinstance(target, tuple):
+            self.watch_ram.add(target[1])
+        else:
+            self.watch_regs.add(target)
+        self.install()
+
+    def unwatch(self, target):
+        if isinstance(target, tuple):
+            self.watch_ram.discard(target[1])
+        else:
+            self.watch_regs.discard(target)
+        self.install()
+
+    def resume(self, max_steps=None):
+        # Returns why the run stopped.
+        vm = self.vm
+        try:
+            vm.run(max_steps)
+        except Stop as stop:
+            if stop.next is not None:
+                vm.state[vm.PC] = stop.next
+                vm.steps += 1
+            return stop.reason
+        return vm.exit_reason if vm.halted else None
+
+    def watched(self):
+        vm = self.vm
+        return [vm.get_operand(r, 0) for r in sorted(self.watch_regs)], [vm.ram[a] for a in sorted(self.watch_ram)]
+
+    def changed(self, before, backwards=False):
+        # A watchpoint message if a watched value differs from before. Going
+        # backwards, the message still reads in execution order.
+        regs, cells = before
+        now_regs, now_cells = self.watched()
+        if backwards:
+            (regs, cells), (now_regs, now_cells) = (now_regs, now_cells), (regs, cells)
+        for r, old, new in zip(sorted(self.watch_regs), regs, now_regs):
+            if old != new:
+                return f"Watchpoint r{r}: {old} -> {new}"
+        for a, old, new in zip(sorted(self.watch_ram), cells, now_cells):
+            if old != new:
+                return f"Watchpoint ram[{a}]: {old} -> {new}"
+        return None
+
+    def replaying(self):
+        trace = self.vm.trace
+        return trace is not None and trace.pos < trace.end
+
+    def travel(self, move, stop=None):
+        # Undo or redo trace entries (move is trace.undo or trace.redo) until
+        # a watched value changes, a breakpoint is reached, stop() returns
+        # True, or the trace runs out. Returns the reason, or None.
+        vm = self.vm
+        backwards = move == vm.trace.undo
+        while True:
+            before = self.watched()
+            if not move(vm):
+                return None
+            reason = self.changed(before, backwards)
+            pc = vm.state[vm.PC]
+            if reason is None and pc in self.breakpoints:
+                reason = self.break_reason(pc)
+            if reason or (stop is not None and stop()):
+                return reason
+            if vm.halted:
+                return vm.exit_reason
+
+    def reverse_step(self):
+        vm = self.vm
+        if vm.trace is None:
+            raise ValueError("Not recording a trace (run with --reverse)")
+        before = self.watched()
+        if not vm.trace.undo(vm):
+            return "At the start of the trace"
+        return self.changed(before, backwards=True)
+
+    def reverse_cont(self):
+        vm = self.vm
+        if vm.trace is None:
+            raise ValueError("Not recording a trace (run with --reverse)")
+        return self.travel(vm.trace.undo) or "At the start of the trace"
+
+    def step(self):
+        # Execute the current instruction, ignoring any breakpoint on it.
+        vm = self.vm
+        if self.replaying():
+            before = self.watched()
+            vm.trace.redo(vm)
+            return self.changed(before) or (vm.exit_reason if vm.halted else None)
+        pc = vm.state[vm.PC]
+        if pc not in self.breakpoints:
+            return self.resume(1)
+        vm.table[pc] = self.orig[pc]
+        try:
+            return self.resume(1)
+        finally:
+            self.install()
+
+    def next(self):
+        # Like step(), but runs a CALL through to its return.
+        vm = self.vm
+        pc = vm.state[vm.PC]
+        opcode = vm.program[pc * 4] if pc < vm.size else 0
+        if opcode & 0x1F != 0b10101:  # not a CALL
+            return self.step()
+        depth = vm.sp
+        reason = self.step()
+        if reason is not None or vm.sp <= depth:
+            return reason
+        ret = (pc + 1) % 256
+        if self.replaying():
+            reason = self.travel(vm.trace.redo, lambda: vm.state[vm.PC] == ret and vm.sp <= depth)
+            if reason is not None or self.replaying() or vm.halted:
+                return reason
+        self.temp = (ret, depth)
+        self.install()
+        try:
+            return self.resume()
+        finally:
+            self.temp = None
+            self.install()
+
+    def cont(self):
+        reason = self.step()
+        if reason is None and self.replaying():
+            reason = self.travel(self.vm.trace.redo)
+        if reason is None and not self.vm.halted:
+            reason = self.resume()
+        return reason
+
+    def where(self):
+        vm = self.vm
+        pc = vm.state[vm.PC]
+        instr = vm.program[pc * 4 : pc * 4 + 4] if pc < vm.size else b""
+        regs = " ".join(f"r{i}={vm.get_operand(i, 0):02X}" for i in range(6))
+        stack = " ".join(f"{b:02X}" for b in vm.stack[: vm.sp])
+        lines = [f"{pc:02X}: {vm.disassemble(instr) if len(instr) == 4 else '(end of program)'}"]
+        source = vm.where(pc)
+        if source:
+            lines.append(f"    at {source}")
+        lines.append(f"    {regs}  steps={vm.steps}")
+        if self.replaying():
+            lines.append(f"    replaying, {vm.trace.end - vm.trace.pos} instructions behind")
+        lines.append(f"    stack[{vm.sp}]: {stack}")
+        return "\n".join(lines)
+
+    def listing(self, around=None, context=5):
+        vm = self.vm
+        pc = vm.state[vm.PC] if around is None else around
+        lines = []
+        for addr, instr in self.instrs():
+            if abs(addr - pc) <= context:
+                mark = ">" if addr == vm.state[vm.PC] else ("*" if addr in self.breakpoints else " ")
+                source = vm.where(addr)
+                lines.append(f"{mark} {addr:02X}: {vm.disassemble(instr)}" + (f"  ; {source}" if source else ""))
+        return "\n".join(lines)
+
+    def dump(self, addr=0, count=64):
+        # count bytes of RAM from addr, 16 to a line.
+        ram = self.vm.ram
+        addr &= 0xFF
+        end = min(addr + count, len(ram))
+        lines = []
+        for row in range(addr, end, 16):
+            cells = " ".join(f"{b:02X}" for b in ram[row : min(row + 16, end)])
+            lines.append(f"  ram[{row:02X}]: {cells}")
+        return "\n".join(lines)
+
+    def repl(self):
+        print("Mini-8 debugger. Commands: b PC [if EXPR], d PC, w rN|ram[N], uw rN|ram[N],")
+        print("s (step), n (step over CALL), c (continue), i (info), l [PC] (list), m [ADDR [N]] (RAM), q (quit)")
+        if self.vm.trace is not None:
+            print("rs (reverse step), rc (reverse continue)")
+        last = "s"
+        while not self.vm.halted or self.vm.trace is not None:
+            try:
+                line = input("(m8db) ").strip() or last
+            except EOFError:
+                break
+            last = line
+            cmd, _, arg = line.partition(" ")
+            try:
+                if cmd == "q":
+                    break
+                elif cmd == "b":
+                    pc, _, cond = arg.partition(" if ")
+                    self.add_breakpoint(int(pc, 0), cond or None)
+                elif cmd == "d":
+                    self.remove_breakpoint(int(arg, 0))
+                elif cmd in ("w", "uw"):
+                    target = parse_target(arg)
+                    (self.watch if cmd == "w" else self.unwatch)(target)
+                elif cmd in ("s", "n", "c", "rs", "rc"):
+                    commands = {"s": self.step, "n": self.next, "c": self.cont, "rs": self.reverse_step, "rc": self.reverse_cont}
+                    reason = commands[cmd]()
+                    if reason:
+                        print(reason)
+                    print(self.where())
+                elif cmd == "i":
+                    print(self.where())
+                elif cmd == "l":
+                    print(self.listing(int(arg, 0) if arg else None))
+                elif cmd == "m":
+                    print(self.dump(*(int(x, 0) for x in arg.split()[:2])))
+                else:
+                    print(f"Unknown command: {cmd}")
+            except (ValueError, SyntaxError) as e:
+                print(f"Error: {e}")
+        if self.vm.halted:
+            print(f"Stopped: {self.vm.exit_reason} after {self.vm.steps} instructions", file=sys.stderr)
+
+
+def parse_target(arg):
+    arg = arg.strip()
+    if arg.startswith("ram[") and arg.endswith("]"):
+        return ("ram", int(arg[4:-1], 0) & 0xFF)
+    if len(arg) == 2 and arg[0] == "r" and arg[1] in "012345":
+        return int(arg[1])
+    raise ValueError(f"Can't watch {arg!r}; use r0-r5 or ram[N]")
@@ -0,0 +1,478 @@
+import hashlib
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from cfg import BRANCH, CALL, INDIRECT, JUMP, NEXT, RET, effect
+from jit import decode
+from terminal import INVALID, RFT_TABLE, BytesSource
+from vm import MiniMachineVM
+
+MAX_STEPS = 100_000  # instructions per input before it counts as a hang
+MAX_LEN = 64  # input bytes
+SLOW = 10_000  # instructions that make an input worth reporting as slow
+
+# Machine states kept, keyed by the input read so far. Resuming from the
+# longest checkpointed prefix skips everything the input has in common with
+# one tried before.
+CHECKPOINTS = 4096
+
+# Seconds between progress reports, and between corpus merges in a pool.
+ROUND = 1.0
+
+# How an execution can fail, as in MiniMachineVM.exit_reason, plus POPs on an
+# empty stack, which the VM itself ignores.
+CRASHES = {
+    "end": "PC ran off the end",
+    "overflow": "stack overflow",
+    "loop": "infinite loop",
+    "pop-empty": "POP on an empty stack",
+}
+
+# Hit counts of an edge in one execution are bucketed 1, 2, 3, 4-7, 8-15,
+# 16-31, 32-127 and 128+, one bit each, so inputs that run a loop a
+# different number of times count as new coverage.
+LIMITS = (1, 2, 3, 4, 8, 16, 32, 128)
+BUCKETS = bytes(max([0] + [1 << i for i, lo in enumerate(LIMITS) if n >= lo]) for n in range(256))
+
+INTERESTING = (0x00, 0x01, 0x0A, 0x0D, 0x20, 0x7F, 0x80, 0xFE, 0xFF)
+
+
+class Starved(Exception):
+    """Raised at an RFT once the input being tested has all been read."""
+
+
+class Pause(Exception):
+    """Raised at an RFT whose machine state has no checkpoint yet."""
+
+
+class PopEmpty(Exception):
+    """Raised by a POP on an empty stack."""
+
+
+class NullSink:
+    """Discards program output."""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Result:
+    """How one execution ended.
+
+    kind is "halt", "starved" (it wanted more input), "budget" or one of
+    CRASHES. pc is where it stopped, or the lowest PC of an infinite loop.
+    """
+
+    __slots__ = ("kind", "pc", "steps", "read", "fresh")
+
+    def __init__(self, kind, pc, steps, read, fresh):
+        self.kind = kind
+        self.pc = pc
+        self.steps = steps  # instructions, counting from the start of the program
+        self.read = read  # input bytes consumed
+        self.fresh = fresh  # (edge, bucket) pairs no earlier execution reached
+
+
+class Fuzzer:
+    """Coverage-guided fuzzing of a program's RFT input.
+
+    Inputs are byte strings served to RFT one byte at a time; a program
+    that reads past the end of its input is starved, and the execution
+    ends there. Handlers for branches, returns, computed jumps, POPs and
+    RFTs are instrumented in place to count the edges they take, and every
+    input that takes a new edge, or an edge a new number of times (see
+    BUCKETS), joins the corpus, which mutation draws on for further inputs.
+
+    At every RFT the machine state and edge counts are checkpointed under
+    the input read so far, so an input only executes from the longest
+    prefix it shares with an earlier one. Crashes are kept per kind and
+    PC, with the shortest input found for each; the slowest input is kept
+    too.
+    """
+
+    def __init__(self, program, max_steps=MAX_STEPS, max_len=MAX_LEN, ignore=(), seed=None, source_map=None):
+        self.program = bytes(program)
+        self.size = min(len(self.program) // 4, 256)
+        self.max_steps = max_steps
+        self.max_len = max_len
+        self.crash_kinds = set(CRASHES) - set(ignore)
+        self.rng = random.Random(seed)
+        self.source = BytesSource()
+        self.vm = MiniMachineVM(
+            self.program, engine="table", output=NullSink(), input_source=self.source, source_map=source_map
+        )
+        self.checkpoints = OrderedDict()
+        self.counts = {}  # edge -> times taken by the current execution, edges being pc << 8 | next PC
+        self.start = (self.vm.snapshot(), {})
+        self.seen = bytearray(1 << 16)  # buckets reached, per edge
+        self.effects = [effect(pc, self.program[pc * 4 : pc * 4 + 4]) for pc in range(self.size)]
+        self.probes = set()  # PCs whose edges are recorded
+        self.instrument()
+        self.words = self.dictionary()
+        self.corpus = []
+        self.found = []  # (input, fresh) for corpus additions since take()
+        self.crashes = {}  # (kind, pc) -> shortest input
+        self.slowest = (0, b"")  # (steps, input)
+        self.execs = 0
+
+    # Instrumentation
+    def instrument(self):
+        table = self.vm.table
+        for pc in range(self.size):
+            opclass, subtype = decode(self.program[pc * 4 : pc * 4 + 4])[:2]
+            kind, target = self.effects[pc]
+            handler = table[pc]
+            if opclass == 0b10 and subtype == 0b011:  # POP
+                handler = self.guard(handler)
+            elif opclass == 0b10 and subtype == 0b110:  # RFT
+                handler = self.gate(handler)
+            elif not (kind in (BRANCH, RET, INDIRECT) or (kind == CALL and target is None)):
+                continue
+            table[pc] = self.probe(pc, handler)
+            self.probes.add(pc)
+
+    def probe(self, pc, body):
+        counts = self.counts
+        base = pc << 8
+
+        def probed():
+            nxt = body()
+            if nxt is not None:
+                counts[base | nxt] = counts.get(base | nxt, 0) + 1
+            return nxt
+
+        return probed
+
+    def guard(self, body):
+        vm = self.vm
+
+        def pop():
+            if not vm.sp:
+                raise PopEmpty
+            return body()
+
+        return pop
+
+    def gate(self, body):
+        # Raising leaves the PC on the RFT and the step count exact, so
+        # execute() can checkpoint the machine and resume it.
+        source, checkpoints = self.source, self.checkpoints
+
+        def rft():
+            pos = source.pos
+            if source.data[:pos] not in checkpoints:
+                raise Pause
+            if pos >= len(source.data):
+                raise Starved
+            return body()
+
+        return rft
+
+    def dictionary(self):
+        # Bytes likely to matter: immediates the program computes and
+        # compares with, and every byte its RFT formats accept.
+        words = set(INTERESTING)
+        for pc in range(self.size):
+            opclass, subtype, imm1, imm2, op1, op2, _ = decode(self.program[pc * 4 : pc * 4 + 4])
+            if opclass in (0b00, 0b01):
+                words.update(val for val, imm in ((op1, imm1), (op2, imm2)) if imm)
+            elif opclass == 0b10 and subtype == 0b110 and op2 & 0x3:
+                words.update(byte for byte in range(256) if RFT_TABLE[op2 & 0x3][byte] != INVALID)
+        return sorted(words)
+
+    # Execution
+    def execute(self, data):
+        # Runs the program on data from the longest checkpointed prefix.
+        vm, source, checkpoints, counts = self.vm, self.source, self.checkpoints, self.counts
+        (snap, taken), pos = self.start, 0
+        for n in range(len(data), -1, -1):
+            if data[:n] in checkpoints:
+                checkpoints.move_to_end(data[:n])
+                (snap, taken), pos = checkpoints[data[:n]], n
+                break
+        vm.restore(snap)
+        counts.clear()
+        counts.update(taken)
+        source.data, source.pos = data, pos
+        kind = None
+        while kind is None:
+            try:
+                vm.run(self.max_steps - vm.steps, detect_loops=True)
+                kind = vm.exit_reason
+            except Pause:
+                checkpoints[data[: source.pos]] = (vm.snapshot(), dict(counts))
+                if len(checkpoints) > CHECKPOINTS:
+                    checkpoints.popitem(last=False)
+            except Starved:
+                kind = "starved"
+            except PopEmpty:
+                kind = "pop-empty"
+        pc = vm.loop[0] if kind == "loop" else vm.state[vm.PC]
+        seen = self.seen
+        fresh = []
+        for edge, n in counts.items():
+            bucket = BUCKETS[min(n, 255)]
+            if not seen[edge] & bucket:
+                fresh.append((edge, bucket))
+        return Result(kind, pc, vm.steps, source.pos, fresh)
+
+    def test(self, data):
+        # Executes data and files it under the corpus, crashes or slowest.
+        self.execs += 1
+        result = self.execute(data)
+        for edge, bucket in result.fresh:
+            self.seen[edge] |= bucket
+        if result.kind in self.crash_kinds:
+            key = (result.kind, result.pc)
+            if key not in self.crashes or len(data) < len(self.crashes[key]):
+                self.crashes[key] = data
+        elif result.fresh and result.kind != "budget":
+            self.corpus.append(data[: result.read])
+            self.found.append((data[: result.read], result.fresh))
+        if result.steps > self.slowest[0]:
+            self.slowest = (result.steps, data)
+        return result
+
+    def seed(self, inputs=()):
+        for data in (b"", *inputs):
+            self.test(bytes(data[: self.max_len]))
+        if not self.corpus:
+            self.corpus.append(b"")
+
+    # Mutation
+    def byte(self):
+        rng = self.rng
+        if rng.random() < 0.5:
+            return rng.choice(self.words)
+        return rng.randrange(256)
+
+    def mutate(self, data):
+        rng = self.rng
+        data = bytearray(data)
+        for _ in range(1 << rng.randrange(3)):
+            op = rng.randrange(7)
+            pos = rng.randrange(len(data)) if data else 0
+            if op == 0 or not data:  # more input
+                data += bytes(self.byte() for _ in range(rng.randint(1, 4)))
+            elif op == 1:
+                data[pos] ^= 1 << rng.randrange(8)
+            elif op == 2:
+                data[pos] = self.byte()
+            elif op == 3:
+                data.insert(pos, self.byte())
+            elif op == 4:
+                del data[pos : pos + rng.randint(1, 4)]
+            elif op == 5:  # a new ending
+                data[pos:] = bytes(self.byte() for _ in range(rng.randint(1, 4)))
+            else:  # splice with another corpus entry
+                other = rng.choice(self.corpus)
+                data[pos:] = other[rng.randrange(len(other) + 1) :]
+        return bytes(data[: self.max_len])
+
+    def fuzz(self, runs=None, seconds=None):
+        # Tests mutated corpus entries until runs executions or seconds have
+        # passed.
+        deadline = None if seconds is None else time.perf_counter() + seconds
+        rng, corpus = self.rng, self.corpus
+        n = 0
+        while runs is None or n < runs:
+            if deadline is not None and n % 64 == 0 and time.perf_counter() >= deadline:
+                break
+            self.test(self.mutate(rng.choice(corpus)))
+            n += 1
+
+    def minimize(self, data, keep):
+        # Shrinks data while keep(result) still holds: first to the bytes
+        # it reads, then by dropping ever smaller chunks.
+        result = self.execute(data)
+        data = data[: result.read]
+        chunk = len(data) // 2
+        while chunk:
+            i = 0
+            while i < len(data):
+                candidate = data[:i] + data[i + chunk :]
+                self.execs += 1
+                if keep(self.execute(candidate)):
+                    data = candidate
+                else:
+                    i += chunk
+            chunk //= 2
+        return data
+
+    # Pools
+    def take(self):
+        # Everything found since the last take(), for merge() in another
+        # process.
+        found, crashes, slowest, execs = self.found, self.crashes, self.slowest, self.execs
+        self.found, self.crashes, self.slowest, self.execs = [], {}, (0, b""), 0
+        return found, crashes, slowest, execs, bytes(self.seen)
+
+    def sync(self, corpus, seen):
+        self.corpus[:] = corpus
+        self.seen[:] = seen
+
+    def merge(self, found, crashes, slowest, execs, seen):
+        for data, fresh in found:
+            new = [(edge, bucket) for edge, bucket in fresh if not self.seen[edge] & bucket]
+            for edge, bucket in new:
+                self.seen[edge] |= bucket
+            if new:
+                self.corpus.append(data)
+                self.found.append((data, new))
+        # Coverage only crashing inputs reached.
+        self.seen[:] = (int.from_bytes(self.seen, "big") | int.from_bytes(seen, "big")).to_bytes(len(seen), "big")
+        for key, data in crashes.items():
+            if key not in self.crashes or len(data) < len(self.crashes[key]):
+                self.crashes[key] = data
+        self.slowest = max(self.slowest, slowest)
+        self.execs += execs
+
+    # Reporting
+    def covered(self):
+        # PCs reached: the entry and every edge's target, followed through
+        # straight-line code up to the next probe.
+        todo = [0] + [edge & 0xFF for edge in range(len(self.seen)) if self.seen[edge]]
+        done = set()
+        while todo:
+            pc = todo.pop()
+            while pc < self.size and pc not in done:
+                done.add(pc)
+                kind, target = self.effects[pc]
+                if pc in self.probes:
+                    break
+                if kind == NEXT:
+                    pc += 1
+                elif kind in (JUMP, CALL):
+                    pc = target
+                else:
+                    break
+        return done
+
+    def edges(self):
+        return len(self.seen) - self.seen.count(0)
+
+    def status(self, elapsed):
+        return (
+            f"#{self.execs} {self.execs / max(elapsed, 1e-9):.0f}/s: {self.edges()} edges, "
+            f"{len(self.covered())}/{self.size} PCs, corpus {len(self.corpus)}, crashes {len(self.crashes)}"
+        )
+
+    def where(self, pc):
+        text = self.vm.where(pc)
+        return f"PC {pc:02X}" + (f" {text}" if text else "")
+
+
+_worker = None
+
+
+def start_worker(program, options):
+    global _worker
+    _worker = Fuzzer(program, **options)
+
+
+def fuzz_round(args):
+    seed, corpus, seen, runs, seconds = args
+    _worker.rng.seed(seed)
+    _worker.sync(corpus, seen)
+    _worker.fuzz(runs, seconds)
+    return _worker.take()
+
+
+def main():
+    import argparse
+
+    from batch import load_program
+    from sourcemap import load_for
+
+    parser = argparse.ArgumentParser(description="Coverage-guided fuzzing of a Mini-8 program's RFT input")
+    parser.add_argument("program", help="Binary or .m8a source to fuzz")
+    parser.add_argument("--time", type=float, default=10.0, help="Seconds to fuzz for (default: 10)")
+    parser.add_argument("--runs", type=int, help="Stop after this many executions")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Worker processes (default: 1)")
+    parser.add_argument("--seed", type=int, help="Random seed, for reproducible runs")
+    parser.add_argument("--max-steps", type=int, default=MAX_STEPS, help="Instructions per input before it hangs")
+    parser.add_argument("--max-len", type=int, default=MAX_LEN, help="Longest input to try")
+    parser.add_argument("--slow", type=int, default=SLOW, help="Report inputs running at least this many instructions")
+    parser.add_argument("--ignore", action="append", default=[], choices=sorted(CRASHES), help="Crash kind to ignore")
+    parser.add_argument("--corpus", help="Directory of seed inputs; new corpus entries are written back to it")
+    parser.add_argument("--artifacts", help="Directory to write minimized crashing and slow inputs to")
+    args = parser.parse_args()
+
+    image, _ = load_program(args.program)
+    options = {"max_steps": args.max_steps, "max_len": args.max_len, "ignore": args.ignore}
+    source_map = load_for(args.program, image.program) or image.source_map()
+    fuzzer = Fuzzer(image.program, seed=args.seed, source_map=source_map, **options)
+    seeds = []
+    if args.corpus and os.path.isdir(args.corpus):
+        for name in sorted(os.listdir(args.corpus)):
+            with open(os.path.join(args.corpus, name), "rb") as f:
+                seeds.append(f.read())
+    fuzzer.seed(seeds)
+
+    rng = random.Random(args.seed)
+    pool = Pool(args.jobs, start_worker, (image.program, options)) if args.jobs > 1 else None
+    start = time.perf_counter()
+    try:
+        while args.runs is None or fuzzer.execs < args.runs:
+            elapsed = time.perf_counter() - start
+            if elapsed >= args.time:
+                break
+            seconds = min(ROUND, args.time - elapsed)
+            runs = None if args.runs is None else args.runs - fuzzer.execs
+            if pool is None:
+                fuzzer.fuzz(runs, seconds)
+            else:
+                runs = None if runs is None else max(1, runs // args.jobs)
+                jobs = [
+                    (rng.getrandbits(64), fuzzer.corpus, bytes(fuzzer.seen), runs, seconds) for _ in range(args.jobs)
+                ]
+                for found in pool.imap_unordered(fuzz_round, jobs):
+                    fuzzer.merge(*found)
+            print(fuzzer.status(time.perf_counter() - start), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.perf_counter() - start
+
+    processes = f"{args.jobs} processes" if args.jobs > 1 else "1 process"
+    print(f"{fuzzer.execs} executions in {elapsed:.1f}s ({fuzzer.execs / max(elapsed, 1e-9):.0f}/s) on {processes}")
+    print(f"Coverage: {fuzzer.edges()} edges, {len(fuzzer.covered())}/{fuzzer.size} PCs")
+    print(f"Corpus: {len(fuzzer.corpus)} inputs")
+    findings = []
+    for (kind, pc), data in sorted(fuzzer.crashes.items()):
+        data = fuzzer.minimize(data, lambda r, kind=kind, pc=pc: (r.kind, r.pc) == (kind, pc))
+        findings.append((f"crash-{kind}-{pc:02X}", f"Crash: {CRASHES[kind]} at {fuzzer.where(pc)}", data))
+    steps, data = fuzzer.slowest
+    if steps >= args.slow:
+        data = fuzzer.minimize(data, lambda r: r.steps >= steps)
+        hang = " (budget exhausted)" if steps >= args.max_steps else ""
+        findings.append(("slow", f"Slow: {steps} instructions{hang}", data))
+    for _, text, data in findings:
+        print(f"{text}: input {data!r}")
+    if not findings:
+        print(f"No crashes; the slowest input ran {steps} instructions")
+
+    if args.corpus:
+        os.makedirs(args.corpus, exist_ok=True)
+        for data in fuzzer.corpus:
+            with open(os.path.join(args.corpus, hashlib.sha1(data).hexdigest()), "wb") as f:
+                f.write(data)
+    if args.artifacts:
+        os.makedirs(args.artifacts, exist_ok=True)
+        for name, _, data in findings:
+            with open(os.path.join(args.artifacts, name), "wb") as f:
+                f.write(data)
+    sys.exit(1 if fuzzer.crashes else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import asyncio
+import contextlib
+import io
+import sys
+import time
+
+import container
+from terminal import BytesSource, MemorySink
+from vm import ENGINES, MiniMachineVM
+
+# Instructions a session runs per scheduling slice before yielding to others.
+QUANTUM = 10_000
+
+# Seconds an idle session, one only polling RFT for input that hasn't
+# arrived, waits between slices.
+IDLE = 0.05
+
+# Seconds a finished session keeps reading after sending EOF, so input the
+# program never consumed doesn't make the close reset the connection and
+# discard output the client has yet to read.
+LINGER = 1.0
+
+
+class QueueSource:
+    """Per-session input, fed from the network.
+
+    read() never blocks: with nothing queued it reports an empty buffer, as
+    the ISA requires, and marks the session as starved. A starved session
+    keeps running as long as it makes progress. Once a whole slice changes
+    nothing but the PC and writes nothing, the host only runs it every IDLE
+    seconds until feed() delivers more input, so a program polling RFT costs
+    next to nothing while its user is idle.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.ready = asyncio.Event()
+        self.starved = False
+        self.closed = False  # no more input will arrive
+
+    def feed(self, data):
+        self.buffer += data
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    def pending(self):
+        return self.pos < len(self.buffer)
+
+    async def wait(self):
+        await self.ready.wait()
+
+    def read(self):
+        if self.pos >= len(self.buffer):
+            self.buffer.clear()
+            self.pos = 0
+            self.ready.clear()
+            self.starved = True
+            return None
+        byte = self.buffer[self.pos]
+        self.pos += 1
+        return byte
+
+    def release(self):
+        pass
+
+
+class StreamSink:
+    """Per-session output, written to the session's transport.
+
+    WRT output collects in memory and goes out whenever the VM flushes, which
+    it does before every RFT and at the end of each slice; the host then
+    awaits the writer so a slow client holds back only its own session.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.buffer = bytearray()
+        self.written = 0  # bytes, ever
+
+    def write(self, data):
+        self.buffer += data
+        self.written += len(data)
+
+    def flush(self):
+        if self.buffer and not self.writer.is_closing():
+            self.writer.write(bytes(self.buffer))
+        self.buffer.clear()
+
+
+class Session:
+    """One connected client running its own copy of the program."""
+
+    def __init__(self, host, number, vm, source, writer):
+        self.host = host
+        self.number = number
+        self.vm = vm
+        self.source = source
+        self.writer = writer
+        self.started = time.perf_counter()
+        self.idle = None  # machine state, less the PC, after the last starved slice
+
+    async def run(self):
+        # Run the VM a quantum at a time, backing off while it only polls for input.
+        vm, source, host = self.vm, self.source, self.host
+        while not vm.halted:
+            quantum = host.quantum
+            if host.max_steps is not None:
+                quantum = min(quantum, host.max_steps - vm.steps)
+                if quantum <= 0:
+                    break
+            source.starved = False
+            written = vm.output.written
+            vm.run(quantum)
+            await self.writer.drain()
+            if vm.halted or self.writer.is_closing():
+                break
+            if source.starved and not source.pending():
+                # A slice that only polled leaves the machine as it was.
+                state = (bytes(vm.state[: vm.PC]), bytes(vm.state[vm.PC + 1 :]), vm.sp)
+                idle = state == self.idle and vm.output.written == written
+                self.idle = state
+                if idle and not source.closed:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(source.wait(), IDLE)
+                if source.closed and not source.pending():
+                    break
+            else:
+                self.idle = None
+            await asyncio.sleep(0)  # let the other sessions run
+
+    async def pump(self, reader):
+        # Forward everything the client sends into the session's input.
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                self.source.feed(data)
+        except ConnectionError:
+            pass
+        self.source.close()
+
+
+class Host:
+    """Serves a Mini-8 program to many clients from one event loop.
+
+    Every connection gets a fork of one template VM, so the program is
+    decoded (or JIT-compiled) once however many sessions are open. Sessions
+    take turns running QUANTUM instructions at a time; a session that only
+    polls RFT for input that hasn't arrived runs a slice every IDLE seconds
+    until its client sends something.
+    """
+
+    def __init__(self, program, engine="table", quantum=QUANTUM, max_steps=None, log=None):
+        self.template = MiniMachineVM(program, engine=engine, output=MemorySink(), input_source=BytesSource())
+        self.quantum = quantum
+        self.max_steps = max_steps
+        self.log = log
+        self.sessions = {}
+        self.count = 0
+
+    def note(self, text):
+        if self.log is not None:
+            print(text, file=self.log, flush=True)
+
+    async def handle(self, reader, writer):
+        self.count += 1
+        source = QueueSource()
+        vm = self.template.fork(output=StreamSink(writer), input_source=source)
+        session = self.sessions[self.count] = Session(self, self.count, vm, source, writer)
+        self.note(f"session {session.number}: connected ({len(self.sessions)} open)")
+        pump = asyncio.ensure_future(session.pump(reader))
+        try:
+            await session.run()
+        except ConnectionError:
+            pass
+        finally:
+            del self.sessions[session.number]
+            reason = "disconnected" if source.closed and not vm.halted else vm.exit_reason
+            elapsed = time.perf_counter() - session.started
+            self.note(f"session {session.number}: {reason} after {vm.steps} instructions, {elapsed:.1f}s")
+            with contextlib.suppress(ConnectionError, asyncio.TimeoutError):
+                if writer.can_write_eof() and not writer.is_closing():
+                    writer.write_eof()
+                    await asyncio.wait_for(asyncio.shield(pump), LINGER)
+            pump.cancel()
+            with contextlib.suppress(ConnectionError):
+                writer.close()
+                await writer.wait_closed()
+
+    async def serve_tcp(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        self.note(f"Listening on {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        async with server:
+            await server.serve_forever()
+
+    async def serve_unix(self, path):
+        server = await asyncio.start_unix_server(self.handle, path)
+        self.note(f"Listening on {path}")
+        async with server:
+            await server.serve_forever()
+
+
+def load(path):
+    if path.endswith(".m8a"):
+        from assembler import assemble
+
+        with open(path) as f:
+            lines = f.readlines()
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                return b"".join(assemble(lines, path=path))
+        except SystemExit:
+            sys.stderr.write(log.getvalue())  # the assembler reports errors on stdout
+            raise
+    return container.load(path).program
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a Mini-8 program to many clients over TCP or a Unix socket")
+    parser.add_argument("program", help="Binary or .m8a source to run for each connection")
+    parser.add_argument("--tcp", metavar="[HOST:]PORT", help="Listen on a TCP port (default: 127.0.0.1:8088)")
+    parser.add_argument("--unix", metavar="PATH", help="Listen on a Unix socket instead")
+    parser.add_argument("--engine", choices=ENGINES, default="table")
+    parser.add_argument("--quantum", type=int, default=QUANTUM, help="Instructions per scheduling slice")
+    parser.add_argument("--max-steps", type=int, help="Instruction budget per session")
+    args = parser.parse_args()
+
+    host = Host(load(args.program), args.engine, args.quantum, args.max_steps, log=sys.stderr)
+    if args.unix:
+        serve = host.serve_unix(args.unix)
+    else:
+        addr, _, port = (args.tcp or "127.0.0.1:8088").rpartition(":")
+        serve = host.serve_tcp(addr or "127.0.0.1", int(port))
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+import hashlib
+import marshal
+import os
+import sys
+
+from terminal import WRT_TABLE
+from vm import RAM_BASE, STACK_BASE, STACK_SIZE
+
+# Bump whenever the generated code changes shape, so stale cache entries are ignored.
+CACHE_VERSION = 6
+
+RAMDATA = f"mem[{RAM_BASE} + r4]"  # r5: the RAM byte r4 points at
+
+ALU_EXPRS = (
+    "({a} & {b})",  # AND
+    None,  # ROR, see rotate_expr()
+    "(({a} + {b}) & 255)",  # ADD
+    "({a} ^ {b})",  # XOR
+    "({a} | {b})",  # OR
+    None,  # ROL, see rotate_expr()
+    "(({a} - {b}) & 255)",  # SUB
+    "({a} ^ 255)",  # NOT
+)
+
+COND_OPS = (None, "!=", ">=", ">", None, "==", "<", "<=")
+
+
+def cache_dir():
+    return os.environ.get("MINI8_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "mini8", "jit"
+    )
+
+
+def program_key(program, leaders):
+    # Leaders decide where blocks start, so a program saved with its own
+    # (see container.py) caches separately from one using find_leaders().
+    h = hashlib.sha256()
+    h.update(f"{CACHE_VERSION}:{sys.implementation.cache_tag}:".encode())
+    h.update(program)
+    h.update(bytes(sorted(leaders)))
+    return h.hexdigest()
+
+
+def decode(instr):
+    opcode, op1, op2, dest = instr
+    imm1 = (opcode >> 6) & 1
+    imm2 = (opcode >> 5) & 1
+    opclass = (opcode >> 3) & 0x3
+    subtype = opcode & 0x7
+    return opclass, subtype, imm1, imm2, op1, op2, dest
+
+
+def find_leaders(program):
+    # Block boundaries: the entry point, every COND jump target, every
+    # immediate CALL target and every return site (the instruction after a CALL,
+    # since POP r7 resumes at the pushed PC + 1).
+    n = min(len(program) // 4, 256)
+    leaders = {0}
+    for pc in range(n):
+        opclass, subtype, imm1, imm2, op1, op2, dest = decode(program[pc * 4 : pc * 4 + 4])
+        if opclass == 0b01 and subtype != 0b100:
+            leaders.add(dest)
+        elif opclass == 0b10 and subtype == 0b101:
+            if imm1:
+                leaders.add(op1)
+            leaders.add((pc + 1) % 256)
+        elif opclass == 0b10 and subtype == 0b000 and imm1 and dest & 0x7 == 7:
+            leaders.add((op1 + 1) % 256)
+    return {pc for pc in leaders if pc < n}
+
+
+def rotate_expr(a, b, left):
+    if b.isdigit():
+        s = int(b) % 8
+        if s == 0:
+            return a
+        lo, hi = (8 - s, s) if left else (s, 8 - s)
+        return f"((({a} >> {lo}) | ({a} << {hi})) & 255)"
+    if left:
+        return f"((({a} << ({b} % 8)) | ({a} >> (8 - ({b} % 8)))) & 255)"
+    return f"((({a} >> ({b} % 8)) | ({a} << (8 - ({b} % 8)))) & 255)"
+
+
+class BlockTranslator:
+    """Translates one basic block into the source of a Python function.
+
+    Registers r0-r6 and the stack pointer live in locals for the whole block and
+    are written back to the VM only at block exits. r5 is the exception: it
+    reads and writes RAM directly, at the address in the r4 local. Every exit returns the next PC, or None once
+    the machine has halted, matching the handlers built by MiniMachineVM.decode().
+    Exits also add the number of instructions executed to ctr[0], and a block
+    that loops on itself stops at its entry once ctr[0] would reach ctr[1].
+    """
+
+    def __init__(self, program, entry, leaders):
+        self.program = program
+        self.entry = entry
+        self.leaders = leaders
+        self.n = min(len(program) // 4, 256)
+        self.used = set()
+        self.written = set()
+        self.body = []
+        self.looped = False
+        self.uses_stack = False
+        self.count = 0
+
+    def operand(self, val, is_imm, pc):
+        if is_imm:
+            return str(val)
+        r = val & 0x7
+        if r == 7:
+            return str(pc)
+        if r == 5:
+            self.used.add(4)
+            return RAMDATA
+        self.used.add(r)
+        return f"r{r}"
+
+    def emit(self, depth, line):
+        self.body.append((depth, line))
+
+    def emit_exit(self, depth, target, count=None):
+        # Writebacks are filled in once the whole block has been translated.
+        self.body.append((depth, ("exit", target, self.count if count is None else count)))
+
+    def translate(self):
+        pc = self.entry
+        while True:
+            if self.translate_instr(pc):
+                break
+            pc = (pc + 1) % 256
+            if pc >= self.n or pc in self.leaders or pc == 0:
+                self.emit_exit(0, str(pc))
+                break
+        return self.render()
+
+    def translate_instr(self, pc):
+        # Returns True if the instruction ends the block.
+        opclass, subtype, imm1, imm2, op1, op2, dest = decode(self.program[pc * 4 : pc * 4 + 4])
+        d = dest & 0x7
+        nxt = (pc + 1) % 256
+        self.count += 1
+
+        if opclass == 0b00:  # ALU
+            a = self.operand(op1, imm1, pc)
+            b = "0" if subtype == 0b111 else self.operand(op2, imm2, pc)
+            if subtype in (0b001, 0b101):
+                expr = rotate_expr(a, b, subtype == 0b101)
+            else:
+                expr = ALU_EXPRS[subtype].format(a=a, b=b)
+            return self.store(pc, d, expr)
+
+        if opclass == 0b01:  # COND
+            if subtype == 0b100:  # NOP
+                return False
+            if subtype == 0b000:  # JMP
+                self.jump(0, dest)
+                return True
+            a = self.operand(op1, imm1, pc)
+            b = self.operand(op2, imm2, pc)
+            self.emit(0, f"if {a} {COND_OPS[subtype]} {b}:")
+            self.jump(1, dest)
+            return False
+
+        if opclass == 0b10:  # IO
+            if subtype == 0b000:  # MOV
+                return self.store(pc, d, self.operand(op1, imm1, pc))
+            if subtype == 0b001:  # SWAP
+                idx1 = op1 & 0x7
+                if idx1 == 6 or d == 6 or idx1 == d:
+                    return False
+                if 5 in (idx1, d):
+                    return self.swap_ram(pc, d if idx1 == 5 else idx1)
+                if idx1 == 7 or d == 7:
+                    other = d if idx1 == 7 else idx1
+                    self.used.add(other)
+                    self.written.add(other)
+                    self.emit(0, f"t = r{other}")
+                    self.emit(0, f"r{other} = {pc}")
+                    self.emit_exit(0, "(t + 1) & 255")
+                    return True
+                self.used.update((idx1, d))
+                self.written.update((idx1, d))
+                self.emit(0, f"r{idx1}, r{d} = r{d}, r{idx1}")
+                return False
+            if subtype == 0b010:  # PUSH
+                self.push(pc, self.operand(op1, imm1, pc))
+                return False
+            if subtype == 0b011:  # POP
+                self.uses_stack = True
+                self.emit(0, "if sp:")
+                self.emit(1, "sp -= 1")
+                if d == 7:
+                    self.emit(1, f"t = mem[{STACK_BASE} + sp]")
+                    self.emit_exit(1, "(t + 1) & 255")
+                    self.emit_exit(0, str(nxt))
+                    return True
+                if d == 5:
+                    self.used.add(4)
+                    self.emit(1, f"{RAMDATA} = mem[{STACK_BASE} + sp]")
+                elif d != 6:
+                    self.used.add(d)
+                    self.written.add(d)
+                    self.emit(1, f"r{d} = mem[{STACK_BASE} + sp]")
+                return False
+            if subtype == 0b100:  # WRT
+                fmt = op2 & 0x3
+                if imm1 and not (fmt == 0 and op1 == 0):
+                    self.emit(0, f"write({WRT_TABLE[fmt][op1]!r})")
+                else:
+                    self.emit(0, f"wrt({self.operand(op1, imm1, pc)}, {fmt})")
+                return False
+            if subtype == 0b101:  # CALL
+                target = self.operand(op1, imm1, pc)
+                self.push(pc, str(pc))
+                self.emit_exit(0, target)
+                return True
+            if subtype == 0b110:  # RFT
+                return self.store(pc, d, f"rft({op2 & 0x3})", pure=False)
+            # HCF
+            self.emit_exit(0, ("halt", pc))
+            return True
+
+        # Reserved opclass: the reference path neither executes nor advances.
+        self.emit_exit(0, str(pc))
+        return True
+
+    def store(self, pc, d, expr, pure=True):
+        if d == 6:
+            if not pure:
+                self.emit(0, expr)
+            return False
+        if d == 7:
+            self.emit(0, f"t = {expr}")
+            self.emit_exit(0, "(t + 1) & 255")
+            return True
+        if d == 5:
+            self.used.add(4)
+            self.emit(0, f"{RAMDATA} = {expr}")
+            return False
+        self.used.add(d)
+        self.written.add(d)
+        self.emit(0, f"r{d} = {expr}")
+        return False
+
+    def swap_ram(self, pc, other):
+        # SWAP of r5 with another register. The address is taken first, as
+        # swapping with r4 changes it.
+        self.used.add(4)
+        self.emit(0, f"k = {RAM_BASE} + r4")
+        if other == 7:
+            self.emit(0, "t = mem[k]")
+            self.emit(0, f"mem[k] = {pc}")
+            self.emit_exit(0, "(t + 1) & 255")
+            return True
+        self.used.add(other)
+        self.written.add(other)
+        self.emit(0, f"r{other}, mem[k] = mem[k], r{other}")
+        return False
+
+    def push(self, pc, expr):
+        # A full stack halts the machine at this instruction.
+        self.uses_stack = True
+        self.emit(0, f"if sp == {STACK_SIZE}:")
+        self.emit_exit(1, ("overflow", pc))
+        self.emit(0, f"mem[{STACK_BASE} + sp] = {expr}")
+        self.emit(0, "sp += 1")
+
+    def jump(self, depth, target):
+        if target == self.entry:
+            self.looped = True
+            self.emit(depth, f"n += {self.count}")
+            self.emit(depth, "if ctr[0] + n >= ctr[1]:")
+            self.emit_exit(depth + 1, str(self.entry), 0)
+            self.emit(depth, "continue")
+        else:
+            self.emit_exit(depth, str(target))
+
+    def render(self):
+        name = f"b_{self.entry}"
+        lines = [f"    def {name}():"]
+        base = 2
+        for r in sorted(self.used):
+            lines.append(f"        r{r} = mem[{r}]")
+        if self.uses_stack:
+            lines.append("        sp = vm.sp")
+        if self.looped:
+            lines.append("        n = 0")
+            lines.append("        while True:")
+            base = 3
+        for depth, line in self.body:
+            ind = "    " * (base + depth)
+            if isinstance(line, str):
+                lines.append(ind + line)
+                continue
+            _, target, count = line
+            for r in sorted(self.written):
+                lines.append(f"{ind}mem[{r}] = r{r}")
+            if self.uses_stack:
+                lines.append(f"{ind}vm.sp = sp")
+            if self.looped:
+                # Completed iterations are already counted in n.
+                count = f"n + {count}"
+            lines.append(f"{ind}ctr[0] += {count}")
+            if isinstance(target, tuple):  # ("halt" or "overflow", pc)
+                lines.append(f"{ind}mem[7] = {target[1]}")
+                if target[0] == "overflow":
+                    lines.append(f"{ind}vm.overflow = True")
+                lines.append(f"{ind}vm.halted = True")
+                lines.append(f"{ind}return None")
+            else:
+                lines.append(f"{ind}return {target}")
+        return name, lines
+
+
+def translate_unit(program, entries, leaders):
+    src = ["def make(mem, wrt, write, rft, vm, ctr):"]
+    names = []
+    for entry in sorted(entries):
+        name, lines = BlockTranslator(program, entry, leaders).translate()
+        src.extend(lines)
+        names.append((entry, name))
+    src.append("    return {" + ", ".join(f"{pc}: {name}" for pc, name in names) + "}")
+    return "\n".join(src) + "\n"
+
+
+class JitCompiler:
+    """Compiles a program into basic-block closures, caching code objects on disk."""
+
+    def __init__(self, program, use_cache=True, leaders=None):
+        # leaders, if given, are find_leaders() results saved with the program.
+        self.program = bytes(program)
+        self.n = min(len(self.program) // 4, 256)
+        self.leaders = find_leaders(self.program) if leaders is None else leaders
+        self.use_cache = use_cache
+        self.path = os.path.join(cache_dir(), program_key(self.program, self.leaders) + ".jit")
+        self.units = (self.load() if use_cache else None) or []
+        self.dirty = False
+        if not self.units and self.leaders:  # an empty program has no blocks
+            self.units = [self.compile_unit(self.leaders)]
+            self.dirty = True
+
+    def compile_unit(self, entries):
+        src = translate_unit(self.program, entries, self.leaders)
+        return compile(src, f"<mini8-jit {sorted(entries)[0]}>", "exec")
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                units = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return units if isinstance(units, list) else None
+
+    def save(self):
+        if not (self.use_cache and self.dirty):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                marshal.dump(self.units, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError:
+            pass
+
+    def bind(self, vm, halt_handler):
+        # Build a 256-entry dispatch table over vm's state. PCs with no
+        # compiled block get a stub that translates one on first use.
+        args = (vm.state, vm.wrt, vm.output.write, vm.rft, vm, vm.ctr)
+        table = [None] * 256
+        for code in self.units:
+            ns = {}
+            exec(code, ns)
+            for pc, fn in ns["make"](*args).items():
+                table[pc] = fn
+        for pc in range(256):
+            if table[pc] is None:
+                table[pc] = halt_handler(pc) if pc >= self.n else self.stub(table, pc, args)
+        return table
+
+    def stub(self, table, pc, args):
+        def miss():
+            code = self.compile_unit({pc})
+            self.units.append(code)
+            self.dirty = True
+            ns = {}
+            exec(code, ns)
+            fn = ns["make"](*args)[pc]
+            table[pc] = fn
+            return fn()
+
+        return miss
@@ -0,0 +1,426 @@
+import contextlib
+import io
+import json
+import os
+import pathlib
+import sys
+import urllib.parse
+
+from assembler import LABEL_RE, OPCODES, REGISTERS, handle_shorthand_op, include_target, parse_value, tokenize_line
+
+LIMIT = 256  # programs must stay under this many instructions
+
+ERROR, WARNING = 1, 2
+
+
+class Line:
+    """One source line, parsed from its own text alone.
+
+    kind is None for blank lines, or "const", "macro", "end", "label",
+    "include" or "instr". name and span locate the defined symbol, the
+    included file or the mnemonic, and
+    args holds (text, start, end) for each operand. Anything that depends on
+    other lines is left to Document.analyze().
+    """
+
+    __slots__ = ("kind", "name", "span", "args", "tokens", "problems")
+
+    def __init__(self, kind=None, name=None, span=None, args=(), tokens=(), problems=()):
+        self.kind = kind
+        self.name = name
+        self.span = span
+        self.args = args
+        self.tokens = tokens
+        self.problems = problems  # (severity, start, end, message)
+
+
+def parse_line(text):
+    # Mirrors assembler.Parser, using the assembler's own lexer.
+    toks = tokenize_line(text)
+    if not toks:
+        return Line()
+    tokens = [(t.text, t.col, t.col + len(t.text)) for t in toks]
+    head = toks[0]
+    if head.text == "include":
+        try:
+            include_target(toks, None)
+        except ValueError:
+            return Line("include", None, tokens[0][1:], tokens=tokens, problems=((ERROR, *tokens[0][1:], 'Invalid include, expected include "file"'),))
+        return Line("include", toks[1].text[1:-1], tokens[1][1:], tokens=tokens)
+    if head.text == "define":
+        if len(toks) < 2 or toks[1].kind != "name":
+            return Line("instr", "DEFINE", tokens[0][1:], tokens=tokens, problems=((ERROR, *tokens[0][1:], "Invalid define"),))
+        name = toks[1].text
+        span = tokens[1][1:]
+        rest = tokens[2:]
+        if rest and rest[0][0] == "(":
+            close = next((k for k, t in enumerate(rest) if t[0] == ")"), len(rest) - 1)
+            rest = rest[close + 1 :]
+        if rest and rest[0][0] == ":":
+            return Line("macro", name.upper(), span, tokens=tokens)
+        problems = () if len(rest) == 1 else ((ERROR, *span, f"Invalid value for {name}"),)
+        return Line("const", name, span, rest[:1], tokens, problems)
+    if head.text == "end" and len(toks) == 1:
+        return Line("end", tokens=tokens)
+    k = 0
+    while k + 1 < len(toks) and toks[k].kind == "name" and toks[k + 1].text == ":":
+        k += 2
+    ops = tokens[k:]
+    if not ops:
+        return Line()
+    mnemonic, start, end = ops[0]
+    if mnemonic.upper() == "LABEL":
+        if len(ops) == 3 and ops[2][0] == ":":
+            ops = ops[:2]
+        if len(ops) != 2 or toks[k + 1].kind != "name":
+            return Line("instr", "LABEL", (start, end), tokens=tokens, problems=((ERROR, start, end, "Invalid LABEL definition"),))
+        return Line("label", ops[1][0], ops[1][1:], tokens=tokens)
+    args = []
+    problems = []
+    for tok, t in zip(toks[k + 1 :], ops[1:]):
+        if tok.text == ",":
+            continue
+        if tok.kind in ("punct", "error"):
+            problems.append((ERROR, t[1], t[2], f"Unexpected {tok.text!r}"))
+        else:
+            args.append(t)
+    mnemonic = mnemonic.upper()
+    if mnemonic in OPCODES:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            filled = handle_shorthand_op(mnemonic, [a[0] for a in args])
+        if out.getvalue():
+            problems.append((WARNING, start, end, out.getvalue().strip().removeprefix("Warning: ")))
+        if len(filled) < 3:
+            problems.append((ERROR, start, end, f"Not enough arguments for {mnemonic}"))
+    return Line("instr", mnemonic, (start, end), args, tokens, problems)
+
+
+def uri_path(uri):
+    parsed = urllib.parse.urlparse(uri)
+    return urllib.parse.unquote(parsed.path) if parsed.scheme == "file" else None
+
+
+_included = {}  # path -> (mtime, parsed lines)
+
+
+def read_lines(path):
+    # The parsed lines of an included file, re-read when it changes on disk.
+    mtime = os.stat(path).st_mtime_ns
+    cached = _included.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _included[path] = (mtime, [parse_line(t) for t in f.read().split("\n")])
+    return cached[1]
+
+
+def diagnostic(line, start, end, message, severity=ERROR):
+    return {
+        "range": {"start": {"line": line, "character": start}, "end": {"line": line, "character": end}},
+        "severity": severity,
+        "source": "mini8",
+        "message": message,
+    }
+
+
+class Document:
+    """The parsed lines of one open source file.
+
+    Edits re-parse only the lines they touch; analyze() then rebuilds the
+    symbol tables and diagnostics from the cached per-line results without
+    running any regexes or expanding any macros.
+    """
+
+    def __init__(self, uri, text):
+        self.uri = uri
+        self.path = uri_path(uri)
+        self.texts = text.split("\n")
+        self.lines = [parse_line(t) for t in self.texts]
+        self.labels = {}
+        self.constants = {}
+        self.macros = {}
+
+    def change(self, start, end, text):
+        # Apply an edit given as (line, character) positions.
+        (l1, c1), (l2, c2) = start, end
+        new = (self.texts[l1][:c1] + text + self.texts[l2][c2:]).split("\n")
+        self.texts[l1 : l2 + 1] = new
+        self.lines[l1 : l2 + 1] = [parse_line(t) for t in new]
+
+    def set_text(self, text):
+        self.texts = text.split("\n")
+        self.lines = [parse_line(t) for t in self.texts]
+
+    def include(self, lines, path, uri, seen, diags, out):
+        # Appends (uri, line number, Line) for lines, with included files
+        # spliced in as the assembler does. uri is None for this document.
+        for i, line in enumerate(lines):
+            if line.kind != "include":
+                out.append((uri, i, line))
+                continue
+            if line.name is None:
+                if uri is None:
+                    for severity, s, e, message in line.problems:
+                        diags.append(diagnostic(i, s, e, message, severity))
+                continue
+            target = os.path.abspath(os.path.join(os.path.dirname(path or ""), line.name))
+            if target in seen:
+                continue
+            seen.add(target)
+            try:
+                included = read_lines(target)
+            except OSError as e:
+                if uri is None:
+                    diags.append(diagnostic(i, *line.span, f"Can't include {line.name}: {e.strerror}"))
+                continue
+            self.include(included, target, pathlib.Path(target).as_uri(), seen, diags, out)
+        return out
+
+    def analyze(self):
+        # Returns (diagnostics, instruction count). Symbols and instructions
+        # from included files count, but only this document's problems are
+        # reported.
+        diags = []
+        seen = {os.path.abspath(self.path)} if self.path else set()
+        entries = self.include(self.lines, self.path, None, seen, diags, [])
+        labels, constants, macros = {}, {}, {}  # name -> (uri, line number, Line)
+        bodies = {}
+        top = []
+        current = None  # macro whose body is being collected
+        for entry in entries:
+            uri, i, line = entry
+            kind = line.kind
+            if kind is None:
+                continue
+            if current is not None:
+                if kind == "end":
+                    current = None
+                    continue
+                if kind not in ("const", "macro"):
+                    bodies[current].append(line)
+                    if kind == "label":
+                        labels.setdefault(line.name, entry)
+                    continue
+                current = None
+            if kind == "const":
+                constants[line.name] = entry
+            elif kind == "macro":
+                macros[line.name] = entry
+                bodies[line.name] = []
+                current = line.name
+            elif kind == "end":
+                if uri is None:
+                    s, e = line.tokens[0][1:]
+                    diags.append(diagnostic(i, s, e, "'end' outside a macro"))
+            else:
+                top.append(entry)
+
+        for entry in top:
+            uri, i, line = entry
+            if line.kind == "label":
+                if line.name in labels and labels[line.name] != entry:
+                    if uri is None:
+                        diags.append(diagnostic(i, *line.span, f"Label '{line.name}' already defined"))
+                else:
+                    labels[line.name] = entry
+        self.labels, self.constants, self.macros = labels, constants, macros
+
+        for uri, i, line in constants.values():
+            if uri is None:
+                for severity, s, e, message in line.problems:
+                    diags.append(diagnostic(i, s, e, message, severity))
+                self.check_args(i, line.args, diags)
+
+        sizes = {}
+        count = 0
+        too_long = False
+        for uri, i, line in top:
+            if line.kind != "instr":
+                continue
+            report = diags if uri is None else []
+            for severity, s, e, message in line.problems:
+                report.append(diagnostic(i, s, e, message, severity))
+            if line.name in macros:
+                count += self.macro_size(line.name, bodies, sizes, set(), diags)
+            elif line.name in OPCODES:
+                count += 1
+                self.check_args(i, line.args[:3], report)
+            elif line.name != "LABEL":
+                report.append(diagnostic(i, *line.span, f"Unknown mnemonic: {line.name}"))
+            if count >= LIMIT and not too_long and uri is None:
+                too_long = True
+                diags.append(diagnostic(i, *line.span, f"Program is too long, must be under {LIMIT} instructions"))
+        return diags, count
+
+    def check_args(self, i, args, diags):
+        for arg, s, e in args:
+            if arg in REGISTERS or arg in self.constants or arg in self.labels:
+                continue
+            if LABEL_RE.match(arg):
+                # Another module may define it when the program is linked.
+                diags.append(diagnostic(i, s, e, f"Undefined label: {arg}", WARNING))
+                continue
+            try:
+                parse_value(arg, {})
+            except ValueError:
+                diags.append(diagnostic(i, s, e, f"Unknown value: {arg or '(empty)'}"))
+
+    def macro_size(self, name, bodies, sizes, active, diags):
+        # Instructions one use of the macro expands to.
+        if name in sizes:
+            return sizes[name]
+        if name in active:
+            uri, i, line = self.macros[name]
+            if uri is None:
+                diags.append(diagnostic(i, *line.span, f"Macro {name} expands itself"))
+            return 0
+        active.add(name)
+        size = 0
+        for line in bodies[name]:
+            if line.kind != "instr":
+                continue
+            if line.name in bodies:
+                size += self.macro_size(line.name, bodies, sizes, active, diags)
+            elif line.name != "LABEL":
+                size += 1
+        active.discard(name)
+        sizes[name] = size
+        return size
+
+    def definition(self, line, character):
+        # Returns (uri, line, start, end) of the symbol under the cursor, if any.
+        if line >= len(self.lines):
+            return None
+        for text, s, e in self.lines[line].tokens:
+            if s <= character <= e:
+                break
+        else:
+            return None
+        text = text.strip(":")
+        for table, name in ((self.labels, text), (self.constants, text), (self.macros, text.upper())):
+            if name in table:
+                uri, target, found = table[name]
+                return (uri or self.uri, target, *found.span)
+        return None
+
+
+class Server:
+    """A Language Server Protocol server over a pair of binary streams."""
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.docs = {}
+        self.running = True
+
+    def read(self):
+        length = None
+        while True:
+            header = self.rfile.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.decode("ascii").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return json.loads(self.rfile.read(length))
+
+    def send(self, payload):
+        body = json.dumps(payload).encode()
+        self.wfile.write(f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        self.wfile.flush()
+
+    def notify(self, method, params):
+        self.send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def serve(self):
+        while self.running:
+            msg = self.read()
+            if msg is None:
+                break
+            method = msg.get("method")
+            handler = getattr(self, "on_" + (method or "").replace("/", "_").replace("$", ""), None)
+            if "id" not in msg:
+                # Notifications have no reply to carry an error, so a bad one
+                # is logged to the client instead of stopping the server.
+                if handler is not None:
+                    try:
+                        handler(msg.get("params") or {})
+                    except Exception as e:
+                        self.notify("window/logMessage", {"type": 1, "message": f"{method}: {type(e).__name__}: {e}"})
+                continue
+            if handler is None:
+                self.send({"jsonrpc": "2.0", "id": msg["id"], "error": {"code": -32601, "message": f"Unknown method {method}"}})
+                continue
+            try:
+                result = handler(msg.get("params") or {})
+            except Exception as e:
+                self.send({"jsonrpc": "2.0", "id": msg["id"], "error": {"code": -32603, "message": f"{type(e).__name__}: {e}"}})
+                continue
+            self.send({"jsonrpc": "2.0", "id": msg["id"], "result": result})
+
+    def publish(self, doc):
+        diags, count = doc.analyze()
+        self.notify("textDocument/publishDiagnostics", {"uri": doc.uri, "diagnostics": diags})
+        self.notify("mini8/instructionCount", {"uri": doc.uri, "count": count, "limit": LIMIT})
+
+    def on_initialize(self, params):
+        return {
+            "capabilities": {
+                "textDocumentSync": {"openClose": True, "change": 2},  # incremental
+                "definitionProvider": True,
+            },
+            "serverInfo": {"name": "mini8-langserver"},
+        }
+
+    def on_shutdown(self, params):
+        return None
+
+    def on_exit(self, params):
+        self.running = False
+
+    def on_textDocument_didOpen(self, params):
+        item = params["textDocument"]
+        doc = self.docs[item["uri"]] = Document(item["uri"], item["text"])
+        self.publish(doc)
+
+    def on_textDocument_didChange(self, params):
+        doc = self.docs.get(params["textDocument"]["uri"])
+        if doc is None:
+            return
+        for change in params["contentChanges"]:
+            if "range" not in change:
+                doc.set_text(change["text"])
+                continue
+            start, end = change["range"]["start"], change["range"]["end"]
+            doc.change((start["line"], start["character"]), (end["line"], end["character"]), change["text"])
+        self.publish(doc)
+
+    def on_textDocument_didClose(self, params):
+        uri = params["textDocument"]["uri"]
+        self.docs.pop(uri, None)
+        self.notify("textDocument/publishDiagnostics", {"uri": uri, "diagnostics": []})
+
+    def on_textDocument_definition(self, params):
+        uri = params["textDocument"]["uri"]
+        pos = params["position"]
+        if uri not in self.docs:
+            return None
+        found = self.docs[uri].definition(pos["line"], pos["character"])
+        if found is None:
+            return None
+        uri, line, start, end = found
+        return {
+            "uri": uri,
+            "range": {"start": {"line": line, "character": start}, "end": {"line": line, "character": end}},
+        }
+
+
+def main():
+    Server(sys.stdin.buffer, sys.stdout.buffer).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+
+from assembler import LABEL_RE, Label, encode, include_target, parse, place_labels, tokenize_line, where
+
+# Bump whenever the object format or the encoding changes, so stale cache
+# entries are rebuilt.
+VERSION = 1
+
+LIMIT = 256  # linked programs must stay under this many instructions
+
+TOOLCHAIN = None  # see toolchain_tag()
+
+
+def cache_dir():
+    return os.environ.get("MINI8_OBJ_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "mini8", "obj"
+    )
+
+
+class ObjectFile:
+    """One separately assembled source file, ready to be linked.
+
+    code holds the encoded instructions, with every operand that names a
+    label left as 0 and listed in relocs as (instruction, slot, label), slot
+    1-3 being the byte to patch. symbols maps the labels the module defines
+    to instruction indexes. Labels are global: a module may refer to any
+    label another one defines.
+
+    lines has the (file, line, macro chain) source of each instruction for
+    the linked program's source map, with None for the module's own file.
+    Saved as JSON, as .m8o files and in the object cache.
+    """
+
+    def __init__(self, source, code=b"", symbols=None, relocs=(), lines=()):
+        self.source = source
+        self.code = bytes(code)
+        self.symbols = symbols or {}
+        self.relocs = list(relocs)
+        self.lines = list(lines)
+
+    def __len__(self):
+        return len(self.code) // 4
+
+    def to_json(self):
+        return {
+            "version": VERSION,
+            "source": self.source,
+            "code": self.code.hex(),
+            "symbols": self.symbols,
+            "relocs": [list(r) for r in self.relocs],
+            "lines": [[file, line, [list(frame) for frame in chain]] for file, line, chain in self.lines],
+        }
+
+    def save(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.to_json(), f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            raise ValueError(f"Unsupported object file version: {data.get('version')}")
+        return cls(
+            data["source"],
+            bytes.fromhex(data["code"]),
+            data["symbols"],
+            [tuple(r) for r in data["relocs"]],
+            [(file, line, tuple(tuple(frame) for frame in chain)) for file, line, chain in data["lines"]],
+        )
+
+
+def assemble_object(lines, path, optimize=False, public=True):
+    # Like assembler.assemble(), but leaves labels to the linker. Without
+    # public, the optimizer may drop code only other modules could reach.
+    constants, ir = parse(lines, path, optimize, public)
+    symbols = place_labels(ir)
+    placeholders = {**constants, **{name: 0 for name in symbols}}
+    code = bytearray()
+    relocs = []
+    sources = []
+    for item in ir:
+        if isinstance(item, Label):
+            continue
+        index = len(sources)
+        for slot, arg in enumerate(item.args, 1):
+            if arg in symbols or (arg not in constants and LABEL_RE.match(arg)):
+                relocs.append((index, slot, arg))
+                placeholders.setdefault(arg, 0)
+        code += encode(item, placeholders)
+        sources.append((item.file, item.line, item.chain))
+    return ObjectFile(path, code, symbols, relocs, sources)
+
+
+def sources(path, seen=None):
+    # (name, contents) of path and every file it includes, directly or not,
+    # in the order the assembler reads them. Bad includes are left for the
+    # assembler to report.
+    seen = set() if seen is None else seen
+    seen.add(os.path.abspath(path))
+    with open(path) as f:
+        text = f.read()
+    result = [(path, text)]
+    for n, line in enumerate(text.splitlines(), 1):
+        if "include" not in line:
+            continue
+        tokens = tokenize_line(line, n)
+        if tokens and tokens[0].text == "include":
+            try:
+                target = include_target(tokens, path)
+                if os.path.abspath(target) not in seen:
+                    result.extend(sources(target, seen))
+            except (OSError, ValueError):
+                pass
+    return result
+
+
+def toolchain_tag():
+    # A hash of the assembler's and linker's own source, so editing either
+    # one retires every object it built without a VERSION bump.
+    global TOOLCHAIN
+    if TOOLCHAIN is None:
+        h = hashlib.sha256()
+        for module in ("assembler.py", "linker.py"):
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), "rb") as f:
+                h.update(f.read())
+        TOOLCHAIN = h.hexdigest()[:16]
+    return TOOLCHAIN
+
+
+def module_key(files, optimize, public):
+    h = hashlib.sha256()
+    h.update(f"{VERSION}:{toolchain_tag()}:{int(optimize)}:{int(public)}:".encode())
+    for name, text in files:
+        h.update(f"{len(name)}:{name}:{len(text)}:".encode())
+        h.update(text.encode())
+    return h.hexdigest()
+
+
+def build(path, optimize=False, use_cache=True, public=True):
+    # The object for one source file, from the cache when neither it nor
+    # anything it includes has changed since it was last assembled.
+    files = sources(path)
+    cached = os.path.join(cache_dir(), module_key(files, optimize, public) + ".m8o")
+    if use_cache:
+        try:
+            return ObjectFile.load(cached)
+        except (OSError, ValueError, KeyError):
+            pass
+    obj = assemble_object(files[0][1].splitlines(keepends=True), path, optimize, public)
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            obj.save(cached)
+        except OSError:
+            pass
+    return obj
+
+
+def link(objects, source_map=None):
+    # Places the modules one after another, the first at PC 0, and patches
+    # every label reference. Returns the instructions like assemble() does.
+    addresses = {}
+    owners = {}
+    base = 0
+    for obj in objects:
+        for name, index in obj.symbols.items():
+            if name in addresses:
+                raise ValueError(f"Label '{name}' defined in both {owners[name]} and {obj.source}")
+            addresses[name] = base + index
+            owners[name] = obj.source
+            if source_map is not None:
+                source_map.add_label(name, base + index)
+        base += len(obj)
+    if base >= LIMIT:
+        raise ValueError(f"Program is too long, {base} instructions, must be under {LIMIT}")
+
+    output = []
+    for obj in objects:
+        code = bytearray(obj.code)
+        for index, slot, name in obj.relocs:
+            if name not in addresses:
+                file, line, _ = obj.lines[index]
+                raise ValueError(f"Undefined label: {name} ({where(file or obj.source, line)})")
+            code[index * 4 + slot] = addresses[name] & 0xFF
+        output.extend(code[i : i + 4] for i in range(0, len(code), 4))
+        if source_map is not None:
+            for file, line, chain in obj.lines:
+                chain = tuple((name, f or obj.source, n) for name, f, n in chain)
+                source_map.add(line, chain, file or obj.source)
+    pc = len(output)
+    print(f"Program is {pc}/256 ({hex(pc).upper()}/0xFF) instructions long")
+    return output
@@ -0,0 +1,231 @@
+from collections import OrderedDict
+
+from cfg import CFG
+from jit import decode
+from vm import STACK_BASE, STACK_SIZE
+
+MEMO_SIZE = 4096  # cached calls, across all subroutines
+
+# Instructions a missed call may run before it is given up on and left to
+# finish in the dispatch loop, so subroutines that never return don't stall
+# run(). A missed call also stops where the run's budget runs out.
+MEMO_LIMIT = 1 << 14
+
+
+class Pure:
+    """A subroutine whose result depends only on some of its registers.
+
+    A call reads the registers in inputs before writing them, changes only
+    those in outputs, and at its deepest has depth values above the return
+    address on the stack. It never does I/O, never touches RAM (r4/r5), and
+    returns with POP r7 to the instruction after the CALL.
+    """
+
+    __slots__ = ("entry", "inputs", "outputs", "depth")
+
+    def __init__(self, entry, inputs, outputs, depth):
+        self.entry = entry
+        self.inputs = inputs
+        self.outputs = outputs
+        self.depth = depth
+
+
+def reads(instr):
+    # Registers an instruction reads, other than r6 (always 0) and r7 (its PC).
+    opclass, subtype, imm1, imm2, op1, op2, dest = decode(instr)
+    regs = set()
+    if opclass == 0b00 or (opclass == 0b01 and subtype not in (0b000, 0b100)):
+        if not imm1:
+            regs.add(op1 & 0x7)
+        if not imm2 and not (opclass == 0b00 and subtype == 0b111):
+            regs.add(op2 & 0x7)
+    elif opclass == 0b10 and subtype in (0b000, 0b010, 0b101) and not imm1:
+        regs.add(op1 & 0x7)
+    elif opclass == 0b10 and subtype == 0b001:
+        regs.update((op1 & 0x7, dest & 0x7))
+    return regs - {6, 7}
+
+
+def find_pure(cfg):
+    # Returns {entry: Pure} for the CALL targets in cfg that qualify, callees
+    # before callers. Recursive subroutines never qualify.
+    pure = {}
+    state = {}
+    for entry in cfg.subs:
+        check(cfg, entry, pure, state)
+    return pure
+
+
+def check(cfg, entry, pure, state):
+    if entry in state:
+        return state[entry]
+    state[entry] = None  # in progress, so recursion fails below
+    sub = cfg.subs[entry]
+    # Only ever entered by CALLs with an immediate target, so the JIT has a
+    # block starting here and the return address is always on the stack.
+    ok = entry != 0 and all(
+        kind == "call" and cfg.program[(cfg.blocks[b].end - 1) * 4] & 0x40 for kind, b in cfg.blocks[entry].preds
+    )
+    for b in sorted(sub.blocks) if ok else ():
+        block = cfg.blocks[b]
+        if block.exit in ("halt", "end") or any(kind == "indirect" for kind, _ in block.succs):
+            ok = False
+            break
+        for pc in range(block.start, block.end):
+            instr = cfg.instr(pc)
+            opclass, subtype = decode(instr)[:2]
+            if opclass == 0b11 or (opclass == 0b10 and subtype in (0b100, 0b110, 0b111)):
+                ok = False  # reserved, WRT, RFT or HCF
+            elif 5 in reads(instr) or 5 in cfg.instr_writes(pc):
+                ok = False  # RAM
+            elif opclass == 0b10 and subtype == 0b101:
+                target = cfg.effects[pc][1]
+                ok = target in cfg.subs and check(cfg, target, pure, state) is not None
+        if not ok:
+            break
+    depth = stack_depth(cfg, sub, pure) if ok else None
+    if depth is not None:
+        pure[entry] = state[entry] = Pure(entry, live_in(cfg, sub, pure), sorted(sub.clobbers), depth)
+    return state[entry]
+
+
+def stack_depth(cfg, sub, pure):
+    # The deepest the subroutine takes the stack above its return address, or
+    # None unless every path keeps the same depth at each block, never pops
+    # the return address except to return through it, and returns at depth 0.
+    into = {sub.entry: 0}
+    todo = [sub.entry]
+    deepest = 0
+    while todo:
+        b = todo.pop()
+        depth = into[b]
+        block = cfg.blocks[b]
+        for pc in range(block.start, block.end):
+            opclass, subtype, _, _, _, _, dest = decode(cfg.instr(pc))
+            if opclass != 0b10:
+                continue
+            if subtype == 0b010:  # PUSH
+                depth += 1
+            elif subtype == 0b011:  # POP
+                if (dest & 0x7 == 7) != (depth == 0):
+                    return None
+                depth -= 1
+            elif subtype == 0b101:  # CALL
+                deepest = max(deepest, depth + 1 + pure[cfg.effects[pc][1]].depth)
+            deepest = max(deepest, depth)
+        for t in cfg.intra_succs(b):
+            if t not in into:
+                into[t] = depth
+                todo.append(t)
+            elif into[t] != depth:
+                return None
+    return deepest
+
+
+def live_in(cfg, sub, pure):
+    # Registers some path through the subroutine reads before writing.
+    uses, defs = {}, {}
+    for b in sub.blocks:
+        block = cfg.blocks[b]
+        use, written = set(), set()
+        for pc in range(block.start, block.end):
+            kind, target = cfg.effects[pc]
+            read = pure[target].inputs if kind == "call" else reads(cfg.instr(pc))
+            use |= set(read) - written
+            written |= cfg.instr_writes(pc)
+        uses[b], defs[b] = use, written
+    live = {b: set() for b in sub.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for b in sub.blocks:
+            out = set().union(*(live[t] for t in cfg.intra_succs(b)))
+            new = uses[b] | (out - defs[b])
+            if new != live[b]:
+                live[b] = new
+                changed = True
+    return sorted(live[sub.entry])
+
+
+class Memo:
+    """Caches the results of calls to pure subroutines.
+
+    On a call it looks up the subroutine's input registers in a shared LRU
+    of size entries. A hit writes the recorded outputs, pops the return
+    address and resumes after the CALL, without running the body. A miss
+    runs the body as usual and records what it left behind. With exact_steps,
+    a hit also adds the instructions the body took when it was recorded to
+    the step count, so counts match an unmemoized run; without, a hit counts
+    as one instruction.
+    """
+
+    def __init__(self, program, size=MEMO_SIZE, exact_steps=True):
+        self.pure = find_pure(CFG(program))
+        self.cache = OrderedDict()  # (entry, *inputs) -> (outputs, steps)
+        self.size = size
+        self.exact_steps = exact_steps
+        self.hits = 0
+        self.misses = 0
+
+    def wrap(self, vm, table):
+        # Replace the handlers at pure entry points of a table or JIT dispatch
+        # table built for vm.
+        for entry, sub in self.pure.items():
+            table[entry] = self.handler(vm, table, table[entry], sub)
+
+    def handler(self, vm, table, body, sub):
+        cache = self.cache
+        mem = vm.state
+        ctr = vm.ctr
+        jit = vm.engine == "jit"
+        entry, inputs, outputs, depth = sub.entry, sub.inputs, sub.outputs, sub.depth
+        exact = self.exact_steps
+
+        # JIT blocks count themselves into ctr[0]. Under run_counted(), the
+        # dispatch loop counts this handler as one step once it returns, and
+        # it counts any more itself.
+        pending = 0 if jit else 1
+
+        def memoized():
+            key = (entry, *[mem[r] for r in inputs])
+            hit = cache.get(key)
+            if hit is not None and exact and ctr[0] + hit[1] > ctr[1]:
+                hit = None  # it would overrun the budget; run the body instead
+            if hit is not None and vm.sp + depth <= STACK_SIZE:
+                cache.move_to_end(key)
+                self.hits += 1
+                values, steps = hit
+                for r, v in zip(outputs, values):
+                    mem[r] = v
+                vm.sp = sp = vm.sp - 1
+                target = mem[STACK_BASE + sp]
+                mem[7] = target
+                ctr[0] += (steps if exact else 1) - pending
+                return (target + 1) & 255
+
+            self.misses += 1
+            base = vm.sp
+            start = ctr[0]
+            n = 1
+            pc = body()
+            while pc is not None and vm.sp >= base:
+                if n == MEMO_LIMIT or ctr[0] + pending >= ctr[1]:
+                    break  # the dispatch loop carries on from pc
+                nxt = table[pc]()
+                if not jit and (nxt is not None or pc < vm.size):
+                    ctr[0] += 1
+                pc = nxt
+                n += 1
+            if pc is not None and vm.sp < base:
+                cache[key] = (bytes(mem[r] for r in outputs), ctr[0] - start + pending)
+                if len(cache) > self.size:
+                    cache.popitem(last=False)
+            return pc
+
+        return memoized
+
+    def report(self, source_map=None):
+        names = ", ".join(
+            (source_map.label(entry) if source_map is not None else None) or f"{entry:02X}" for entry in sorted(self.pure)
+        )
+        return f"Memoized {len(self.pure)} subroutines ({names or 'none'}): {self.hits} hits, {self.misses} misses"
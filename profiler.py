@@ -0,0 +1,122 @@
+import json
+
+CLASS_NAMES = ("ALU", "COND", "IO", "reserved")
+
+# Instruction kinds that run_profile() does extra bookkeeping for.
+JUMP, CALL, PUSH, POP = 1, 2, 3, 4
+
+
+class Profile:
+    """Per-PC statistics collected by MiniMachineVM.run_profile().
+
+    counts[pc] is how often each instruction executed, and taken[pc] how often
+    a jump at pc branched. calls maps each CALL target to [calls, inclusive
+    instructions], where a call lasts until the stack drops back below the
+    return address it pushed. With a source map, reports also give the source
+    line and nearest label of each PC.
+    """
+
+    def __init__(self, program, source_map=None):
+        self.program = bytes(program)
+        self.source_map = source_map
+        self.size = min(len(self.program) // 4, 256)
+        self.counts = [0] * 256
+        self.taken = [0] * 256
+        self.calls = {}
+        self.max_depth = 0
+        self.kinds = [None] * 256
+        self.targets = [None] * 256
+        for pc in range(self.size):
+            opcode, _, _, dest = self.program[pc * 4 : pc * 4 + 4]
+            opclass = (opcode >> 3) & 0x3
+            subtype = opcode & 0x7
+            if opclass == 0b01 and subtype != 0b100:
+                self.kinds[pc] = JUMP
+                self.targets[pc] = dest
+            elif opclass == 0b10 and subtype == 0b101:
+                self.kinds[pc] = CALL
+            elif opclass == 0b10 and subtype == 0b010:
+                self.kinds[pc] = PUSH
+            elif opclass == 0b10 and subtype == 0b011:
+                self.kinds[pc] = POP
+
+    def instr(self, pc):
+        return self.program[pc * 4 : pc * 4 + 4]
+
+    def opclass(self, pc):
+        return CLASS_NAMES[(self.program[pc * 4] >> 3) & 0x3]
+
+    def source(self, pc):
+        # Source fields for the JSON report.
+        if self.source_map is None:
+            return {}
+        loc = self.source_map.location(pc)
+        if loc is None:
+            return {}
+        file, line, chain = loc
+        info = {"file": file, "line": line}
+        label = self.source_map.label(pc)
+        if label:
+            info["label"] = label
+        if chain:
+            info["macros"] = [{"name": name, "file": f, "line": n} for name, f, n in chain]
+        return info
+
+    def total(self):
+        return sum(self.counts)
+
+    def to_json(self, disassemble):
+        classes = dict.fromkeys(CLASS_NAMES, 0)
+        for pc in range(self.size):
+            classes[self.opclass(pc)] += self.counts[pc]
+        return {
+            "steps": self.total(),
+            "instructions": [
+                {"pc": pc, "count": self.counts[pc], "disasm": disassemble(self.instr(pc)), **self.source(pc)}
+                for pc in range(self.size)
+                if self.counts[pc]
+            ],
+            "classes": classes,
+            "jumps": [
+                {
+                    "pc": pc,
+                    "target": self.targets[pc],
+                    "taken": self.taken[pc],
+                    "not_taken": self.counts[pc] - self.taken[pc],
+                }
+                for pc in range(self.size)
+                if self.kinds[pc] == JUMP and self.counts[pc]
+            ],
+            "calls": [
+                {"target": target, "calls": calls, "instructions": inclusive, **self.source(target)}
+                for target, (calls, inclusive) in sorted(self.calls.items(), key=lambda kv: -kv[1][1])
+            ],
+            "max_stack_depth": self.max_depth,
+        }
+
+    def write_json(self, path, disassemble):
+        with open(path, "w") as f:
+            json.dump(self.to_json(disassemble), f, indent=2)
+            f.write("\n")
+
+    def listing(self, disassemble):
+        # The disassembly with execution counts, jump outcomes and call costs.
+        total = self.total() or 1
+        lines = [f"{'addr':>4}  {'count':>10}  {'%':>6}  instruction"]
+        for pc in range(self.size):
+            count = self.counts[pc]
+            hex_instr = " ".join(f"{b:02X}" for b in self.instr(pc))
+            line = f"{pc:02X}:  {count:>10}  {100 * count / total:6.2f}  {hex_instr}  {disassemble(self.instr(pc))}"
+            notes = []
+            if pc in self.calls:
+                calls, inclusive = self.calls[pc]
+                notes.append(f"<- {calls} calls, {inclusive} instructions inclusive")
+            if self.kinds[pc] == JUMP and count:
+                notes.append(f"taken {self.taken[pc]}, not taken {count - self.taken[pc]}")
+            if self.source_map is not None:
+                notes.append(self.source_map.describe(pc))
+            if notes:
+                line += "  ; " + "; ".join(notes)
+            lines.append(line)
+        lines.append(f"{self.total()} instructions, max stack depth {self.max_depth}")
+        return "\n".join(lines)
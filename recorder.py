@@ -0,0 +1,281 @@
+import struct
+import sys
+
+from jit import decode
+from vm import RAM_BASE, STACK_BASE, STACK_SIZE, STATE_SIZE, MiniMachineVM
+
+VERSION = 1
+MAGIC = b"M8TR"
+HEADER = struct.Struct("<4sBxxxIIQHBBB3x")  # magic, version, program size, entries, steps, sp, pc, halted, overflow
+
+CAPACITY = 1 << 20  # entries; 4 MiB
+
+# What an instruction changes besides the PC, see Trace.
+NONE, REG, SWAP, PUSH, POP = range(5)
+
+# Entry flags.
+MOVED = 1  # the push or pop happened
+HALTED = 2  # the machine halted on this instruction
+
+
+class Trace:
+    """A ring buffer of the last `capacity` instructions a VM executed.
+
+    Each entry is 4 bytes: the PC, flags, and the old and new value of
+    whatever the instruction changed. Which register or stack slot that was
+    follows from the instruction itself: a register for ALU, MOV and RFT
+    (old and new value), both registers for SWAP (their old values), the
+    stack slot for PUSH and CALL (old and pushed value), and for POP the
+    destination's old value and the popped one. That is enough to undo
+    entries one at a time back to the oldest one kept, and to redo them
+    again, without re-executing anything; input read by RFT comes from the
+    trace, so replay needs no input source. r5 stands for the RAM byte r4
+    points at, see cell(); a SWAP with r5 keeps the other register first.
+
+    Entries first..end are kept, with pos the number applied to the VM's
+    current state. Recording starts at pos, dropping any undone entries.
+    """
+
+    def __init__(self, program, capacity=CAPACITY):
+        self.program = bytes(program)
+        self.capacity = capacity
+        self.buf = bytearray(capacity * 4)
+        self.end = 0  # entries recorded, including those overwritten
+        self.pos = 0
+        self.final = None  # (pc, halted, overflow) after the last entry
+        self.kinds = [NONE] * 256
+        self.ra = [0] * 256
+        self.rb = [0] * 256
+        for pc in range(min(len(self.program) // 4, 256)):
+            self.kinds[pc], self.ra[pc], self.rb[pc] = self.classify(self.program[pc * 4 : pc * 4 + 4])
+
+    @staticmethod
+    def classify(instr):
+        opclass, subtype, _, _, op1, _, dest = decode(instr)
+        d = dest & 0x7
+        if opclass == 0b00 or (opclass == 0b10 and subtype in (0b000, 0b110)):  # ALU, MOV, RFT
+            return (REG, d, 0) if d < 6 else (NONE, 0, 0)
+        if opclass == 0b10 and subtype == 0b001:  # SWAP
+            a = op1 & 0x7
+            if a == 6 or d == 6 or a == d:
+                return NONE, 0, 0
+            if 7 in (a, d):  # the other register gets the PC
+                return REG, d if a == 7 else a, 0
+            return (SWAP, d, a) if a == 5 else (SWAP, a, d)
+        if opclass == 0b10 and subtype in (0b010, 0b101):  # PUSH, CALL
+            return PUSH, 0, 0
+        if opclass == 0b10 and subtype == 0b011:
+            return POP, d if d < 6 else 6, 0  # r6 reads as 0, so the old value is 0
+        return NONE, 0, 0
+
+    @staticmethod
+    def cell(state, r):
+        # Where register r's value is kept in the VM's state.
+        return RAM_BASE + state[4] if r == 5 else r
+
+    @property
+    def first(self):
+        return max(0, self.end - self.capacity)
+
+    def __len__(self):
+        return self.end - self.first
+
+    def entry(self, i):
+        # (pc, flags, old, new) of entry i, counted from the start of recording.
+        k = (i % self.capacity) * 4
+        return tuple(self.buf[k : k + 4])
+
+    def before(self, pc, state, sp):
+        # The value the instruction at pc may overwrite.
+        kind = self.kinds[pc]
+        if kind == PUSH:
+            return state[STACK_BASE + sp] if sp < STACK_SIZE else 0
+        return state[self.cell(state, self.ra[pc])] if kind != NONE else 0
+
+    def record(self, pc, old, sp, vm):
+        # Append the entry for the instruction at pc, given the value before()
+        # returned and the stack pointer before it ran.
+        kind = self.kinds[pc]
+        state = vm.state
+        flags = HALTED if vm.halted else 0
+        new = 0
+        if kind == REG or kind == SWAP:
+            new = state[self.cell(state, self.ra[pc])]
+        elif kind == PUSH and vm.sp > sp:
+            flags |= MOVED
+            new = state[STACK_BASE + sp]
+        elif kind == POP and vm.sp < sp:
+            flags |= MOVED
+            new = state[STACK_BASE + vm.sp]
+        k = (self.end % self.capacity) * 4
+        self.buf[k : k + 4] = bytes((pc, flags, old, new))
+        self.end += 1
+        self.pos = self.end
+
+    def truncate(self):
+        # Forget entries that were undone, before recording over them.
+        self.end = self.pos
+
+    def finish(self, vm):
+        self.final = vm.state[vm.PC], vm.halted, vm.overflow
+
+    def undo(self, vm):
+        # Step vm back over the last applied entry. Returns False at the
+        # oldest entry kept.
+        if self.pos <= self.first:
+            return False
+        self.pos -= 1
+        pc, flags, old, new = self.entry(self.pos)
+        kind, ra, rb = self.kinds[pc], self.ra[pc], self.rb[pc]
+        state = vm.state
+        if kind == REG:
+            state[self.cell(state, ra)] = old
+        elif kind == SWAP:
+            state[ra] = old  # ra is never r5, so r4 is restored before RAM is addressed
+            state[self.cell(state, rb)] = new
+        elif kind == PUSH and flags & MOVED:
+            vm.sp -= 1
+            state[STACK_BASE + vm.sp] = old
+        elif kind == POP and flags & MOVED:
+            state[STACK_BASE + vm.sp] = new
+            vm.sp += 1
+            if ra < 6:
+                state[self.cell(state, ra)] = old
+        state[vm.PC] = pc
+        vm.steps -= 1
+        vm.halted = vm.overflow = False
+        vm.exit_reason = None
+        return True
+
+    def redo(self, vm):
+        # Step vm forward over the next recorded entry. Returns False once
+        # vm is back at the end of the trace.
+        if self.pos >= self.end:
+            return False
+        pc, flags, old, new = self.entry(self.pos)
+        self.pos += 1
+        kind, ra, rb = self.kinds[pc], self.ra[pc], self.rb[pc]
+        state = vm.state
+        if kind == REG:
+            state[self.cell(state, ra)] = new
+        elif kind == SWAP:
+            k = self.cell(state, rb)
+            state[ra], state[k] = new, old
+        elif kind == PUSH and flags & MOVED:
+            state[STACK_BASE + vm.sp] = new
+            vm.sp += 1
+        elif kind == POP and flags & MOVED:
+            vm.sp -= 1
+            if ra < 6:
+                state[self.cell(state, ra)] = new
+        vm.steps += 1
+        if self.pos < self.end:
+            state[vm.PC] = self.entry(self.pos)[0]
+        else:
+            state[vm.PC], vm.halted, vm.overflow = self.final
+        if flags & HALTED:
+            state[vm.PC] = pc
+            vm.halted = True
+            vm.overflow = kind == PUSH and not flags & MOVED
+        if vm.halted:
+            vm.exit_reason = "overflow" if vm.overflow else "end" if state[vm.PC] >= vm.size else "halt"
+        return True
+
+    def save(self, path, vm):
+        # The kept entries oldest first, with the program and the machine
+        # state after the last of them, so the run can be stepped back
+        # offline. A vm that is replaying is moved to the end first.
+        while self.redo(vm):
+            pass
+        start, stop = (self.first % self.capacity) * 4, (self.end % self.capacity) * 4
+        if not len(self):
+            entries = b""
+        elif start < stop:
+            entries = self.buf[start:stop]
+        else:
+            entries = self.buf[start:] + self.buf[:stop]
+        pc, halted, overflow = self.final or (vm.state[vm.PC], vm.halted, vm.overflow)
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.program), len(entries) // 4, vm.steps, vm.sp, pc, halted, overflow))
+            f.write(self.program)
+            f.write(vm.state)
+            f.write(entries)
+
+    @classmethod
+    def load(cls, path, capacity=None):
+        # Returns (trace, vm), with vm in the state the trace ends in.
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, size, count, steps, sp, pc, halted, overflow = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a Mini-8 trace")
+        if version != VERSION:
+            raise ValueError(f"Unsupported trace version: {version}")
+        offset = HEADER.size
+        program = data[offset : offset + size]
+        state = data[offset + size : offset + size + STATE_SIZE]
+        entries = data[offset + size + STATE_SIZE :]
+        if len(entries) != count * 4:
+            raise ValueError(f"{path} is truncated")
+        trace = cls(program, max(capacity or count, 1))
+        trace.buf[: len(entries)] = entries
+        trace.end = trace.pos = count
+        trace.final = pc, bool(halted), bool(overflow)
+        vm = MiniMachineVM(program, engine="table")
+        vm.restore((state, sp, bool(halted), bool(overflow), steps))
+        vm.state[vm.PC] = pc
+        vm.trace = trace
+        return trace, vm
+
+
+def main():
+    import argparse
+
+    import sourcemap
+
+    parser = argparse.ArgumentParser(description="Inspect a trace saved by vm.py --trace")
+    parser.add_argument("trace", help="Trace file")
+    parser.add_argument("--last", type=int, default=20, help="Entries to list (default: 20)")
+    parser.add_argument("--map", help="Source map for the traced program")
+    parser.add_argument("--debug", action="store_true", help="Step back through the trace in the debugger")
+    args = parser.parse_args()
+
+    trace, vm = Trace.load(args.trace)
+    if args.map:
+        vm.source_map = sourcemap.SourceMap.load(args.map)
+        if not vm.source_map.matches(trace.program):
+            parser.error(f"{args.map} is the source map of a different program")
+    if args.debug:
+        from debugger import Debugger
+
+        Debugger(vm).repl()
+        return
+    start = max(trace.first, trace.end - args.last)
+    for i in range(start, trace.end):
+        pc, flags, old, new = trace.entry(i)
+        step = vm.steps - (trace.end - i)
+        instr = trace.program[pc * 4 : pc * 4 + 4]
+        source = vm.where(pc)
+        print(f"{step:>10}  {pc:02X}: {vm.disassemble(instr):<24} {delta(trace, pc, flags, old, new)}" + (f"  ; {source}" if source else ""))
+    print(f"{len(trace)} of {vm.steps} instructions traced, ended at PC {vm.state[vm.PC]:02X}", file=sys.stderr)
+
+
+def delta(trace, pc, flags, old, new):
+    # A short description of what an entry changed.
+    kind, ra, rb = trace.kinds[pc], trace.ra[pc], trace.rb[pc]
+    text = ""
+    if kind == REG:
+        text = f"r{ra}: {old:02X} -> {new:02X}"
+    elif kind == SWAP:
+        text = f"r{ra}: {old:02X} -> {new:02X}, r{rb}: {new:02X} -> {old:02X}"
+    elif kind == PUSH and flags & MOVED:
+        text = f"push {new:02X}"
+    elif kind == POP and flags & MOVED:
+        text = f"pop {new:02X}" + (f", r{ra}: {old:02X} -> {new:02X}" if ra < 6 else "")
+    if flags & HALTED:
+        text += " (halted)"
+    return text.strip()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import bisect
+import json
+import os
+import zlib
+
+VERSION = 2
+
+
+class SourceMap:
+    """Maps each PC of an assembled program back to its source.
+
+    For every instruction it records the file and line it came from and the
+    chain of macro uses that produced it, outermost first, as (macro, file,
+    line) frames. Labels are kept by name, so any PC can be described
+    relative to the nearest label at or before it.
+
+    Saved as JSON next to the binary (out.mi8.map). Files and chains are
+    stored once and referenced by index from the per-PC entries. The
+    program's size and CRC32 are saved too, so a map left behind by an
+    earlier build is never applied to a different binary.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.files = []
+        self.chains = [()]
+        self.pcs = []  # (file index, line, chain index)
+        self.labels = {}
+        self._file_ids = {}
+        self._chain_ids = {(): 0}
+        self._sorted = None
+        self.program = None  # fingerprint() of the program described
+
+    def add(self, line, chain=(), file=None):
+        # Record the source of the next PC.
+        file = self.file if file is None else file
+        if file not in self._file_ids:
+            self._file_ids[file] = len(self.files)
+            self.files.append(file)
+        chain = tuple((name, self.file if f is None else f, n) for name, f, n in chain)
+        if chain not in self._chain_ids:
+            self._chain_ids[chain] = len(self.chains)
+            self.chains.append(chain)
+        self.pcs.append((self._file_ids[file], line, self._chain_ids[chain]))
+
+    def add_label(self, name, pc):
+        self.labels[name] = pc
+        self._sorted = None
+
+    def location(self, pc):
+        # Returns (file, line, chain), or None for PCs past the program.
+        if not 0 <= pc < len(self.pcs):
+            return None
+        file, line, chain = self.pcs[pc]
+        return self.files[file], line, self.chains[chain]
+
+    def label(self, pc):
+        # The nearest label at or before pc, as "$name" or "$name+3".
+        if self._sorted is None:
+            items = sorted((addr, name) for name, addr in self.labels.items())
+            self._sorted = ([addr for addr, _ in items], [name for _, name in items])
+        addrs, names = self._sorted
+        k = bisect.bisect_right(addrs, pc) - 1
+        if k < 0:
+            return None
+        return names[k] if addrs[k] == pc else f"{names[k]}+{pc - addrs[k]}"
+
+    def describe(self, pc):
+        # e.g. "primes.m8a:52 $modulo+1 (INC primes.m8a:60)"
+        loc = self.location(pc)
+        if loc is None:
+            # Maps built from a container's symbol table only have labels.
+            return (self.label(pc) or "") if not self.pcs else ""
+        file, line, chain = loc
+        text = f"{os.path.basename(file)}:{line}"
+        label = self.label(pc)
+        if label:
+            text += f" {label}"
+        if chain:
+            text += " (" + " > ".join(f"{name} {os.path.basename(f)}:{n}" for name, f, n in chain) + ")"
+        return text
+
+    def matches(self, program):
+        return self.program == fingerprint(program)
+
+    def to_json(self):
+        return {
+            "version": VERSION,
+            "program": list(self.program),
+            "files": self.files,
+            "labels": self.labels,
+            "chains": [[list(frame) for frame in chain] for chain in self.chains],
+            "pcs": [list(entry) for entry in self.pcs],
+        }
+
+    def save(self, path, program):
+        self.program = fingerprint(program)
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            raise ValueError(f"Unsupported source map version: {data.get('version')}")
+        smap = cls()
+        smap.program = tuple(data["program"])
+        smap.files = data["files"]
+        smap.labels = data["labels"]
+        smap.chains = [tuple(tuple(frame) for frame in chain) for chain in data["chains"]]
+        smap.pcs = [tuple(entry) for entry in data["pcs"]]
+        smap._file_ids = {f: i for i, f in enumerate(smap.files)}
+        smap._chain_ids = {c: i for i, c in enumerate(smap.chains)}
+        return smap
+
+
+def fingerprint(program):
+    return len(program), zlib.crc32(program)
+
+
+def load_for(program_path, program):
+    # The map saved alongside a binary, or None if there isn't one or it
+    # describes some other program, such as an earlier build.
+    path = program_path + ".map"
+    if not os.path.exists(path):
+        return None
+    try:
+        smap = SourceMap.load(path)
+    except ValueError:  # unreadable, or from before maps were fingerprinted
+        return None
+    return smap if smap.matches(program) else None
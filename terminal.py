@@ -0,0 +1,310 @@
+import codecs
+import os
+import select
+import shutil
+import sys
+import termios
+import tty
+
+CLEAR = b"\033c"
+EMPTY = 0xFE  # RFT result when the input buffer is empty
+INVALID = 0xFF  # RFT result when the input is out of range for the format
+
+
+def _format(val, fmt):
+    if fmt == 0:  # UTF-8, written as raw bytes so multi-byte sequences pass through
+        return CLEAR if val == 0 else bytes([val])
+    elif fmt == 1:  # Decimal
+        return str(val).encode() if val <= 9 else b"?"
+    elif fmt == 2:  # Alphabetic
+        return bytes([ord("A") + val]) if val <= 25 else b"?"
+    else:  # Hexadecimal
+        return hex(val)[2:].upper().encode() if val <= 0xF else b"?"
+
+
+def _parse(byte, fmt):
+    if fmt == 0:  # UTF-8, read byte by byte
+        return byte
+    ch = chr(byte)
+    if fmt == 1:  # Decimal
+        return int(ch) if ch in "0123456789" else INVALID
+    elif fmt == 2:  # Alphabetic, case-insensitive
+        letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        return letters.index(ch.upper()) if ch.isascii() and ch.upper() in letters else INVALID
+    else:  # Hexadecimal, case-insensitive
+        return int(ch, 16) if ch in "0123456789ABCDEFabcdef" else INVALID
+
+
+# WRT output bytes, indexed [fmt][value].
+WRT_TABLE = tuple(tuple(_format(val, fmt) for val in range(256)) for fmt in range(4))
+
+# RFT results, indexed [fmt][input byte].
+RFT_TABLE = tuple(tuple(_parse(byte, fmt) for byte in range(256)) for fmt in range(4))
+
+
+class TTYSink:
+    """Writes every WRT straight through to the stream, for interactive use."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout.buffer
+
+    def write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+
+    def flush(self):
+        pass
+
+
+class BufferedSink:
+    """Collects output and writes it in blocks of at least `threshold` bytes.
+
+    The VM flushes it before every RFT and when a run ends, so prompts are
+    still visible before input is read.
+    """
+
+    def __init__(self, stream=None, threshold=8192):
+        self.stream = stream or sys.stdout.buffer
+        self.threshold = threshold
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(self.buffer)
+            self.buffer.clear()
+        self.stream.flush()
+
+
+class MemorySink:
+    """Keeps all output in memory, for tests and batch runs."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        pass
+
+
+class ScreenSink:
+    """Interprets output into a grid of character cells, like a terminal,
+    and draws only what changed.
+
+    CLEAR (WRT 0) blanks the grid and starts a new frame. The grid is drawn
+    to the stream when a frame ends, at the next CLEAR, and whenever the VM
+    flushes, so prompts show before RFT. Each draw moves the cursor to every
+    run of cells that differs from what the terminal already shows and
+    rewrites just those, all in one write, so a redrawn screen never flashes
+    blank and unchanged cells cost next to nothing.
+
+    Newlines start the next row, long lines wrap and the grid scrolls at the
+    bottom; other escape sequences are dropped. With no stream nothing is
+    drawn, and the grid (lines(), row and col) is there to inspect.
+    """
+
+    def __init__(self, stream=None, rows=None, cols=None):
+        size = shutil.get_terminal_size()
+        self.stream = stream
+        self.rows = rows or size.lines
+        self.cols = cols or size.columns
+        self.grid = [[" "] * self.cols for _ in range(self.rows)]
+        self.shown = None  # the grid as last drawn, None before the first draw
+        self.at = None  # where the terminal's cursor is
+        self.row = self.col = 0
+        self.escape = ""  # an escape sequence being read
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.frames = 0  # CLEARs seen
+
+    def write(self, data):
+        for ch in self.decoder.decode(data):
+            if self.escape:
+                self.escape += ch
+                if self.escape == "\033c":
+                    self.escape = ""
+                    self.clear()
+                elif self.escape[1] != "[" or (len(self.escape) > 2 and "@" <= ch <= "~"):
+                    self.escape = ""
+            elif ch == "\033":
+                self.escape = ch
+            elif ch == "\n":
+                self.newline()
+            elif ch == "\r":
+                self.col = 0
+            elif ch == "\b":
+                self.col = max(self.col - 1, 0)
+            elif ch == "\t":
+                self.col = min(self.col // 8 * 8 + 8, self.cols)
+            elif " " <= ch != "\x7f":
+                if self.col >= self.cols:
+                    self.newline()
+                self.grid[self.row][self.col] = ch
+                self.col += 1
+
+    def newline(self):
+        self.col = 0
+        if self.row + 1 < self.rows:
+            self.row += 1
+        else:
+            self.grid.append(self.grid.pop(0))
+            self.grid[-1][:] = " " * self.cols
+
+    def clear(self):
+        self.flush()
+        for row in self.grid:
+            row[:] = " " * self.cols
+        self.row = self.col = 0
+        self.frames += 1
+
+    def lines(self):
+        # The grid as text, without trailing blanks.
+        lines = ["".join(row).rstrip() for row in self.grid]
+        while lines and not lines[-1]:
+            lines.pop()
+        return lines
+
+    def flush(self):
+        if self.stream is None:
+            return
+        out = []
+        if self.shown is None:
+            out.append("\033[H\033[2J")
+            self.shown = [[" "] * self.cols for _ in range(self.rows)]
+            self.at = (0, 0)
+        for r, (row, old) in enumerate(zip(self.grid, self.shown)):
+            if row == old:
+                continue
+            c = 0
+            while c < self.cols:
+                if row[c] == old[c]:
+                    c += 1
+                    continue
+                start = c
+                while c < self.cols and row[c] != old[c]:
+                    c += 1
+                out.append(self.move(r, start) + "".join(row[start:c]))
+                self.at = (r, c)
+            old[:] = row
+        if not out:
+            return
+        out.append(self.move(self.row, min(self.col, self.cols - 1)))
+        self.at = (self.row, min(self.col, self.cols - 1))
+        self.stream.write("".join(out).encode())
+        self.stream.flush()
+
+    def move(self, r, c):
+        # The shortest output taking the terminal's cursor from self.at to
+        # (r, c): rewriting the cells on the way, which already show the
+        # right thing, or an absolute move.
+        options = [f"\033[{r + 1};{c + 1}H"]
+        tr, tc = self.at
+        row = self.grid[r]
+        if r == tr:
+            options.append("\r" + "".join(row[:c]))
+            if tc <= c:
+                options.append("".join(row[tc:c]))
+        elif r == tr + 1:
+            options.append("\r\n" + "".join(row[:c]))
+        return min(options, key=len)
+
+
+def default_sink():
+    return TTYSink() if sys.stdout.isatty() else BufferedSink()
+
+
+# Input sources implement the ISA's internally managed input buffer: read()
+# returns the next input byte, or None when no input is available (RFT then
+# yields 0xFE). release() undoes any terminal state once a run ends.
+
+
+class TTYSource:
+    """Reads keys from a terminal without waiting for Enter.
+
+    The terminal is switched to cbreak mode on the first read and restored by
+    release(), so a run changes the terminal mode at most once. Each read
+    waits up to `timeout` seconds for a key before reporting an empty buffer.
+    """
+
+    def __init__(self, stream=None, timeout=0.01):
+        self.fd = (stream or sys.stdin).fileno()
+        self.timeout = timeout
+        self.buffer = b""
+        self.pos = 0
+        self.saved = None
+
+    def read(self):
+        if self.pos >= len(self.buffer):
+            if self.saved is None:
+                self.saved = termios.tcgetattr(self.fd)
+                tty.setcbreak(self.fd)
+            ready, _, _ = select.select([self.fd], [], [], self.timeout)
+            if not ready:
+                return None
+            self.buffer = os.read(self.fd, 1024)
+            self.pos = 0
+            if not self.buffer:
+                return None
+        byte = self.buffer[self.pos]
+        self.pos += 1
+        return byte
+
+    def release(self):
+        if self.saved is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.saved = None
+
+
+class StreamSource:
+    """Reads input from a pipe or file in large chunks."""
+
+    def __init__(self, stream=None, chunk=65536):
+        stream = stream or sys.stdin.buffer
+        self.read_chunk = getattr(stream, "read1", stream.read)
+        self.chunk = chunk
+        self.buffer = b""
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        if self.pos >= len(self.buffer):
+            if self.eof:
+                return None
+            self.buffer = self.read_chunk(self.chunk)
+            self.pos = 0
+            if not self.buffer:
+                self.eof = True
+                return None
+        byte = self.buffer[self.pos]
+        self.pos += 1
+        return byte
+
+    def release(self):
+        pass
+
+
+class BytesSource:
+    """Serves input from a preloaded bytes object."""
+
+    def __init__(self, data=b""):
+        self.data = bytes(data)
+        self.pos = 0
+
+    def read(self):
+        if self.pos >= len(self.data):
+            return None
+        byte = self.data[self.pos]
+        self.pos += 1
+        return byte
+
+    def release(self):
+        pass
+
+
+def default_source():
+    return TTYSource() if sys.stdin.isatty() else StreamSource()
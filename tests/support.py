@@ -0,0 +1,40 @@
+import contextlib
+import glob
+import io
+import os
+
+from assembler import assemble
+from terminal import BytesSource, MemorySink
+from vm import MiniMachineVM
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROGRAMS = sorted(glob.glob(os.path.join(ROOT, "programs", "*.m8a")))
+
+# Input for the programs that read some; the rest ignore it.
+INPUT = b"0413258\n"
+
+# Enough for every program that halts; input_reader and tic-tac-toe on no
+# input poll RFT forever.
+MAX_STEPS = 300_000
+
+
+def build(source, optimize=False, path=None):
+    # Assembles a path, or source text, quietly.
+    if path is None and os.path.exists(source):
+        path = source
+        with open(path) as f:
+            source = f.read()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return b"".join(assemble(source.splitlines(keepends=True), optimize=optimize, path=path))
+
+
+def run(program, engine="reference", data=INPUT, max_steps=MAX_STEPS, **options):
+    vm = MiniMachineVM(
+        program, engine=engine, jit_cache=False, output=MemorySink(), input_source=BytesSource(data), **options
+    )
+    vm.run(max_steps)
+    return vm
+
+
+def name(path):
+    return os.path.basename(path)
@@ -0,0 +1,41 @@
+import pytest
+from support import PROGRAMS, build, name, run
+
+
+def outcome(program):
+    vm = run(program, "table")
+    return vm.exit_reason, bytes(vm.output.data)
+
+
+@pytest.mark.parametrize("path", PROGRAMS, ids=name)
+def test_optimizer_keeps_behaviour(path):
+    plain, optimized = build(path), build(path, optimize=True)
+    assert len(optimized) <= len(plain)
+    (reason, out), (opt_reason, opt_out) = outcome(plain), outcome(optimized)
+    assert opt_reason == reason
+    if reason == "budget":  # -O may get further in the same budget
+        assert opt_out.startswith(out)
+    else:
+        assert opt_out == out
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        # A POP r7 of a pushed value is a computed jump, not a return.
+        ('PUSH 1\nPOP r7\nWRT "A"\nWRT "B"\nHCF\n', b"AB"),
+        # On an empty stack, POP r7 does nothing and execution falls through.
+        ('POP r7\nWRT "A"\nHCF\nWRT "B"\n', b"A"),
+    ],
+)
+def test_optimizer_keeps_pop_r7_fall_through(source, expected):
+    for optimize in (False, True):
+        vm = run(build(source, optimize=optimize))
+        assert vm.exit_reason == "halt"
+        assert bytes(vm.output.data) == expected
+
+
+def test_optimizer_still_drops_code_after_a_return():
+    source = 'CALL $f\nHCF\nlabel $f\nPOP r7\nWRT "X"\n'
+    assert len(build(source, optimize=True)) == len(build(source)) - 4
+    assert run(build(source, optimize=True)).exit_reason == "halt"
@@ -0,0 +1,51 @@
+import pytest
+from cfg import CFG
+from support import INPUT, MAX_STEPS, PROGRAMS, build, name
+from terminal import BytesSource, MemorySink
+from vm import MiniMachineVM
+
+
+def observe(program, cfg):
+    # Runs program one step at a time, returning the VM, the most
+    # instructions any call to each subroutine ran, and the most times each
+    # bounded loop's header ran per entry into the loop.
+    vm = MiniMachineVM(program, engine="table", output=MemorySink(), input_source=BytesSource(INPUT))
+    loops = [loop for sub in cfg.subs.values() for loop in sub.loops if loop.bound is not None]
+    bodies = [{pc for b in loop.body for pc in range(cfg.blocks[b].start, cfg.blocks[b].end)} for loop in loops]
+    entered = [None] * len(loops)  # [stack depth at the header, header runs]
+    iterations = {loop: 0 for loop in loops}
+    calls = {}
+    frames = []  # (stack depth inside the call, target, steps at the call)
+    while vm.steps < MAX_STEPS and not vm.halted:
+        pc, sp = vm.state[vm.PC], vm.sp
+        for i, loop in enumerate(loops):
+            # Callees run deeper in the stack; leaving at the loop's own
+            # depth ends the entry.
+            if entered[i] is not None and pc not in bodies[i] and sp <= entered[i][0]:
+                entered[i] = None
+            if pc == loop.header:
+                entered[i] = entered[i] or [sp, 0]
+                entered[i][1] += 1
+                iterations[loop] = max(iterations[loop], entered[i][1])
+        vm.run(1)
+        if pc < vm.size and cfg.effects[pc][0] == "call" and vm.sp > sp:
+            frames.append((vm.sp, vm.state[vm.PC], vm.steps))
+        while frames and vm.sp < frames[-1][0]:
+            _, target, start = frames.pop()
+            calls[target] = max(calls.get(target, 0), vm.steps - start)
+    return vm, calls, iterations
+
+
+@pytest.mark.parametrize("path", PROGRAMS, ids=name)
+def test_bounds_hold_at_run_time(path):
+    program = build(path)
+    cfg = CFG(program)
+    vm, calls, iterations = observe(program, cfg)
+    for loop, most in iterations.items():
+        assert most <= loop.bound, loop.header
+    for entry, most in calls.items():
+        wcet = cfg.subs[entry].wcet
+        assert wcet is None or most <= wcet, entry
+    wcet = cfg.subs[0].wcet
+    if vm.halted and wcet is not None:
+        assert vm.steps <= wcet
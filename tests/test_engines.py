@@ -0,0 +1,91 @@
+import pytest
+from support import INPUT, PROGRAMS, build, name, run
+
+OPTIONS = ({"memoize": True}, {"accelerate": True}, {"memoize": True, "accelerate": True})
+
+
+ENGINES = (
+    ("table", {}),
+    ("jit", {}),
+    ("table", {"memoize": True}),
+    ("jit", {"memoize": True}),
+    ("table", {"accelerate": True}),
+    ("jit", {"accelerate": True}),
+)
+
+BATCH_STEPS = 40_000
+
+
+def machine(vm):
+    return vm.exit_reason, vm.steps, bytes(vm.state), vm.sp, bytes(vm.output.data)
+
+
+@pytest.mark.parametrize("path", PROGRAMS, ids=name)
+def test_engines_agree_with_the_reference(path, tmp_path, monkeypatch):
+    monkeypatch.setenv("MINI8_CACHE_DIR", str(tmp_path))
+    program = build(path)
+    expected = machine(run(program))
+    for engine, options in ENGINES:
+        assert machine(run(program, engine, **options)) == expected, (engine, options)
+
+
+@pytest.mark.parametrize("path", PROGRAMS, ids=name)
+def test_batch_agrees_with_the_reference(path):
+    pytest.importorskip("numpy")
+    from batchvm import BatchVM
+
+    # Lockstep numpy steps are slow one machine at a time, so stop early.
+    program = build(path)
+    vm = run(program, max_steps=BATCH_STEPS)
+    batch = BatchVM(program, 2, inputs=[INPUT, INPUT])
+    batch.run(BATCH_STEPS)
+    for i in range(2):
+        assert batch.steps[i] == vm.steps
+        assert batch.halted[i] == (vm.exit_reason != "budget")
+        assert batch.output(i) == bytes(vm.output.data)
+        assert bytes(batch.reg[i]) == bytes(vm.state[:8])
+        assert bytes(batch.ram[i]) == bytes(vm.ram)
+        assert bytes(batch.stack[i, : batch.sp[i]]) == bytes(vm.stack[: vm.sp])
+
+
+@pytest.mark.parametrize("path", PROGRAMS, ids=name)
+def test_wrapped_table_stops_at_the_budget(path):
+    # Memo misses and accelerated loops stand for many instructions, and
+    # must still stop exactly where the reference engine does.
+    program = build(path)
+    total = run(program, "table").steps
+    for budget in (1, 7, 500, total // 3, total - 1):
+        if budget < 1:
+            continue
+        expected = machine(run(program, max_steps=budget))
+        for options in OPTIONS:
+            assert machine(run(program, "table", max_steps=budget, **options)) == expected, (budget, options)
+
+
+def test_loop_range_steps_like_the_detector():
+    # The cycle runs through a counting loop, which accel would skip.
+    source = (
+        "label $top\nMOV 0, r0\nJMP $count\nlabel $back\nJMP $top\n"
+        "label $count\nJEQ r0, 10, $back\nADD r0, 1, r0\nJMP $count\n"
+    )
+    program = build(source)
+    for options in ({},) + OPTIONS:
+        vm = run(program, "table", max_steps=0, **options)
+        vm.run(10_000, detect_loops=True)
+        assert (vm.exit_reason, vm.loop) == ("loop", (0, 5)), options
+        # With budget to spare, the wrapped table skips the counting loop;
+        # the table the detector and the replay step must not.
+        vm.state[vm.PC], vm.state[0], vm.ctr[:] = 3, 0, [0, 10_000]
+        assert vm.plain_table()[3]() == 4, options
+
+
+
+def test_forks_do_not_share_profile_or_trace():
+    program = build("MOV 3, r0\nlabel $l\nSUB r0, 1, r0\nJNE r0, 0, $l\nHCF\n")
+    vm = run(program, "table", max_steps=2, profile=True, trace=5)
+    counts, steps = list(vm.profile.counts), len(vm.trace)
+    child = vm.fork()
+    assert child.profile is None and child.trace is None
+    child.run(100)
+    assert child.exit_reason == "halt"
+    assert (list(vm.profile.counts), len(vm.trace)) == (counts, steps)
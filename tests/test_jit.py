@@ -0,0 +1,23 @@
+from jit import JitCompiler, find_leaders, program_key
+from support import build, run
+
+PROGRAM = 'MOV 3, r0\nlabel $loop\nSUB r0, 1, r0\nWRT r0, 0b01\nJNE r0, 0, $loop\nHCF\n'
+
+
+def test_empty_program_runs_off_the_end(tmp_path, monkeypatch):
+    monkeypatch.setenv("MINI8_CACHE_DIR", str(tmp_path))
+    for program in (b"", b"\x01\x02"):
+        for engine in ("reference", "table", "jit"):
+            vm = run(program, engine)
+            assert (vm.exit_reason, vm.steps) == ("end", 0)
+
+
+def test_cache_key_covers_leaders(tmp_path, monkeypatch):
+    monkeypatch.setenv("MINI8_CACHE_DIR", str(tmp_path))
+    program = build(PROGRAM)
+    leaders = find_leaders(program)
+    assert program_key(program, leaders) != program_key(program, leaders | {3})
+    assert JitCompiler(program).path != JitCompiler(program, leaders=leaders | {3}).path
+    for extra in (set(), {3}, {2, 3}):
+        vm = run(program, "jit", leaders=leaders | extra)
+        assert (vm.exit_reason, bytes(vm.output.data)) == ("halt", b"210")
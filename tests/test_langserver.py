@@ -0,0 +1,35 @@
+import io
+import json
+
+from langserver import Server
+
+
+def frame(payload):
+    body = json.dumps(payload).encode()
+    return f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+
+
+def replies(data):
+    out = []
+    while data:
+        header, _, data = data.partition(b"\r\n\r\n")
+        length = int(header.split(b":")[1])
+        out.append(json.loads(data[:length]))
+        data = data[length:]
+    return out
+
+
+def test_bad_notification_keeps_the_server_running():
+    uri = "file:///tmp/main.m8a"
+    edit = {"range": {"start": {"line": 9, "character": 0}, "end": {"line": 9, "character": 0}}, "text": "x"}
+    messages = [
+        {"jsonrpc": "2.0", "method": "textDocument/didOpen", "params": {"textDocument": {"uri": uri, "text": "HCF"}}},
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {"textDocument": {"uri": uri}, "contentChanges": [edit]}},
+        {"jsonrpc": "2.0", "id": 1, "method": "shutdown"},
+    ]
+    wfile = io.BytesIO()
+    Server(io.BytesIO(b"".join(frame(m) for m in messages)), wfile).serve()
+    sent = replies(wfile.getvalue())
+    logged = [m for m in sent if m.get("method") == "window/logMessage"]
+    assert len(logged) == 1 and "IndexError" in logged[0]["params"]["message"]
+    assert sent[-1] == {"jsonrpc": "2.0", "id": 1, "result": None}
@@ -0,0 +1,51 @@
+import contextlib
+import io
+
+import container
+import linker
+from jit import find_leaders
+from linker import ObjectFile, link, module_key
+from sourcemap import SourceMap
+from support import build, run
+
+
+def test_cache_key_covers_the_toolchain(monkeypatch):
+    files = [("main.m8a", "MOV 1, r0\nHCF\n")]
+    key = module_key(files, False, True)
+    assert key == module_key(files, False, True)
+    monkeypatch.setattr(linker, "TOOLCHAIN", "edited")
+    assert module_key(files, False, True) != key
+
+
+MAIN = "MOV 3, r0\nlabel $loop\nCALL $show\nSUB r0, 1, r0\nJNE r0, 0, $loop\nHCF\n"
+LIB = "label $show\nWRT r0, 0b01\nPOP r7\n"
+
+
+def test_objects_and_containers_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setenv("MINI8_OBJ_CACHE_DIR", str(tmp_path / "cache"))
+    paths = []
+    for name, text in (("main.m8a", MAIN), ("lib.m8a", LIB)):
+        paths.append(tmp_path / name)
+        paths[-1].write_text(text)
+    expected = build(MAIN + LIB)
+
+    for use_cache in (False, True, True):  # fresh, stored, then loaded from the cache
+        objects = []
+        for path in paths:
+            linker.build(str(path), use_cache=use_cache).save(str(path.with_suffix(".m8o")))
+            objects.append(ObjectFile.load(str(path.with_suffix(".m8o"))))
+        smap = SourceMap()
+        with contextlib.redirect_stdout(io.StringIO()):
+            program = b"".join(link(objects, smap))
+        assert program == expected
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+    out = tmp_path / "prog.mi8"
+    container.save(str(out), program, smap.labels)
+    image = container.load(str(out))
+    assert image.container
+    assert (bytes(image.program), image.symbols) == (program, {"$loop": 1, "$show": 5})
+    assert image.leaders == find_leaders(program)
+    for engine in ("reference", "jit"):
+        vm = run(image.program, engine, leaders=image.leaders if engine == "jit" else None)
+        assert (vm.exit_reason, bytes(vm.output.data)) == ("halt", b"321")
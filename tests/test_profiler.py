@@ -0,0 +1,9 @@
+from support import build, run
+
+
+def test_jump_to_the_next_instruction_counts_its_condition():
+    # Both jumps land on the next instruction; only the first one branches.
+    program = build("MOV 1, r0\nJEQ r0, 1, $a\nlabel $a\nJNE r0, 1, $b\nlabel $b\nJMP $c\nlabel $c\nHCF\n")
+    prof = run(program, "table", profile=True).profile
+    assert prof.counts[1:4] == [1, 1, 1]
+    assert prof.taken[1:4] == [1, 0, 1]
@@ -0,0 +1,33 @@
+import pytest
+from support import INPUT, PROGRAMS, build, name, run
+from terminal import BytesSource, MemorySink
+from vm import MiniMachineVM
+
+STEPS = 1500
+
+
+def snapshots(program, steps):
+    # The reference engine's snapshot after each number of steps, up to a
+    # halt. Running off the end halts without taking a step.
+    vm = MiniMachineVM(program, output=MemorySink(), input_source=BytesSource(INPUT))
+    snaps = [vm.snapshot()]
+    while len(snaps) <= steps and not vm.halted:
+        vm.run(1)
+        snaps[vm.steps :] = [vm.snapshot()]
+    return snaps
+
+
+@pytest.mark.parametrize("capacity", (STEPS, 100))
+@pytest.mark.parametrize("path", PROGRAMS, ids=name)
+def test_undo_and_redo_match_snapshots(path, capacity):
+    program = build(path)
+    snaps = snapshots(program, STEPS)
+    vm = run(program, "table", max_steps=STEPS, trace=capacity)
+    assert vm.snapshot() == snaps[vm.steps]
+    end = vm.steps
+    while vm.trace.undo(vm):
+        assert vm.snapshot() == snaps[vm.steps]
+    assert vm.steps == max(end - capacity, 0)
+    while vm.trace.redo(vm):
+        assert vm.snapshot() == snaps[vm.steps]
+    assert vm.steps == end
@@ -0,0 +1,12 @@
+import sourcemap
+
+
+def test_load_for_skips_a_map_of_another_program(tmp_path):
+    path = str(tmp_path / "out.mi8")
+    smap = sourcemap.SourceMap(file="prog.m8a")
+    smap.add(1)
+    smap.add_label("$start", 0)
+    smap.save(path + ".map", b"\x70\x01\x00\x00")
+    assert sourcemap.load_for(path, b"\x70\x01\x00\x00").labels == {"$start": 0}
+    assert sourcemap.load_for(path, b"\x70\x02\x00\x00") is None
+    assert sourcemap.load_for(str(tmp_path / "other.mi8"), b"") is None
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def listing(path, flag):
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "vm.py"), str(path), flag], capture_output=True, text=True, cwd=ROOT
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_listing_pads_short_trailing_instruction(tmp_path):
+    # Raw binaries load as a memoryview; a short last instruction is padded.
+    path = tmp_path / "odd.mi8"
+    path.write_bytes(bytes([0x81, 0x01, 0x00, 0x00, 0x82, 0x00, 0x00, 0x00, 0xBF, 0x00]))
+    assert "81 01 00 00  82 00 00 00  BF 00 00 00" in listing(path, "-v")
+    out = listing(path, "-vv")
+    assert "02: BF 00 00 00" in out
+    assert "01: 82 00 00 00  ADD_rr r0, r0, r0" in out
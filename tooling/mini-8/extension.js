@@ -0,0 +1,46 @@
+const path = require("path");
+const vscode = require("vscode");
+const { LanguageClient } = require("vscode-languageclient/node");
+
+let client;
+
+function activate(context) {
+  const config = vscode.workspace.getConfiguration("mini8");
+  const folder = vscode.workspace.workspaceFolders?.[0]?.uri.fsPath ?? "";
+  const server = config.get("server.path") || path.join(folder, "langserver.py");
+  const python = config.get("server.python") || "python3";
+
+  client = new LanguageClient(
+    "mini8",
+    "Mini-8 Language Server",
+    { command: python, args: [server] },
+    { documentSelector: [{ language: "mini8" }] }
+  );
+
+  // Live instruction count against the 256-instruction limit.
+  const counts = new Map();
+  const status = vscode.window.createStatusBarItem(vscode.StatusBarAlignment.Left);
+  const showCount = () => {
+    const editor = vscode.window.activeTextEditor;
+    const count = editor && counts.get(editor.document.uri.toString());
+    if (!count) {
+      status.hide();
+      return;
+    }
+    status.text = `Mini-8: ${count.count}/${count.limit}`;
+    status.show();
+  };
+  client.onNotification("mini8/instructionCount", (params) => {
+    counts.set(params.uri, params);
+    showCount();
+  });
+  context.subscriptions.push(status, vscode.window.onDidChangeActiveTextEditor(showCount));
+
+  client.start();
+}
+
+function deactivate() {
+  return client ? client.stop() : undefined;
+}
+
+module.exports = { activate, deactivate };
@@ -1,17 +1,270 @@
+import mmap
+import os
 import sys
-import tty, termios
+import operator
+import time
+
+import container
+import sourcemap
+from terminal import (
+    EMPTY,
+    RFT_TABLE,
+    WRT_TABLE,
+    BytesSource,
+    MemorySink,
+    ScreenSink,
+    TTYSink,
+    default_sink,
+    default_source,
+)
+
+ENGINES = ("reference", "table", "jit")
+
+# Instructions run between clock checks when run() has a timeout.
+TIME_SLICE = 1 << 16
+
+# Binary ALU operations indexed by subtype. Results are masked to 8 bits by the caller.
+ALU_FUNCS = (
+    operator.and_,  # AND
+    lambda a, b: (a >> (b % 8)) | (a << (8 - (b % 8))),  # ROR
+    operator.add,  # ADD
+    operator.xor,  # XOR
+    operator.or_,  # OR
+    lambda a, b: (a << (b % 8)) | (a >> (8 - (b % 8))),  # ROL
+    operator.sub,  # SUB
+    lambda a, b: ~a,  # NOT
+)
+
+# Jump conditions indexed by subtype. None marks JMP (always) and NOP (never).
+COND_FUNCS = (
+    None,  # JMP
+    operator.ne,  # JNE
+    operator.ge,  # JGE
+    operator.gt,  # JGT
+    None,  # NOP
+    operator.eq,  # JEQ
+    operator.lt,  # JLT
+    operator.le,  # JLE
+)
+
+
+# Machine state layout: registers, RAM and stack share one bytearray, so a
+# snapshot is a single copy. The stack pointer is kept separately. r5 is
+# never stored: it reads and writes the RAM byte r4 points at, so state[5]
+# stays 0.
+RAM_BASE = 8
+RAM_SIZE = 256
+STACK_BASE = RAM_BASE + RAM_SIZE
+STACK_SIZE = 256  # the ISA's minimum depth
+STATE_SIZE = STACK_BASE + STACK_SIZE
+
+
+def uses_ram(instr):
+    # Whether an instruction reads or writes r5.
+    opcode, op1, op2, dest = instr
+    imm1, imm2 = (opcode >> 6) & 1, (opcode >> 5) & 1
+    opclass, subtype = (opcode >> 3) & 0x3, opcode & 0x7
+    a = not imm1 and op1 & 0x7 == 5
+    b = not imm2 and op2 & 0x7 == 5
+    d = dest & 0x7 == 5
+    if opclass == 0b00:
+        return a or (b and subtype != 0b111) or d  # NOT ignores OP2
+    if opclass == 0b01:
+        return subtype not in (0b000, 0b100) and (a or b)
+    if opclass == 0b10:
+        if subtype in (0b000, 0b001):  # MOV, SWAP
+            return d or (op1 & 0x7 == 5 if subtype else a)
+        if subtype in (0b010, 0b100, 0b101):  # PUSH, WRT, CALL
+            return a
+        return subtype in (0b011, 0b110) and d  # POP, RFT
+    return False
+
+
+def open_ram_image(path):
+    # A writable mapping of the RAM image at path, which is created zeroed if
+    # it doesn't exist.
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size not in (0, RAM_SIZE):
+            raise ValueError(f"{path} is not a RAM image: {size} bytes, expected {RAM_SIZE}")
+        if not size:
+            os.ftruncate(fd, RAM_SIZE)
+        return mmap.mmap(fd, RAM_SIZE)
+    finally:
+        os.close(fd)
 
 
 class MiniMachineVM:
-    def __init__(self, program: bytes, debug: bool = False):
-        self.reg = [0] * 8  # r0-r7
-        self.ram = [0] * 256
-        self.stack = []
+    __slots__ = (
+        "state",
+        "reg",
+        "ram",
+        "stack",
+        "sp",
+        "program",
+        "halted",
+        "overflow",
+        "debug",
+        "engine",
+        "output",
+        "input",
+        "size",
+        "steps",
+        "exit_reason",
+        "jit",
+        "ctr",
+        "table",
+        "profile",
+        "loop",
+        "reads",
+        "source_map",
+        "memo",
+        "accel",
+        "trace",
+        "ram_image",
+    )
+
+    PC = 7  # r7 is PC
+
+    def __init__(
+        self,
+        program: bytes,
+        debug: bool = False,
+        engine: str = "reference",
+        jit_cache: bool = True,
+        output=None,
+        input_source=None,
+        profile: bool = False,
+        source_map=None,
+        memoize: bool = False,
+        exact_steps: bool = True,
+        accelerate: bool = False,
+        trace: int = 0,
+        leaders=None,
+        ram_file=None,
+    ):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
+        if memoize and engine == "reference":
+            raise ValueError("Memoization needs the table or jit engine")
+        if accelerate and engine == "reference":
+            raise ValueError("Loop acceleration needs the table or jit engine")
+        self.state = bytearray(STATE_SIZE)
+        view = memoryview(self.state)
+        self.reg = view[:8]  # r0-r7
+        self.ram = view[RAM_BASE:STACK_BASE]  # zero-copy: hosts may read and fill it directly
+        self.stack = view[STACK_BASE:]  # entries below sp are live
+        self.sp = 0
+        # With ram_file, RAM starts out as the file's contents and is written
+        # back every time run() returns, so it persists across runs.
+        self.ram_image = None
+        if ram_file is not None:
+            self.ram_image = open_ram_image(ram_file)
+            self.ram[:] = self.ram_image
         self.program = program
         self.halted = False
-        self.term_buffer = ""
-        self.PC = 7  # r7 is PC
+        self.overflow = False  # halted by a PUSH or CALL on a full stack
         self.debug = debug
+        self.engine = engine
+        # WRT output sink; see terminal.py. Fixed for the lifetime of the VM.
+        self.output = output or (TTYSink() if debug else default_sink())
+        # RFT input buffer; see terminal.py.
+        self.input = input_source or default_source()
+        self.size = len(program) // 4  # instructions
+        self.steps = 0  # instructions executed
+        self.exit_reason = None
+        self.loop = None  # PC range of a detected infinite loop, see run()
+        self.reads = None  # PCs of the program's RFTs, see rft_pcs()
+        self.source_map = source_map  # a sourcemap.SourceMap, if one was saved
+        self.jit = None
+        self.ctr = [0, 0]  # JIT step count and budget, see run_jit()
+        if engine == "jit":
+            from jit import JitCompiler
+
+            self.jit = JitCompiler(program, use_cache=jit_cache, leaders=leaders)
+        self.memo = None  # a memo.Memo when memoizing pure subroutines
+        if memoize:
+            from memo import Memo
+
+            self.memo = Memo(program, exact_steps=exact_steps)
+        self.accel = None  # an accel.Accelerator when fast-forwarding counting loops
+        if accelerate:
+            from accel import Accelerator
+
+            self.accel = Accelerator(program)
+        self.table = self.bind()
+        self.profile = None  # a profiler.Profile while profiling, see run_profile()
+        if profile:
+            from profiler import Profile
+
+            self.profile = Profile(program, source_map)
+        self.trace = None  # a recorder.Trace of the last `trace` instructions, see run_trace()
+        if trace:
+            from recorder import Trace
+
+            self.trace = Trace(program, trace)
+
+    def bind(self):
+        # Build the dispatch table for the table and JIT engines. Handlers
+        # close over this VM's state, so every VM needs its own table.
+        if self.engine == "table":
+            table = self.decode()
+        elif self.engine == "jit":
+            table = self.jit.bind(self, self._halt_handler)
+        else:
+            return None
+        if self.memo is not None:
+            self.memo.wrap(self, table)
+        if self.accel is not None:
+            self.accel.wrap(self, table)
+        return table
+
+    def snapshot(self):
+        # Everything needed to resume execution later. Input and output are
+        # not part of a snapshot.
+        return bytes(self.state), self.sp, self.halted, self.overflow, self.steps
+
+    def restore(self, snap):
+        # Copies in place, so decoded handlers stay bound to this VM.
+        state, self.sp, self.halted, self.overflow, self.steps = snap
+        self.state[:] = state
+        self.exit_reason = None
+
+    def fork(self, output=None, input_source=None):
+        # A new VM in the same state, sharing this one's output and input
+        # unless others are given. JIT forks reuse the compiled code. Forks
+        # get a private copy of RAM, never this VM's RAM image, and neither
+        # profile nor trace this VM's run.
+        vm = object.__new__(type(self))
+        for name in self.__slots__:
+            setattr(vm, name, getattr(self, name))
+        vm.state = bytearray(self.state)
+        view = memoryview(vm.state)
+        vm.reg = view[:8]
+        vm.ram = view[RAM_BASE:STACK_BASE]
+        vm.stack = view[STACK_BASE:]
+        vm.output = output or self.output
+        vm.input = input_source or self.input
+        vm.ctr = [0, 0]
+        vm.ram_image = None
+        vm.profile = vm.trace = None
+        vm.table = vm.bind()
+        return vm
+
+    def push(self, val):
+        # Returns False, halting the machine, if the stack is full.
+        if self.sp >= STACK_SIZE:
+            self.halted = self.overflow = True
+            return False
+        self.state[STACK_BASE + self.sp] = val
+        self.sp += 1
+        return True
+
+    def pop(self):
+        # Callers check self.sp first; POP on an empty stack does nothing.
+        self.sp -= 1
+        return self.state[STACK_BASE + self.sp]
 
     def fetch(self):
         pc = self.reg[self.PC]
@@ -27,6 +280,12 @@ class MiniMachineVM:
         im2s = "i" if imm2 else "r"
         return f"_{im1s}{im2s}"
 
+    def where(self, pc):
+        # The source location of pc, if there is a source map.
+        if self.source_map is None or pc >= self.size:
+            return ""
+        return self.source_map.describe(pc)
+
     def disassemble(self, instr):
         opcode, op1, op2, dest = instr
         imm1 = (opcode >> 6) & 1
@@ -40,6 +299,11 @@ class MiniMachineVM:
         def op_val(val, imm):
             return f"{val} ({hex(val)})" if imm else reg_name(val & 0x7)
 
+        def target(addr):
+            # A code address, with its label if one is known.
+            label = self.source_map.label(addr) if self.source_map is not None else None
+            return f"{addr} ({label})" if label and "+" not in label else f"{addr}"
+
         imstr = self.immstr(imm1, imm2)
         if opclass == 0b00:
             # ALU
@@ -54,11 +318,11 @@ class MiniMachineVM:
             cond_ops = ["JMP", "JNE", "JGE", "JGT", "NOP", "JEQ", "JLT", "JLE"]
             op = cond_ops[subtype] if subtype < len(cond_ops) else "???"
             if op == "JMP":
-                return f"{op} {dest}"
+                return f"{op} {target(dest)}"
             elif op == "NOP":
                 return f"{op}"
             else:
-                return f"{op}{imstr} {op_val(op1, imm1)}, {op_val(op2, imm2)}, {dest}"
+                return f"{op}{imstr} {op_val(op1, imm1)}, {op_val(op2, imm2)}, {target(dest)}"
         elif opclass == 0b10:
             # IO
             io_ops = ["MOV", "SWAP", "PUSH", "POP", "WRT", "CALL", "RFT", "HCF"]
@@ -77,7 +341,7 @@ class MiniMachineVM:
                 fmt_str = fmt_names[fmt] if fmt < len(fmt_names) else str(fmt)
                 return f"{op}{imstr} {op_val(op1, imm1)}, {fmt_str}"
             elif op == "CALL":
-                return f"{op}{imstr} {op_val(op1, imm1)}"
+                return f"{op}{imstr} {target(op1) if imm1 else reg_name(op1 & 0x7)}"
             elif op == "RFT":
                 return f"{op}{imstr} {op_val(op1, imm1)}"
             elif op == "HCF":
@@ -95,34 +359,763 @@ class MiniMachineVM:
         for i in range(0, len(self.program), 4):
             instr = self.program[i : i + 4]
             if len(instr) < 4:
-                instr += b"\x00" * (4 - len(instr))
+                instr = bytes(instr) + b"\x00" * (4 - len(instr))  # raw binaries load as a memoryview
             hex_instr = " ".join(f"{b:02X}" for b in instr)
             lines.append(hex_instr)
         return "\n".join("  ".join(lines[i : i + 4]) for i in range(0, len(lines), 4))
 
-    def run(self):
-        while not self.halted:
+    def run(self, max_steps=None, timeout=None, detect_loops=False):
+        # Run until the machine halts, max_steps instructions have executed or
+        # timeout seconds have passed. self.exit_reason records why it stopped:
+        # "halt" (HCF), "end" (the PC ran off the end of the program),
+        # "overflow" (stack overflow), "budget", "timeout" or "loop". With
+        # detect_loops, a machine that provably never halts stops with "loop"
+        # and self.loop set to the (lowest, highest) PC of the cycle.
+        if self.halted:
+            return
+        self.loop = None
+        brent = [None, 0, 1, 0]  # loop detector: saved state and sp, power, steps since save
+        timed_out = False
+        try:
+            if timeout is None:
+                self.run_engine(max_steps, detect_loops, brent)
+            else:
+                deadline = time.perf_counter() + timeout
+                start = self.steps
+                while True:
+                    chunk = TIME_SLICE
+                    if max_steps is not None:
+                        chunk = min(chunk, start + max_steps - self.steps)
+                        if chunk <= 0:
+                            break
+                    self.run_engine(chunk, detect_loops, brent)
+                    if self.halted or self.loop is not None:
+                        break
+                    if time.perf_counter() >= deadline:
+                        timed_out = True
+                        break
+        finally:
+            self.output.flush()
+            self.input.release()
+            if self.jit is not None:
+                self.jit.save()
+            if self.ram_image is not None:
+                self.ram_image[:] = self.ram
+        if self.loop is not None:
+            self.exit_reason = "loop"
+        elif not self.halted:
+            self.exit_reason = "timeout" if timed_out else "budget"
+        elif self.overflow:
+            self.exit_reason = "overflow"
+        elif self.reg[self.PC] >= self.size:
+            self.exit_reason = "end"
+        else:
+            self.exit_reason = "halt"
+
+    def run_engine(self, max_steps, detect_loops=False, brent=None):
+        if self.profile is not None:
+            self.run_profile(max_steps)
+        elif self.trace is not None:
+            self.run_trace(max_steps)
+        elif detect_loops:
+            self.run_loopcheck(max_steps, brent)
+        elif self.jit is not None:
+            self.run_jit(max_steps)
+        elif self.memo is not None or self.accel is not None:
+            self.run_counted(max_steps)
+        elif self.table is not None:
+            self.run_table(max_steps)
+        else:
+            self.run_reference(max_steps)
+
+    def run_reference(self, max_steps=None):
+        limit = sys.maxsize if max_steps is None else max_steps
+        n = 0
+        while not self.halted and n < limit:
             instr = self.fetch()
             if instr is None:
                 break
-            if self.debug:
-                print(f"\nPC: {self.reg[self.PC]}")
-                print(f"Instr: {[hex(b) for b in instr]}")
-                print(f"Disasm: {self.disassemble(instr)}")
-                print(f"Registers: {self.reg}")
-                print(f"Program view: {self.program.hex().upper()}")
-                input("Press Enter to step...")
+            n += 1
+            self.steps += 1
             self.execute(instr)
             # PC increment unless changed by jump/call/halt
             if not self.halted and self.reg[self.PC] == (self.reg[self.PC] - 1) % 256:
                 self.reg[self.PC] = (self.reg[self.PC] + 1) % 256
 
+    def decode(self):
+        # Decode the whole program once into a per-PC table of handlers.
+        # Each handler executes one instruction and returns the next PC,
+        # or None once the machine has halted.
+        n = min(len(self.program) // 4, 256)
+        table = []
+        for pc in range(256):
+            if pc < n:
+                table.append(self.decode_instr(pc, self.program[pc * 4 : pc * 4 + 4]))
+            else:
+                table.append(self._halt_handler(pc))
+        return table
+
+    def _halt_handler(self, pc):
+        reg = self.state
+
+        def halt():
+            reg[7] = pc
+            self.halted = True
+
+        return halt
+
+    def _overflow_handler(self, pc):
+        halt = self._halt_handler(pc)
+
+        def overflow():
+            self.overflow = True
+            return halt()
+
+        return overflow
+
+    def decode_instr(self, pc, instr):
+        opcode, op1, op2, dest = instr
+        imm1 = (opcode >> 6) & 1
+        imm2 = (opcode >> 5) & 1
+        opclass = (opcode >> 3) & 0x3
+        subtype = opcode & 0x7
+        reg = mem = self.state  # registers are the first 8 bytes
+        nxt = (pc + 1) % 256
+        d = dest & 0x7
+
+        # Resolve operands up front. Reading r7 always yields the PC of the
+        # instruction being executed, so it folds into an immediate.
+        def operand(val, is_imm):
+            if is_imm:
+                return True, val
+            if val & 0x7 == 7:
+                return True, pc
+            return False, val & 0x7
+
+        a_imm, a = operand(op1, imm1)
+        b_imm, b = operand(op2, imm2)
+        if uses_ram(instr):
+            return self._decode_ram(pc, instr, a_imm, a, b_imm, b)
+
+        # ALU
+        if opclass == 0b00:
+            f = ALU_FUNCS[subtype]
+            if subtype == 0b111:  # NOT ignores OP2
+                b_imm, b = True, 0
+            if d == 6:
+                return lambda: nxt
+            if d == 7 or (a_imm and b_imm):
+                if a_imm and b_imm:
+                    res = f(a, b) & 0xFF
+                    return self._store_const(pc, d, res)
+
+                def alu_pc():
+                    res = f(a if a_imm else reg[a], b if b_imm else reg[b]) & 0xFF
+                    reg[7] = res
+                    return (res + 1) % 256
+
+                return alu_pc
+            if a_imm:
+
+                def alu_ir():
+                    reg[d] = f(a, reg[b]) & 0xFF
+                    return nxt
+
+                return alu_ir
+            if b_imm:
+
+                def alu_ri():
+                    reg[d] = f(reg[a], b) & 0xFF
+                    return nxt
+
+                return alu_ri
+
+            def alu_rr():
+                reg[d] = f(reg[a], reg[b]) & 0xFF
+                return nxt
+
+            return alu_rr
+
+        # COND
+        elif opclass == 0b01:
+            f = COND_FUNCS[subtype]
+            if subtype == 0b000:  # JMP
+                return lambda: dest
+            if subtype == 0b100:  # NOP
+                return lambda: nxt
+            if a_imm and b_imm:
+                target = dest if f(a, b) else nxt
+                return lambda: target
+            if a_imm:
+                return lambda: dest if f(a, reg[b]) else nxt
+            if b_imm:
+                return lambda: dest if f(reg[a], b) else nxt
+            return lambda: dest if f(reg[a], reg[b]) else nxt
+
+        # IO
+        elif opclass == 0b10:
+            if subtype == 0b000:  # MOV
+                if a_imm:
+                    return self._store_const(pc, d, a)
+                if d == 6:
+                    return lambda: nxt
+                if d == 7:
+
+                    def mov_pc():
+                        reg[7] = reg[a]
+                        return (reg[a] + 1) % 256
+
+                    return mov_pc
+
+                def mov():
+                    reg[d] = reg[a]
+                    return nxt
+
+                return mov
+            elif subtype == 0b001:  # SWAP
+                idx1 = op1 & 0x7
+                if idx1 == 6 or d == 6 or idx1 == d:
+                    return lambda: nxt
+                if idx1 == 7 or d == 7:
+                    other = d if idx1 == 7 else idx1
+
+                    def swap_pc():
+                        target = reg[other]
+                        reg[other] = pc
+                        reg[7] = target
+                        return (target + 1) % 256
+
+                    return swap_pc
+
+                def swap():
+                    reg[idx1], reg[d] = reg[d], reg[idx1]
+                    return nxt
+
+                return swap
+            elif subtype == 0b010:  # PUSH
+                overflow = self._overflow_handler(pc)
+                if a_imm:
+
+                    def push_imm():
+                        sp = self.sp
+                        if sp == STACK_SIZE:
+                            return overflow()
+                        mem[STACK_BASE + sp] = a
+                        self.sp = sp + 1
+                        return nxt
+
+                    return push_imm
+
+                def push_reg():
+                    sp = self.sp
+                    if sp == STACK_SIZE:
+                        return overflow()
+                    mem[STACK_BASE + sp] = reg[a]
+                    self.sp = sp + 1
+                    return nxt
+
+                return push_reg
+            elif subtype == 0b011:  # POP
+                if d == 7:
+
+                    def ret():
+                        sp = self.sp
+                        if sp:
+                            self.sp = sp = sp - 1
+                            target = mem[STACK_BASE + sp]
+                            reg[7] = target
+                            return (target + 1) % 256
+                        return nxt
+
+                    return ret
+
+                def pop():
+                    sp = self.sp
+                    if sp:
+                        self.sp = sp = sp - 1
+                        if d != 6:
+                            reg[d] = mem[STACK_BASE + sp]
+                    return nxt
+
+                return pop
+            elif subtype == 0b100:  # WRT
+                wrt = self.wrt
+                fmt = op2 & 0x3
+                if a_imm and not (fmt == 0 and a == 0):
+                    write = self.output.write
+                    data = WRT_TABLE[fmt][a]
+
+                    def wrt_const():
+                        write(data)
+                        return nxt
+
+                    return wrt_const
+                if a_imm:
+
+                    def wrt_imm():
+                        wrt(a, fmt)
+                        return nxt
+
+                    return wrt_imm
+
+                def wrt_reg():
+                    wrt(reg[a], fmt)
+                    return nxt
+
+                return wrt_reg
+            elif subtype == 0b101:  # CALL
+                overflow = self._overflow_handler(pc)
+                if a_imm:
+
+                    def call_imm():
+                        sp = self.sp
+                        if sp == STACK_SIZE:
+                            return overflow()
+                        mem[STACK_BASE + sp] = pc
+                        self.sp = sp + 1
+                        return a
+
+                    return call_imm
+
+                def call_reg():
+                    sp = self.sp
+                    if sp == STACK_SIZE:
+                        return overflow()
+                    mem[STACK_BASE + sp] = pc
+                    self.sp = sp + 1
+                    return reg[a]
+
+                return call_reg
+            elif subtype == 0b110:  # RFT
+                fmt = op2 & 0x3
+                rft = self.rft
+                if d == 7:
+
+                    def read_pc():
+                        val = rft(fmt)
+                        reg[7] = val
+                        return (val + 1) % 256
+
+                    return read_pc
+                if d == 6:
+
+                    def read_discard():
+                        rft(fmt)
+                        return nxt
+
+                    return read_discard
+
+                def read():
+                    reg[d] = rft(fmt)
+                    return nxt
+
+                return read
+            else:  # HCF
+                return self._halt_handler(pc)
+
+        # Reserved opclass: the reference path neither executes nor advances.
+        return lambda: pc
+
+    def _decode_ram(self, pc, instr, a_imm, a, b_imm, b):
+        # Handlers for instructions that use r5, built from accessors for the
+        # RAM byte r4 points at rather than specialized like the rest. Operands
+        # come resolved as in decode_instr().
+        opcode, op1, op2, dest = instr
+        opclass = (opcode >> 3) & 0x3
+        subtype = opcode & 0x7
+        mem = self.state
+        nxt = (pc + 1) % 256
+        d = dest & 0x7
+
+        def getter(is_imm, v):
+            if is_imm:
+                return lambda: v
+            if v == 5:
+                return lambda: mem[RAM_BASE + mem[4]]
+            return lambda: mem[v]  # r6 is never written, so reads as 0
+
+        def setter(r):
+            # Stores a value and returns the next PC.
+            if r == 5:
+
+                def to_ram(v):
+                    mem[RAM_BASE + mem[4]] = v
+                    return nxt
+
+                return to_ram
+            if r == 7:
+
+                def to_pc(v):
+                    mem[7] = v
+                    return (v + 1) % 256
+
+                return to_pc
+            if r == 6:
+                return lambda v: nxt
+
+            def to_reg(v):
+                mem[r] = v
+                return nxt
+
+            return to_reg
+
+        get_a = getter(a_imm, a)
+        get_b = getter(b_imm, b)
+        put = setter(d)
+
+        if opclass == 0b00:  # ALU
+            f = ALU_FUNCS[subtype]
+            if subtype == 0b111:  # NOT ignores OP2
+                get_b = getter(True, 0)
+            return lambda: put(f(get_a(), get_b()) & 0xFF)
+        if opclass == 0b01:  # COND
+            f = COND_FUNCS[subtype]
+            return lambda: dest if f(get_a(), get_b()) else nxt
+        if subtype == 0b000:  # MOV
+            return lambda: put(get_a())
+        if subtype == 0b001:  # SWAP
+            other = d if op1 & 0x7 == 5 else op1 & 0x7
+            if other in (5, 6):
+                return lambda: nxt
+            if other == 7:
+
+                def swap_pc():
+                    k = RAM_BASE + mem[4]
+                    target = mem[k]
+                    mem[k] = pc
+                    mem[7] = target
+                    return (target + 1) % 256
+
+                return swap_pc
+
+            def swap():
+                # Swapping with r4 moves RAM's old byte into r4, so the
+                # address is taken first.
+                k = RAM_BASE + mem[4]
+                mem[other], mem[k] = mem[k], mem[other]
+                return nxt
+
+            return swap
+        if subtype == 0b010:  # PUSH
+            overflow = self._overflow_handler(pc)
+
+            def push_ram():
+                sp = self.sp
+                if sp == STACK_SIZE:
+                    return overflow()
+                mem[STACK_BASE + sp] = get_a()
+                self.sp = sp + 1
+                return nxt
+
+            return push_ram
+        if subtype == 0b011:  # POP
+
+            def pop_ram():
+                sp = self.sp
+                if sp:
+                    self.sp = sp = sp - 1
+                    return put(mem[STACK_BASE + sp])
+                return nxt
+
+            return pop_ram
+        if subtype == 0b100:  # WRT
+            wrt = self.wrt
+            fmt = op2 & 0x3
+
+            def wrt_ram():
+                wrt(get_a(), fmt)
+                return nxt
+
+            return wrt_ram
+        if subtype == 0b101:  # CALL
+            overflow = self._overflow_handler(pc)
+
+            def call_ram():
+                sp = self.sp
+                if sp == STACK_SIZE:
+                    return overflow()
+                mem[STACK_BASE + sp] = pc
+                self.sp = sp + 1
+                return get_a()
+
+            return call_ram
+        # RFT
+        rft = self.rft
+        fmt = op2 & 0x3
+        return lambda: put(rft(fmt))
+
+    def _store_const(self, pc, d, value):
+        reg = self.state
+        nxt = (pc + 1) % 256
+        if d == 6:
+            return lambda: nxt
+        if d == 7:
+            target = (value + 1) % 256
+
+            def store_pc():
+                reg[7] = value
+                return target
+
+            return store_pc
+
+        def store():
+            reg[d] = value
+            return nxt
+
+        return store
+
+    def run_table(self, max_steps=None):
+        table = self.table
+        reg = self.state
+        pc = reg[self.PC]
+        limit = sys.maxsize if max_steps is None else max_steps
+        n = 0
+        try:
+            for n in range(limit):
+                nxt = table[pc]()
+                if nxt is None:
+                    if pc < self.size:  # HCF; running off the end is not an instruction
+                        n += 1
+                    break
+                pc = nxt
+            else:
+                n = limit
+        finally:
+            # On an exception, pc still names the instruction that was executing.
+            reg[self.PC] = pc
+            self.steps += n
+
+    def run_counted(self, max_steps=None):
+        # Like run_table(), but counting into ctr[0] as run_jit() does, so
+        # memo and accel handlers that stand for many instructions can see
+        # the budget left. Handlers find ctr[0] not yet counting their own
+        # instruction.
+        table = self.table
+        reg = self.state
+        ctr = self.ctr
+        ctr[0] = self.steps
+        ctr[1] = sys.maxsize if max_steps is None else self.steps + max_steps
+        pc = reg[self.PC]
+        try:
+            while ctr[0] < ctr[1]:
+                nxt = table[pc]()
+                if nxt is None:
+                    if pc < self.size:
+                        ctr[0] += 1
+                    break
+                ctr[0] += 1
+                pc = nxt
+        finally:
+            reg[self.PC] = pc
+            self.steps = ctr[0]
+
+    def run_jit(self, max_steps=None):
+        # Like run_table(), but blocks count their own instructions into ctr[0]
+        # and may overshoot max_steps by at most one block.
+        table = self.table
+        reg = self.state
+        ctr = self.ctr
+        ctr[0] = self.steps
+        ctr[1] = sys.maxsize if max_steps is None else self.steps + max_steps
+        pc = reg[self.PC]
+        try:
+            while ctr[0] < ctr[1]:
+                pc = table[pc]()
+                if pc is None:  # the halting block has already set r7
+                    break
+        finally:
+            if pc is not None:
+                reg[self.PC] = pc
+            self.steps = ctr[0]
+
+    def run_loopcheck(self, max_steps, brent):
+        # Like run_table(), also running Brent's cycle detection over machine
+        # states. Between RFTs the machine is deterministic, so meeting a saved
+        # state again proves it loops forever. The saved state is only
+        # compared when the PC matches, which keeps the per-step cost low.
+        table = self.plain_table()
+        reads = self.rft_pcs()
+        state = self.state
+        saved, saved_sp, power, lam = brent
+        saved_pc = saved[self.PC] if saved is not None else -1
+        pc = state[self.PC]
+        limit = sys.maxsize if max_steps is None else max_steps
+        n = 0
+        try:
+            for n in range(limit):
+                nxt = table[pc]()
+                if nxt is None:
+                    if pc < self.size:
+                        n += 1
+                    break
+                if pc in reads:  # input makes the future unpredictable
+                    saved, saved_pc, power, lam = None, -1, 1, 0
+                pc = nxt
+                lam += 1
+                if pc == saved_pc:
+                    state[self.PC] = pc
+                    if state == saved and self.sp == saved_sp:
+                        n += 1
+                        self.loop = self.loop_range(lam)
+                        break
+                if lam == power:
+                    state[self.PC] = pc
+                    saved, saved_pc, saved_sp = bytes(state), pc, self.sp
+                    power *= 2
+                    lam = 0
+            else:
+                n = limit
+        finally:
+            state[self.PC] = pc
+            self.steps += n
+            brent[:] = saved, saved_sp, power, lam
+
+    def plain_table(self):
+        # A dispatch table that runs one instruction per handler: self.table,
+        # unless memo or accel wrappers have been installed in it.
+        if self.engine == "table" and self.memo is None and self.accel is None:
+            return self.table
+        return self.decode()
+
+    def rft_pcs(self):
+        if self.reads is None:
+            self.reads = {pc for pc in range(min(self.size, 256)) if self.program[pc * 4] & 0x1F == 0b10110}
+        return self.reads
+
+    def loop_range(self, period):
+        # Replays one period of a detected cycle on a scratch copy of the
+        # machine and returns the lowest and highest PC it visits.
+        probe = self.fork(output=MemorySink(), input_source=BytesSource())
+        table = probe.plain_table()  # stepping as run_loopcheck() did
+        pc = lo = hi = probe.state[self.PC]
+        for _ in range(period):
+            pc = table[pc]()
+            lo, hi = min(lo, pc), max(hi, pc)
+        return lo, hi
+
+    def condition(self, pc):
+        # A function giving whether the jump at pc branches in the current
+        # state: its condition, not where it lands, since a jump to pc + 1
+        # lands there either way.
+        opcode, op1, op2, _ = self.program[pc * 4 : pc * 4 + 4]
+        subtype = opcode & 0x7
+        f = COND_FUNCS[subtype]
+        if f is None:
+            return (lambda: True) if subtype == 0b000 else (lambda: False)
+        mem = self.state
+
+        def getter(val, is_imm):
+            if is_imm:
+                return lambda: val
+            r = val & 0x7
+            if r == 7:
+                return lambda: pc
+            if r == 5:
+                return lambda: mem[RAM_BASE + mem[4]]
+            return lambda: mem[r]
+
+        get_a, get_b = getter(op1, (opcode >> 6) & 1), getter(op2, (opcode >> 5) & 1)
+        return lambda: f(get_a(), get_b())
+
+    def run_profile(self, max_steps=None):
+        # Like run_table(), also recording statistics into self.profile. JIT
+        # blocks run many instructions per call, so this always runs decoded
+        # handlers; the other run loops never pay for profiling.
+        from profiler import CALL, JUMP, POP, PUSH
+
+        prof = self.profile
+        table = self.plain_table()
+        counts, taken, kinds, calls = prof.counts, prof.taken, prof.kinds, prof.calls
+        # Jumps change nothing but the PC, so their conditions read the same
+        # after the handler has run.
+        branches = {pc: self.condition(pc) for pc in range(self.size) if kinds[pc] == JUMP}
+        frames = []  # (stack depth inside the call, target, step of the CALL)
+        reg = self.state
+        pc = reg[self.PC]
+        limit = sys.maxsize if max_steps is None else max_steps
+        n = 0
+        try:
+            for n in range(limit):
+                nxt = table[pc]()
+                if nxt is None:
+                    if pc < self.size:
+                        counts[pc] += 1
+                        n += 1
+                    break
+                counts[pc] += 1
+                kind = kinds[pc]
+                if kind == JUMP:
+                    if branches[pc]():
+                        taken[pc] += 1
+                elif kind == CALL or kind == PUSH:
+                    if self.sp > prof.max_depth:
+                        prof.max_depth = self.sp
+                    if kind == CALL:
+                        frames.append((self.sp, nxt, n))
+                        calls.setdefault(nxt, [0, 0])[0] += 1
+                elif kind == POP:
+                    while frames and self.sp < frames[-1][0]:
+                        _, target, start = frames.pop()
+                        calls[target][1] += n - start
+                pc = nxt
+            else:
+                n = limit
+        finally:
+            reg[self.PC] = pc
+            self.steps += n
+            # Calls still running count what they have executed so far.
+            for _, target, start in frames:
+                calls[target][1] += max(n - 1 - start, 0)
+
+    def run_trace(self, max_steps=None):
+        # Like run_table(), also logging each instruction's changes into
+        # self.trace. Handlers that raise after executing, like the debugger's
+        # watchpoints, say so with a `next` attribute and are logged too.
+        trace = self.trace
+        table = self.plain_table()
+        before, record = trace.before, trace.record
+        state = self.state
+        pc = state[self.PC]
+        limit = sys.maxsize if max_steps is None else max_steps
+        n = 0
+        trace.truncate()
+        try:
+            for n in range(limit):
+                sp = self.sp
+                old = before(pc, state, sp)
+                try:
+                    nxt = table[pc]()
+                except Exception as e:
+                    if getattr(e, "next", None) is not None:
+                        record(pc, old, sp, self)
+                    raise
+                if nxt is None:
+                    if pc < self.size:
+                        record(pc, old, sp, self)
+                        n += 1
+                    break
+                record(pc, old, sp, self)
+                pc = nxt
+            else:
+                n = limit
+        finally:
+            state[self.PC] = pc
+            self.steps += n
+            trace.finish(self)
+
     def get_operand(self, val, is_imm):
-        return val if is_imm else self.reg[val & 0x7]
+        if is_imm:
+            return val
+        if val & 0x7 == 5:  # RAMDATA
+            return self.ram[self.reg[4]]
+        return self.reg[val & 0x7]
 
     def set_reg(self, idx, value):
         if idx == 6:
             return  # r6 is reserved
+        if idx == 5:  # RAMDATA
+            self.ram[self.reg[4]] = value & 0xFF
+            return
         self.reg[idx] = value & 0xFF
 
     def execute(self, instr):
@@ -196,100 +1189,114 @@ class MiniMachineVM:
                 idx1 = op1 & 0x7
                 idx2 = dest & 0x7
                 if idx1 != 6 and idx2 != 6:
-                    self.reg[idx1], self.reg[idx2] = self.reg[idx2], self.reg[idx1]
+                    if idx1 == 5:
+                        idx1, idx2 = idx2, idx1
+                    # RAM is written first, while r4 still holds its address.
+                    val1, val2 = self.get_operand(idx1, 0), self.get_operand(idx2, 0)
+                    self.set_reg(idx2, val1)
+                    self.set_reg(idx1, val2)
             elif subtype == 0b010:  # PUSH
                 val = self.get_operand(op1, imm1)
-                self.stack.append(val)
+                if not self.push(val):
+                    return
             elif subtype == 0b011:  # POP
-                if self.stack:
-                    self.set_reg(dest & 0x7, self.stack.pop())
+                if self.sp:
+                    self.set_reg(dest & 0x7, self.pop())
             elif subtype == 0b100:  # WRT
                 val = self.get_operand(op1, imm1)
                 fmt = op2 & 0x3
                 self.wrt(val, fmt)
             elif subtype == 0b101:  # CALL
                 addr = self.get_operand(op1, imm1)
-                self.stack.append((self.reg[self.PC]) % 256)
-                self.set_reg(self.PC, addr)
+                if self.push(self.reg[self.PC]):
+                    self.set_reg(self.PC, addr)
                 return
             elif subtype == 0b110:  # RFT
                 fmt = op2 & 0x3
-                input_val = None
-                try:
-                    fd = sys.stdin.fileno()
-                    old_settings = termios.tcgetattr(fd)
-                    try:
-                        tty.setraw(fd)
-                        user_input = sys.stdin.read(1)
-                    finally:
-                        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-                except EOFError:
-                    user_input = ""
-                    input_val = 0xFE
-                    self.set_reg(dest & 0x7, input_val)
-                    return
-
-                if fmt == 0:  # UTF-8
-                    if user_input:
-                        input_val = ord(user_input[0]) & 0xFF
-                    else:
-                        input_val = 0xFF
-                elif fmt == 1:  # Decimal
-                    if user_input.isdigit() and 0 <= int(user_input) <= 9:
-                        input_val = int(user_input)
-                    else:
-                        input_val = 0xFF
-                elif fmt == 2:  # Alphabetic
-                    if user_input and user_input[0].isalpha():
-                        ch = user_input[0].upper()
-                        idx = ord(ch) - ord("A")
-                        if 0 <= idx <= 25:
-                            input_val = idx
-                        else:
-                            input_val = 0xFF
-                    else:
-                        input_val = 0xFF
-                elif fmt == 3:  # Hexadecimal
-                    if user_input and len(user_input) == 1 and user_input[0].upper() in "0123456789ABCDEF":
-                        input_val = int(user_input[0], 16)
-                    else:
-                        input_val = 0xFF
-                self.set_reg(dest & 0x7, input_val)
-                return
+                self.set_reg(dest & 0x7, self.rft(fmt))
             elif subtype == 0b111:  # HCF
                 self.halted = True
                 return
             self.reg[self.PC] = (self.reg[self.PC] + 1) % 256
             return
 
+    def rft(self, fmt):
+        self.output.flush()  # show any prompt before waiting for input
+        byte = self.input.read()
+        if byte is None:
+            return EMPTY
+        return RFT_TABLE[fmt][byte]
+
     def wrt(self, val, fmt):
-        if fmt == 0:  # UTF-8
-            if val == 0:
-                self.term_buffer = ""
-                print("\033c", end="")  # clear terminal
-            else:
-                print(chr(val), end="")
-        elif fmt == 1:  # Decimal
-            if val <= 9:
-                print(str(val), end="")
-            else:
-                print("?", end="")
-        elif fmt == 2:  # Alphabetic
-            if val <= 25:
-                print(chr(ord("A") + val), end="")
-            else:
-                print("?", end="")
-        elif fmt == 3:  # Hexadecimal
-            if val <= 0xF:
-                print(hex(val)[2:].upper(), end="")
-            else:
-                print("?", end="")
-        sys.stdout.flush()
+        self.output.write(WRT_TABLE[fmt][val])
 
 
 if __name__ == "__main__":
     debug = False
     v_opt = 0
+    engine = "reference"
+    jit_cache = True
+    profile_file = None
+    max_steps = None
+    timeout = None
+    detect_loops = False
+    memoize = False
+    exact_steps = True
+    accelerate = False
+    trace_file = None
+    trace_size = None
+    reverse = False
+    screen = False
+    ram_file = None
+    if "--no-jit-cache" in sys.argv:
+        jit_cache = False
+        sys.argv.remove("--no-jit-cache")
+    if "--engine" in sys.argv:
+        i = sys.argv.index("--engine")
+        engine = sys.argv[i + 1]
+        del sys.argv[i : i + 2]
+    if "--profile" in sys.argv:
+        i = sys.argv.index("--profile")
+        profile_file = sys.argv[i + 1]
+        del sys.argv[i : i + 2]
+    if "--max-steps" in sys.argv:
+        i = sys.argv.index("--max-steps")
+        max_steps = int(sys.argv[i + 1])
+        del sys.argv[i : i + 2]
+    if "--timeout" in sys.argv:
+        i = sys.argv.index("--timeout")
+        timeout = float(sys.argv[i + 1])
+        del sys.argv[i : i + 2]
+    if "--detect-loops" in sys.argv:
+        detect_loops = True
+        sys.argv.remove("--detect-loops")
+    if "--memoize" in sys.argv:
+        memoize = True
+        sys.argv.remove("--memoize")
+    if "--accelerate" in sys.argv:
+        accelerate = True
+        sys.argv.remove("--accelerate")
+    if "--inexact-steps" in sys.argv:
+        exact_steps = False
+        sys.argv.remove("--inexact-steps")
+    if "--trace" in sys.argv:
+        i = sys.argv.index("--trace")
+        trace_file = sys.argv[i + 1]
+        del sys.argv[i : i + 2]
+    if "--trace-size" in sys.argv:
+        i = sys.argv.index("--trace-size")
+        trace_size = int(sys.argv[i + 1])
+        del sys.argv[i : i + 2]
+    if "--reverse" in sys.argv:
+        reverse = True
+        sys.argv.remove("--reverse")
+    if "--ram" in sys.argv:
+        i = sys.argv.index("--ram")
+        ram_file = sys.argv[i + 1]
+        del sys.argv[i : i + 2]
+    if "--screen" in sys.argv:
+        screen = True
+        sys.argv.remove("--screen")
     if "--debug" in sys.argv:
         debug = True
         sys.argv.remove("--debug")
@@ -305,10 +1312,39 @@ if __name__ == "__main__":
         print("No program specified, defaulting to out.mi8")
     else:
         program_file = sys.argv[1]
-    with open(program_file, "rb") as f:
-        program = f.read()
+    image = container.load(program_file)
+    program = image.program
+    source_map = sourcemap.load_for(program_file, program) or image.source_map()
+
+    if debug:
+        engine = "table"  # the debugger instruments the decoded handler table
+        memoize = False  # and steps through every call
+        accelerate = False
+    if (memoize or accelerate) and engine == "reference":
+        engine = "table"
+    trace = 0
+    # Recording costs every instruction, so the debugger only records (and
+    # can step back) with --reverse, --trace or --trace-size.
+    if trace_file or (debug and (reverse or trace_size)):
+        from recorder import CAPACITY
 
-    vm = MiniMachineVM(program, debug=debug)
+        trace = trace_size or CAPACITY
+    vm = MiniMachineVM(
+        program,
+        debug=debug,
+        engine=engine,
+        jit_cache=jit_cache,
+        profile=profile_file is not None,
+        source_map=source_map,
+        memoize=memoize,
+        exact_steps=exact_steps,
+        accelerate=accelerate,
+        trace=trace,
+        leaders=image.leaders,
+        ram_file=ram_file,
+        # Redraw only the cells that change; the debugger prints between steps.
+        output=ScreenSink(sys.stdout.buffer) if screen and not debug else None,
+    )
     if v_opt == 1:
         print("Program (hex):")
         print(vm.program_format())
@@ -320,10 +1356,34 @@ if __name__ == "__main__":
         for i in range(0, len(program), 4):
             instr = program[i : i + 4]
             if len(instr) < 4:
-                instr += b"\x00" * (4 - len(instr))
+                instr = bytes(instr) + b"\x00" * (4 - len(instr))  # raw binaries load as a memoryview
             addr = i // 4
             disasm = vm.disassemble(instr)
             hex_instr = " ".join(f"{b:02X}" for b in instr)
-            print(f"{addr:02X}: {hex_instr}  {disasm}")
+            source = vm.where(addr)
+            print(f"{addr:02X}: {hex_instr}  {disasm}" + (f"  ; {source}" if source else ""))
+        sys.exit(0)
+    if debug:
+        from debugger import Debugger
+
+        Debugger(vm).repl()
+        if trace_file:
+            vm.trace.save(trace_file, vm)
         sys.exit(0)
-    vm.run()
+    vm.run(max_steps, timeout=timeout, detect_loops=detect_loops)
+    if trace_file:
+        vm.trace.save(trace_file, vm)
+    if vm.exit_reason == "loop":
+        where = vm.where(vm.loop[0])
+        print(f"Stopped: infinite loop at PC {vm.loop[0]:02X}-{vm.loop[1]:02X}" + (f" ({where})" if where else ""), file=sys.stderr)
+    elif vm.exit_reason not in ("halt", "end"):
+        where = vm.where(vm.state[vm.PC])
+        print(f"Stopped: {vm.exit_reason} after {vm.steps} instructions" + (f" at {where}" if where else ""), file=sys.stderr)
+    if vm.memo is not None:
+        print(vm.memo.report(source_map), file=sys.stderr)
+    if vm.accel is not None:
+        print(vm.accel.report(source_map), file=sys.stderr)
+    if profile_file:
+        # JSON to the given file, the annotated listing to stderr.
+        vm.profile.write_json(profile_file, vm.disassemble)
+        print(vm.profile.listing(vm.disassemble), file=sys.stderr)